@@ -0,0 +1,302 @@
+import ast
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from analysis_engine import ANALYZER_VERSION, FUNCTION_NODES, CodeQualityMetric, analyze_tree
+
+class PersistentLRUCache:
+    """
+    A size-bounded key/value store in SQLite that evicts the least recently used entries.
+
+    Values are stored as JSON. The cache is safe to share between threads, and several processes
+    can open the same file.
+    """
+
+    # Pending access times are written after this many hits, or this many seconds
+    FLUSH_ENTRIES = 64
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024):
+        """
+        Open (or create) the cache file.
+
+        Args:
+            path (str): Path to the SQLite database file.
+            max_bytes (int): Total size of stored values above which old entries are evicted.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self._conn.commit()
+        self._size = self._total_size()
+        # Access times of hits are written in batches rather than one transaction per lookup
+        self._accessed: Dict[str, float] = {}
+        self._last_flush = time.monotonic()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up a value and mark it as recently used.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            Optional[Any]: The stored value, or None on a miss.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._accessed[key] = time.time()
+            if len(self._accessed) >= self.FLUSH_ENTRIES or time.monotonic() - self._last_flush >= self.FLUSH_INTERVAL:
+                self._flush_accesses()
+                self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any) -> None:
+        """
+        Store a value, evicting least recently used entries if the cache grows past its size limit.
+
+        Args:
+            key (str): The cache key.
+            value (Any): A JSON-serialisable value.
+        """
+        payload = json.dumps(value)
+        with self._lock:
+            self._accessed.pop(key, None)
+            self._flush_accesses()
+            previous = self._conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, payload, len(payload), time.time()),
+            )
+            self._size += len(payload) - (previous[0] if previous else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _total_size(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def _flush_accesses(self) -> None:
+        if self._accessed:
+            self._conn.executemany("UPDATE entries SET last_access = ? WHERE key = ?",
+                                   [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed.clear()
+        self._last_flush = time.monotonic()
+
+    def _evict(self) -> None:
+        # The running total only sees this process's writes; other processes may share the file
+        self._size = self._total_size()
+        if self._size <= self.max_bytes:
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.evictions += 1
+            self._size -= size
+            if self._size <= self.max_bytes:
+                break
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Report hit/miss counters for this process and the cache's current size.
+
+        Returns:
+            Dict[str, int]: The 'hits', 'misses', 'evictions', 'entries' and 'bytes' counters.
+        """
+        with self._lock:
+            self._flush_accesses()
+            self._conn.commit()
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': entries, 'bytes': size}
+
+    def clear(self) -> None:
+        """Remove every entry."""
+        with self._lock:
+            self._accessed.clear()
+            self._conn.execute("DELETE FROM entries")
+            self._conn.commit()
+            self._size = 0
+
+    def close(self) -> None:
+        """Close the underlying database connection."""
+        with self._lock:
+            self._flush_accesses()
+            self._conn.commit()
+            self._conn.close()
+
+def line_layout(node: ast.AST) -> List[tuple]:
+    """
+    Describe how a syntax tree is split over lines, as far as the metrics can tell.
+
+    Lines of code (and so the maintainability index) count the distinct lines nodes start on,
+    and the function length check compares each function's span with
+    CodeQualityMetric.max_function_length. The layout holds just that: the rank of each node's
+    first line among those lines, and for functions whether they are too long. Comments, blank
+    lines and moving the code up or down don't change it, unless a function crosses the limit.
+
+    Args:
+        node (ast.AST): The module, class or function.
+
+    Returns:
+        List[tuple]: (line rank,) for each node, plus the too-long flag for functions, in traversal order.
+    """
+    nodes = [child for child in ast.walk(node) if getattr(child, 'lineno', None) is not None]
+    ranks = {line: rank for rank, line in enumerate(sorted({child.lineno for child in nodes}))}
+    limit = CodeQualityMetric.max_function_length
+    return [(ranks[child.lineno], child.end_lineno - child.lineno + 1 > limit)
+            if isinstance(child, FUNCTION_NODES) else (ranks[child.lineno],) for child in nodes]
+
+def normalized_hash(node: ast.AST) -> str:
+    """
+    Hash a syntax tree so that comments and spacing within lines don't affect the result.
+
+    The analyzer version is part of the hash, so results from an older analyzer are never reused.
+
+    Args:
+        node (ast.AST): The module, class or function to hash.
+
+    Returns:
+        str: A hex SHA-256 digest.
+    """
+    dump = ast.dump(node, annotate_fields=False, include_attributes=False)
+    payload = f"{ANALYZER_VERSION}\n{dump}\n{line_layout(node)}"
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def iter_function_nodes(tree: ast.AST) -> Iterable[tuple]:
+    """
+    Yield every function in a module with its qualified name, e.g. 'Class.method'.
+
+    Functions come in source order, so when several share a name (e.g. in the branches of an
+    if/else) the last one is the one the analysis engine reports under that name.
+
+    Args:
+        tree (ast.AST): The parsed module.
+
+    Yields:
+        tuple: (qualified_name, function_node) pairs.
+    """
+    stack = [('', child) for child in reversed(list(ast.iter_child_nodes(tree)))]
+    while stack:
+        prefix, node = stack.pop()
+        if isinstance(node, FUNCTION_NODES + (ast.ClassDef,)):
+            name = f"{prefix}{node.name}"
+            if isinstance(node, FUNCTION_NODES):
+                yield name, node
+            stack.extend((f"{name}.", child) for child in reversed(list(ast.iter_child_nodes(node))))
+        else:
+            stack.extend((prefix, child) for child in reversed(list(ast.iter_child_nodes(node))))
+
+class AnalysisCache:
+    """
+    Caches code analysis results keyed by the normalized AST, per module and per function.
+    """
+
+    def __init__(self, path: str = './.refactor_earth_cache/analysis.sqlite', max_bytes: int = 256 * 1024 * 1024):
+        """
+        Args:
+            path (str): Path to the SQLite database file.
+            max_bytes (int): Size limit of the stored results.
+        """
+        self.store = PersistentLRUCache(path, max_bytes)
+
+    def analyze(self, code: str) -> Dict[str, Any]:
+        """
+        Analyze Python source, reusing stored results when the code is unchanged.
+
+        When the module changed, unchanged functions keep their stored results; only the module
+        totals and the changed functions are measured again.
+
+        Args:
+            code (str): The Python source code.
+
+        Returns:
+            Dict[str, Any]: {'module': {...}, 'functions': {qualified_name: {...}}}, as from analyze_source.
+
+        Raises:
+            SyntaxError: If the code cannot be parsed.
+        """
+        tree = ast.parse(code)
+        key = f"module:{normalized_hash(tree)}"
+        results = self.store.get(key)
+        if results is None:
+            known = {}
+            for _, node in iter_function_nodes(tree):
+                result = self.store.get(f"function:{normalized_hash(node)}")
+                if result is not None:
+                    known[node] = result
+            results = analyze_tree(tree, known=known)
+            self.store.put(key, results)
+            for name, node in iter_function_nodes(tree):
+                if node in known:
+                    continue
+                result = results['functions'][name]
+                if result['lineno'] != node.lineno:
+                    # Shadowed by a later function of the same name; the module results only hold that one
+                    self.analyze_function(node)
+                    continue
+                self.store.put(f"function:{normalized_hash(node)}", result)
+            return results
+        # Line numbers are not part of the key, so report where each function is now
+        for name, node in iter_function_nodes(tree):
+            results['functions'][name].update(lineno=node.lineno, end_lineno=node.end_lineno)
+        return results
+
+    def analyze_functions(self, tree: ast.AST) -> Dict[str, Dict[str, Any]]:
+        """
+        Get per-function results for a module, analyzing only functions not seen before.
+
+        Args:
+            tree (ast.AST): The parsed module.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: Function metrics keyed by qualified name.
+        """
+        return {name: self.analyze_function(node) for name, node in iter_function_nodes(tree)}
+
+    def analyze_function(self, node: ast.AST) -> Dict[str, Any]:
+        """
+        Get the metrics for a single function, analyzing it only if it has not been seen before.
+
+        Args:
+            node (ast.AST): The function definition.
+
+        Returns:
+            Dict[str, Any]: The function's metrics.
+        """
+        key = f"function:{normalized_hash(node)}"
+        result = self.store.get(key)
+        if result is None:
+            result = analyze_tree(ast.Module(body=[node], type_ignores=[]))['functions'][node.name]
+            self.store.put(key, result)
+        # Line numbers are not part of the key, so report where the function is now
+        return dict(result, lineno=node.lineno, end_lineno=node.end_lineno)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Report cache hit/miss counters and size.
+
+        Returns:
+            Dict[str, int]: See PersistentLRUCache.stats.
+        """
+        return self.store.stats()
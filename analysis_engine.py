@@ -0,0 +1,514 @@
+import ast
+import math
+import re
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional
+
+# Bump this whenever a metric's definition changes so stored results are not reused across versions
+ANALYZER_VERSION = "1.0"
+
+# Node types that repeat their body, and the comprehension clause that acts like one
+LOOP_NODES = (ast.For, ast.AsyncFor, ast.While, ast.comprehension)
+FUNCTION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef)
+COMPREHENSION_NODES = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+# Calls that touch the filesystem or the terminal
+IO_CALLS = {'open', 'print', 'input', 'write', 'writelines', 'read', 'readline', 'readlines'}
+
+def call_name(node: ast.Call) -> Optional[str]:
+    """
+    Get the bare name of the function being called, e.g. 'append' for `result.append(x)`.
+
+    Args:
+        node (ast.Call): The call node.
+
+    Returns:
+        Optional[str]: The called name, or None for calls on computed expressions.
+    """
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    return None
+
+def big_o(order: int, log: bool = False) -> str:
+    """
+    Format a polynomial order as big-O notation.
+
+    Args:
+        order (int): The exponent of n.
+        log (bool): Whether to add a log n factor.
+
+    Returns:
+        str: The complexity string, e.g. 'O(n^2)' or 'O(n log n)'.
+    """
+    if order == 0:
+        return "O(log n)" if log else "O(1)"
+    term = "n" if order == 1 else f"n^{order}"
+    return f"O({term} log n)" if log else f"O({term})"
+
+class MetricPlugin:
+    """
+    Base class for a metric computed during the single AST traversal.
+
+    The engine keeps one state object per plugin for the module and for every function, and calls
+    `visit` for each node whose type is listed in `node_types`. When a scope is finished,
+    `finalize` turns its state into the metric values reported for that scope.
+    """
+    name = "metric"
+    node_types = ()
+
+    def new_state(self) -> Any:
+        """Create the empty accumulator for one scope."""
+        return {}
+
+    def visit(self, node: ast.AST, state: Any, depth: int, engine: "AnalysisEngine") -> None:
+        """
+        Update a scope's state with one node.
+
+        Args:
+            node (ast.AST): The node being visited.
+            state (Any): The accumulator created by `new_state` for this scope.
+            depth (int): How many loops inside the scope enclose this node.
+            engine (AnalysisEngine): The running engine, for traversal context.
+        """
+
+    def finalize(self, state: Any, scope: "Scope") -> Dict[str, Any]:
+        """
+        Turn a scope's accumulated state into metric values.
+
+        Args:
+            state (Any): The accumulator for the scope.
+            scope (Scope): The finished scope.
+
+        Returns:
+            Dict[str, Any]: Metric names mapped to their values.
+        """
+        return {}
+
+class TimeComplexityMetric(MetricPlugin):
+    """Estimates time complexity from loop nesting and sorting calls."""
+    name = "time_complexity"
+    node_types = LOOP_NODES + (ast.Call,)
+
+    def new_state(self):
+        return {'order': 0, 'log': False, 'loops': 0}
+
+    def visit(self, node, state, depth, engine):
+        if isinstance(node, ast.Call):
+            if call_name(node) not in ('sorted', 'sort'):
+                return
+            # A sort costs n log n on top of the loops around it
+            candidate = (depth + 1, True)
+        else:
+            state['loops'] = max(state['loops'], depth + 1)
+            candidate = (depth + 1, False)
+        if candidate > (state['order'], state['log']):
+            state['order'], state['log'] = candidate
+
+    def finalize(self, state, scope):
+        return {'time_complexity': big_o(state['order'], state['log']), 'max_loop_depth': state['loops']}
+
+class SpaceComplexityMetric(MetricPlugin):
+    """Estimates space complexity from how deeply growing containers are filled."""
+    name = "space_complexity"
+    node_types = (ast.List, ast.Dict, ast.Set, ast.ListComp, ast.SetComp, ast.DictComp, ast.Call)
+
+    def new_state(self):
+        return {'order': 0, 'allocations': 0}
+
+    def visit(self, node, state, depth, engine):
+        if isinstance(node, ast.Call):
+            if call_name(node) in ('append', 'extend', 'add', 'insert', 'update', 'setdefault'):
+                state['order'] = max(state['order'], depth)
+            return
+        state['allocations'] += 1
+        if isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp)):
+            state['order'] = max(state['order'], depth + len(node.generators))
+
+    def finalize(self, state, scope):
+        return {'space_complexity': big_o(state['order']), 'allocations': state['allocations']}
+
+class CodeQualityMetric(MetricPlugin):
+    """Scores code quality by counting common style and robustness issues."""
+    name = "code_quality"
+    node_types = FUNCTION_NODES + (ast.ClassDef, ast.ExceptHandler, ast.Global)
+    max_function_length = 50
+    max_arguments = 5
+
+    def new_state(self):
+        return Counter()
+
+    def visit(self, node, state, depth, engine):
+        if isinstance(node, ast.ExceptHandler):
+            if node.type is None:
+                state['bare_except'] += 1
+            return
+        if isinstance(node, ast.Global):
+            state['global_statement'] += 1
+            return
+        if ast.get_docstring(node) is None:
+            state['missing_docstring'] += 1
+        if isinstance(node, ast.ClassDef):
+            if not re.match(r'^_*[A-Z][A-Za-z0-9]*$', node.name):
+                state['naming'] += 1
+            return
+        if not re.match(r'^_*[a-z][a-z0-9_]*$', node.name):
+            state['naming'] += 1
+        if node.end_lineno - node.lineno + 1 > self.max_function_length:
+            state['long_function'] += 1
+        args = node.args
+        if len(args.posonlyargs) + len(args.args) + len(args.kwonlyargs) > self.max_arguments:
+            state['too_many_arguments'] += 1
+
+    def finalize(self, state, scope):
+        score = max(0, 100 - 10 * sum(state.values()))
+        return {'code_quality': score, 'quality_issues': dict(state)}
+
+class ScalabilityMetric(MetricPlugin):
+    """Scores how well code scales with input size, penalising nested loops and I/O inside loops."""
+    name = "scalability"
+    node_types = LOOP_NODES + (ast.Call,)
+
+    def new_state(self):
+        return {'max_depth': 0, 'nested_loops': 0, 'io_in_loops': 0}
+
+    def visit(self, node, state, depth, engine):
+        if isinstance(node, ast.Call):
+            if depth > 0 and call_name(node) in IO_CALLS:
+                state['io_in_loops'] += 1
+            return
+        state['max_depth'] = max(state['max_depth'], depth + 1)
+        if depth > 0:
+            state['nested_loops'] += 1
+
+    def finalize(self, state, scope):
+        score = 100 - 20 * max(0, state['max_depth'] - 1) - 5 * state['nested_loops'] - 10 * state['io_in_loops']
+        return {'scalability_score': max(0, score), 'io_in_loops': state['io_in_loops']}
+
+class MaintainabilityMetric(MetricPlugin):
+    """Computes the maintainability index from Halstead volume, cyclomatic complexity and lines of code."""
+    name = "maintainability_index"
+    node_types = (ast.AST,)
+    decision_nodes = (ast.If, ast.For, ast.AsyncFor, ast.While, ast.IfExp, ast.ExceptHandler, ast.Assert, ast.comprehension)
+
+    def new_state(self):
+        return {'operators': Counter(), 'operands': Counter(), 'decisions': 0, 'lines': set()}
+
+    def visit(self, node, state, depth, engine):
+        lineno = getattr(node, 'lineno', None)
+        if lineno is not None:
+            state['lines'].add(lineno)
+        if isinstance(node, (ast.operator, ast.unaryop, ast.boolop, ast.cmpop)):
+            state['operators'][type(node).__name__] += 1
+        elif isinstance(node, ast.Name):
+            state['operands'][node.id] += 1
+        elif isinstance(node, ast.Constant):
+            state['operands'][repr(node.value)] += 1
+        elif isinstance(node, ast.Attribute):
+            state['operands'][node.attr] += 1
+        elif isinstance(node, (ast.stmt, ast.Call, ast.Subscript)):
+            state['operators'][type(node).__name__] += 1
+        if isinstance(node, self.decision_nodes):
+            state['decisions'] += 1
+            if isinstance(node, ast.comprehension):
+                state['decisions'] += len(node.ifs)
+        elif isinstance(node, ast.BoolOp):
+            state['decisions'] += len(node.values) - 1
+
+    def finalize(self, state, scope):
+        operators, operands = state['operators'], state['operands']
+        vocabulary = len(operators) + len(operands)
+        length = sum(operators.values()) + sum(operands.values())
+        volume = length * math.log2(vocabulary) if vocabulary > 1 else 0.0
+        complexity = 1 + state['decisions']
+        loc = len(state['lines'])
+        index = 171 - 0.23 * complexity
+        if volume > 0:
+            index -= 5.2 * math.log(volume)
+        if loc > 0:
+            index -= 16.2 * math.log(loc)
+        return {
+            'maintainability_index': round(max(0.0, min(100.0, index * 100 / 171)), 2),
+            'cyclomatic_complexity': complexity,
+            'halstead_volume': round(volume, 2),
+            'loc': loc,
+        }
+
+class EnergyMetric(MetricPlugin):
+    """
+    Estimates energy use and carbon footprint by weighting operations by their relative cost.
+
+    Each operation inside a loop is assumed to run `loop_scale` times per enclosing loop.
+    """
+    name = "energy"
+    node_types = LOOP_NODES + (ast.BinOp, ast.AugAssign, ast.UnaryOp, ast.Compare, ast.Call, ast.Subscript,
+                               ast.List, ast.Dict, ast.Set, ast.ListComp, ast.SetComp, ast.DictComp)
+    # Estimated joules per execution of each kind of operation
+    weights = {
+        'arithmetic': 1e-9,
+        'comparison': 1e-9,
+        'indexing': 2e-9,
+        'loop_overhead': 5e-9,
+        'function_call': 2e-8,
+        'memory_allocation': 5e-8,
+        'io': 1e-5,
+    }
+    loop_scale = 10
+    carbon_intensity = 0.475  # kgCO2 per kWh, global average
+
+    def new_state(self):
+        return Counter()
+
+    def visit(self, node, state, depth, engine):
+        if isinstance(node, LOOP_NODES):
+            category = 'loop_overhead'
+            depth += 1
+        elif isinstance(node, (ast.BinOp, ast.AugAssign, ast.UnaryOp)):
+            category = 'arithmetic'
+        elif isinstance(node, ast.Compare):
+            category = 'comparison'
+        elif isinstance(node, ast.Subscript):
+            category = 'indexing'
+        elif isinstance(node, ast.Call):
+            category = 'io' if call_name(node) in IO_CALLS else 'function_call'
+        else:
+            category = 'memory_allocation'
+        state[category] += self.weights[category] * self.loop_scale ** depth
+
+    def finalize(self, state, scope):
+        joules = sum(state.values())
+        energy_kwh = joules / 3.6e6
+        operations = joules / self.weights['arithmetic']
+        return {
+            'energy_consumption': energy_kwh,
+            'carbon_footprint': energy_kwh * self.carbon_intensity,
+            'sustainability_score': round(max(0.0, 100 - 12 * math.log10(1 + operations)), 2),
+            'energy_by_operation': {category: value / 3.6e6 for category, value in state.items()},
+        }
+
+class TestCoverageMetric(MetricPlugin):
+    """Estimates test coverage as the share of defined functions that are called from a test function."""
+    name = "test_coverage"
+    node_types = FUNCTION_NODES + (ast.Call,)
+
+    def new_state(self):
+        return {'defined': set(), 'tested': set(), 'tests': 0}
+
+    def visit(self, node, state, depth, engine):
+        if isinstance(node, ast.Call):
+            if engine.in_test_function():
+                state['tested'].add(call_name(node))
+        elif node.name.startswith('test'):
+            state['tests'] += 1
+        else:
+            state['defined'].add(node.name)
+
+    def finalize(self, state, scope):
+        defined = state['defined']
+        coverage = 100.0 * len(defined & state['tested']) / len(defined) if defined else 0.0
+        return {'test_coverage': round(coverage, 2), 'test_functions': state['tests']}
+
+_registered_plugins: List[MetricPlugin] = [
+    TimeComplexityMetric(),
+    SpaceComplexityMetric(),
+    CodeQualityMetric(),
+    ScalabilityMetric(),
+    MaintainabilityMetric(),
+    EnergyMetric(),
+    TestCoverageMetric(),
+]
+
+def register_plugin(plugin: MetricPlugin) -> None:
+    """
+    Add a metric to the set computed by default, replacing any plugin with the same name.
+
+    Args:
+        plugin (MetricPlugin): The metric plugin to register.
+    """
+    _registered_plugins[:] = [p for p in _registered_plugins if p.name != plugin.name]
+    _registered_plugins.append(plugin)
+
+def registered_plugins() -> List[MetricPlugin]:
+    """
+    Get the metric plugins computed by default.
+
+    Returns:
+        List[MetricPlugin]: The registered plugins, in registration order.
+    """
+    return list(_registered_plugins)
+
+class Scope:
+    """A module or function being measured, with one state per plugin."""
+    __slots__ = ('name', 'node', 'base_depth', 'states')
+
+    def __init__(self, name: str, node: ast.AST, base_depth: int, plugins: List[MetricPlugin]):
+        self.name = name
+        self.node = node
+        self.base_depth = base_depth
+        self.states = [plugin.new_state() for plugin in plugins]
+
+class AnalysisEngine:
+    """
+    Walks an AST once and feeds every node to the metric plugins interested in it.
+
+    Each node counts towards the module and every function that encloses it, so per-function
+    and per-module results come out of the same traversal.
+    """
+
+    def __init__(self, plugins: Optional[Iterable[MetricPlugin]] = None):
+        self.plugins = list(plugins) if plugins is not None else registered_plugins()
+        self._dispatch = {}
+        self._depth = 0
+        self._scopes: List[Scope] = []
+        self._names: List[str] = []
+        self._enclosing: List[str] = []
+        self._known: Dict[ast.AST, Dict[str, Any]] = {}
+
+    def _plugins_for(self, node_type: type) -> List[tuple]:
+        # Resolve once per node class which plugins want it, so the hot loop is a dict lookup
+        handlers = self._dispatch.get(node_type)
+        if handlers is None:
+            handlers = [(index, plugin) for index, plugin in enumerate(self.plugins)
+                        if issubclass(node_type, plugin.node_types)]
+            self._dispatch[node_type] = handlers
+        return handlers
+
+    def in_test_function(self) -> bool:
+        """
+        Check whether the node being visited is inside a test function.
+
+        Returns:
+            bool: True if any enclosing function's name starts with 'test'.
+        """
+        return any(name.startswith('test') for name in self._enclosing)
+
+    def analyze(self, tree: ast.AST, known: Optional[Dict[ast.AST, Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Compute every plugin's metrics for a parsed module in one traversal.
+
+        Args:
+            tree (ast.AST): The parsed module.
+            known (Dict[ast.AST, Dict[str, Any]], optional): Results of functions measured before,
+                keyed by their node. They are reported as given instead of measured again; their
+                nodes still count towards the module and the functions enclosing them.
+
+        Returns:
+            Dict[str, Any]: {'module': {...}, 'functions': {qualified_name: {...}}}.
+        """
+        self._depth = 0
+        self._names = []
+        self._enclosing = []
+        self._known = known or {}
+        module = Scope('<module>', tree, 0, self.plugins)
+        self._scopes = [module]
+        self._functions = {}
+        for child in ast.iter_child_nodes(tree):
+            self._visit(child)
+        return {'module': self._finalize(module), 'functions': self._functions}
+
+    def _feed(self, node: ast.AST) -> None:
+        handlers = self._plugins_for(type(node))
+        if not handlers:
+            return
+        for scope in self._scopes:
+            depth = self._depth - scope.base_depth
+            for index, plugin in handlers:
+                plugin.visit(node, scope.states[index], depth, self)
+
+    def _visit(self, node: ast.AST) -> None:
+        if isinstance(node, FUNCTION_NODES):
+            self._names.append(node.name)
+            self._enclosing.append(node.name)
+            name = '.'.join(self._names)
+            known = self._known.get(node)
+            if known is None:
+                scope = Scope(name, node, self._depth, self.plugins)
+                self._scopes.append(scope)
+            self._feed(node)
+            for child in ast.iter_child_nodes(node):
+                self._visit(child)
+            if known is None:
+                self._scopes.pop()
+                result = self._finalize(scope)
+            else:
+                result = dict(known)
+            self._enclosing.pop()
+            self._names.pop()
+            result['lineno'], result['end_lineno'] = node.lineno, node.end_lineno
+            self._functions[name] = result
+            return
+
+        self._feed(node)
+        if isinstance(node, ast.ClassDef):
+            self._names.append(node.name)
+            for child in ast.iter_child_nodes(node):
+                self._visit(child)
+            self._names.pop()
+        elif isinstance(node, (ast.For, ast.AsyncFor, ast.While)):
+            # The header runs once per outer iteration, the body once per inner iteration
+            for child in ((node.target, node.iter) if isinstance(node, (ast.For, ast.AsyncFor)) else (node.test,)):
+                self._visit(child)
+            self._depth += 1
+            for child in node.body:
+                self._visit(child)
+            self._depth -= 1
+            for child in node.orelse:
+                self._visit(child)
+        elif isinstance(node, COMPREHENSION_NODES):
+            entered = 0
+            for generator in node.generators:
+                self._visit(generator.iter)
+                self._feed(generator)
+                self._depth += 1
+                entered += 1
+                self._visit(generator.target)
+                for condition in generator.ifs:
+                    self._visit(condition)
+            if isinstance(node, ast.DictComp):
+                self._visit(node.key)
+                self._visit(node.value)
+            else:
+                self._visit(node.elt)
+            self._depth -= entered
+        else:
+            for child in ast.iter_child_nodes(node):
+                self._visit(child)
+
+    def _finalize(self, scope: Scope) -> Dict[str, Any]:
+        result = {}
+        for plugin, state in zip(self.plugins, scope.states):
+            result.update(plugin.finalize(state, scope))
+        return result
+
+def analyze_tree(tree: ast.AST, plugins: Optional[Iterable[MetricPlugin]] = None,
+                 known: Optional[Dict[ast.AST, Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """
+    Compute all metrics for a parsed module in a single traversal.
+
+    Args:
+        tree (ast.AST): The parsed module.
+        plugins (Iterable[MetricPlugin], optional): Metrics to compute. Defaults to the registered plugins.
+        known (Dict[ast.AST, Dict[str, Any]], optional): Results of functions measured before,
+            keyed by their node (see AnalysisEngine.analyze).
+
+    Returns:
+        Dict[str, Any]: {'module': {...}, 'functions': {qualified_name: {...}}}.
+    """
+    return AnalysisEngine(plugins).analyze(tree, known)
+
+def analyze_source(code: str, plugins: Optional[Iterable[MetricPlugin]] = None) -> Dict[str, Any]:
+    """
+    Parse Python source and compute all metrics in a single traversal.
+
+    Args:
+        code (str): The Python source code.
+        plugins (Iterable[MetricPlugin], optional): Metrics to compute. Defaults to the registered plugins.
+
+    Returns:
+        Dict[str, Any]: {'module': {...}, 'functions': {qualified_name: {...}}}.
+
+    Raises:
+        SyntaxError: If the code cannot be parsed.
+    """
+    return analyze_tree(ast.parse(code), plugins)
@@ -1,4 +1,5 @@
 import pandas as pd
+from emissions_store import EmissionsStore
 
 def save_emissions_data(data, filename='emissions_data.csv'):
     """
@@ -17,6 +18,24 @@ def save_emissions_data(data, filename='emissions_data.csv'):
     # Save the DataFrame to a CSV file
     df.to_csv(filename, index=False)
 
+def append_emissions_data(data, store_path='./emissions_store'):
+    """
+    Append emissions data to the columnar emissions store.
+
+    Unlike save_emissions_data, this only writes the new rows, so continuous tracking doesn't
+    rewrite the whole history on every call.
+
+    Args:
+        data (list of dict): The emissions data to append. Each dictionary has a 'timestamp',
+            'energy_consumed' and 'carbon_emitted', and optionally 'script', 'commit' and 'function'.
+        store_path (str): The directory of the emissions store. Defaults to './emissions_store'.
+
+    Returns:
+        int: The number of rows appended.
+    """
+    with EmissionsStore(store_path) as store:
+        return store.extend(data)
+
 # Example usage
 if __name__ == "__main__":
     # Sample emissions data
@@ -0,0 +1,276 @@
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from functools import partial
+from typing import Any, Dict, List, Optional
+from script_runner import DEFAULT_LIMITS, limit_resources
+
+METRICS = ('wall_time', 'cpu_time', 'peak_rss', 'energy_consumed')
+
+def emissions_tracker():
+    """Create a quiet CodeCarbon tracker, or return None if CodeCarbon isn't installed."""
+    try:
+        from codecarbon import EmissionsTracker
+    except ImportError:
+        return None
+    return EmissionsTracker(save_to_file=False, log_level='error')
+
+def run_once(script_path: str, timeout: Optional[float] = None, cwd: Optional[str] = None,
+             track_energy: bool = True, limits: Optional[Dict[str, Optional[int]]] = None) -> Dict[str, Any]:
+    """
+    Run a script once in a fresh interpreter and measure it.
+
+    Args:
+        script_path (str): Path to the script to run.
+        timeout (float, optional): Seconds before the run is killed.
+        cwd (str, optional): Working directory for the run. Defaults to the script's directory.
+        track_energy (bool): Whether to measure energy with CodeCarbon, if it is installed.
+        limits (Dict[str, Optional[int]], optional): CPU time, memory and file size limits for the
+            run (see script_runner.limit_resources). Defaults to DEFAULT_LIMITS.
+
+    Returns:
+        Dict[str, Any]: 'wall_time' and 'cpu_time' in seconds, 'peak_rss' in bytes, 'energy_consumed'
+        in kWh (or None), 'returncode' and 'timed_out'.
+    """
+    cwd = cwd or os.path.dirname(os.path.abspath(script_path))
+    tracker = emissions_tracker() if track_energy else None
+    if tracker is not None:
+        tracker.start()
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.abspath(script_path)], cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               preexec_fn=partial(limit_resources, DEFAULT_LIMITS if limits is None else limits))
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer is not None:
+        timer.start()
+    try:
+        # wait4 gives us the child's own CPU time and peak memory, not the harness's
+        _, status, usage = os.wait4(process.pid, 0)
+    finally:
+        if timer is not None:
+            timer.cancel()
+    wall_time = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    energy = None
+    if tracker is not None:
+        tracker.stop()
+        if tracker.final_emissions_data is not None:
+            energy = tracker.final_emissions_data.energy_consumed
+
+    return {
+        'wall_time': wall_time,
+        'cpu_time': usage.ru_utime + usage.ru_stime,
+        'peak_rss': usage.ru_maxrss * 1024,  # ru_maxrss is in KiB on Linux
+        'energy_consumed': energy,
+        'returncode': process.returncode,
+        'timed_out': timed_out.is_set(),
+    }
+
+def measure(script_path: str, repeats: int = 10, warmup: int = 2, timeout: Optional[float] = None,
+            cwd: Optional[str] = None, track_energy: bool = True,
+            limits: Optional[Dict[str, Optional[int]]] = None) -> Dict[str, Any]:
+    """
+    Run a script repeatedly, discarding warmup runs, and collect the measurements.
+
+    Args:
+        script_path (str): Path to the script to run.
+        repeats (int): Number of measured runs.
+        warmup (int): Number of unmeasured runs first (to warm file and bytecode caches).
+        timeout (float, optional): Seconds before a run is killed.
+        cwd (str, optional): Working directory for the runs.
+        track_energy (bool): Whether to measure energy.
+        limits (Dict[str, Optional[int]], optional): Resource limits for each run (see run_once).
+
+    Returns:
+        Dict[str, Any]: 'samples' (a list per metric from successful runs) and 'failures'.
+    """
+    for _ in range(warmup):
+        run_once(script_path, timeout, cwd, track_energy=False, limits=limits)
+    samples = {metric: [] for metric in METRICS}
+    failures = 0
+    for _ in range(repeats):
+        if not _record(run_once(script_path, timeout, cwd, track_energy, limits), samples):
+            failures += 1
+    return {'samples': samples, 'failures': failures}
+
+def _record(run: Dict[str, Any], samples: Dict[str, List[float]]) -> bool:
+    # Failed runs are counted but not measured; their timings would skew the comparison
+    if run['returncode'] != 0 or run['timed_out']:
+        return False
+    for metric in METRICS:
+        if run[metric] is not None:
+            samples[metric].append(run[metric])
+    return True
+
+def summarize(values: List[float], confidence: float = 0.95, resamples: int = 2000, seed: int = 0) -> Dict[str, Any]:
+    """
+    Summarize measurements by their median with a bootstrap confidence interval.
+
+    Args:
+        values (List[float]): The measurements.
+        confidence (float): Confidence level of the interval.
+        resamples (int): Number of bootstrap resamples.
+        seed (int): Seed for the resampling, so reports are reproducible.
+
+    Returns:
+        Dict[str, Any]: 'n', 'median', 'ci_low', 'ci_high', 'min' and 'max' (None values when empty).
+    """
+    if not values:
+        return {'n': 0, 'median': None, 'ci_low': None, 'ci_high': None, 'min': None, 'max': None}
+    rng = random.Random(seed)
+    medians = sorted(statistics.median(rng.choices(values, k=len(values))) for _ in range(resamples))
+    tail = (1 - confidence) / 2
+    return {
+        'n': len(values),
+        'median': statistics.median(values),
+        'ci_low': medians[int(tail * (resamples - 1))],
+        'ci_high': medians[int((1 - tail) * (resamples - 1))],
+        'min': min(values),
+        'max': max(values),
+    }
+
+def mann_whitney_u(a: List[float], b: List[float]) -> Dict[str, float]:
+    """
+    Two-sided Mann-Whitney U test, using the normal approximation with a tie correction.
+
+    It makes no assumption about the shape of the distributions, which suits skewed timings.
+
+    Args:
+        a (List[float]): The first sample.
+        b (List[float]): The second sample.
+
+    Returns:
+        Dict[str, float]: The 'u' statistic and the two-sided 'p_value'.
+    """
+    n1, n2 = len(a), len(b)
+    if n1 == 0 or n2 == 0:
+        return {'u': float('nan'), 'p_value': 1.0}
+    combined = sorted([(value, 0) for value in a] + [(value, 1) for value in b])
+    ranks = [0.0] * len(combined)
+    tie_term = 0.0
+    i = 0
+    while i < len(combined):
+        j = i
+        while j + 1 < len(combined) and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        tied = j - i + 1
+        tie_term += tied ** 3 - tied
+        i = j + 1
+    rank_sum = sum(rank for rank, (_, group) in zip(ranks, combined) if group == 0)
+    u = rank_sum - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    variance = n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1)))
+    if variance <= 0:
+        return {'u': u, 'p_value': 1.0}
+    z = (abs(u - n1 * n2 / 2) - 0.5) / math.sqrt(variance)
+    return {'u': u, 'p_value': min(1.0, math.erfc(max(z, 0.0) / math.sqrt(2)))}
+
+def compare(before: Dict[str, List[float]], after: Dict[str, List[float]], alpha: float = 0.05,
+            confidence: float = 0.95) -> Dict[str, Any]:
+    """
+    Compare two sets of measurements metric by metric.
+
+    Args:
+        before (Dict[str, List[float]]): Samples per metric for the original code.
+        after (Dict[str, List[float]]): Samples per metric for the optimized code.
+        alpha (float): Significance level.
+        confidence (float): Confidence level of the reported intervals.
+
+    Returns:
+        Dict[str, Any]: Per metric, the two summaries, the relative change of the medians, the
+        p-value and whether the difference is significant.
+    """
+    comparison = {}
+    for metric in METRICS:
+        a, b = before.get(metric, []), after.get(metric, [])
+        summary_a, summary_b = summarize(a, confidence), summarize(b, confidence)
+        change = None
+        if summary_a['median'] and summary_b['median'] is not None:
+            change = (summary_b['median'] - summary_a['median']) / summary_a['median']
+        test = mann_whitney_u(a, b)
+        comparison[metric] = {
+            'before': summary_a,
+            'after': summary_b,
+            'relative_change': change,
+            'p_value': test['p_value'],
+            'significant': bool(a and b and test['p_value'] < alpha),
+        }
+    return comparison
+
+def benchmark_trees(original_dir: str, optimized_dir: str, script_name: str, repeats: int = 10, warmup: int = 2,
+                    timeout: Optional[float] = None, alpha: float = 0.05, confidence: float = 0.95,
+                    track_energy: bool = True, limits: Optional[Dict[str, Optional[int]]] = None) -> Dict[str, Any]:
+    """
+    Measure the same script in the original and optimized trees and test whether they differ.
+
+    Runs alternate between the two trees so that drift in machine load affects both equally.
+
+    Args:
+        original_dir (str): Directory with the original code.
+        optimized_dir (str): Directory with the optimized code.
+        script_name (str): Script to run, relative to each directory.
+        repeats (int): Measured runs per tree.
+        warmup (int): Unmeasured runs per tree first.
+        timeout (float, optional): Seconds before a run is killed.
+        alpha (float): Significance level.
+        confidence (float): Confidence level of the reported intervals.
+        track_energy (bool): Whether to measure energy.
+        limits (Dict[str, Optional[int]], optional): Resource limits for each run (see run_once).
+
+    Returns:
+        Dict[str, Any]: A JSON-serializable report with the settings, failure counts and comparison.
+    """
+    trees = {'original': original_dir, 'optimized': optimized_dir}
+    for name, directory in trees.items():
+        for _ in range(warmup):
+            run_once(os.path.join(directory, script_name), timeout, directory, track_energy=False, limits=limits)
+
+    samples = {name: {metric: [] for metric in METRICS} for name in trees}
+    failures = {name: 0 for name in trees}
+    for _ in range(repeats):
+        for name, directory in trees.items():
+            run = run_once(os.path.join(directory, script_name), timeout, directory, track_energy, limits)
+            if not _record(run, samples[name]):
+                failures[name] += 1
+
+    return {
+        'script': script_name,
+        'repeats': repeats,
+        'warmup': warmup,
+        'timeout': timeout,
+        'alpha': alpha,
+        'confidence': confidence,
+        'failures': failures,
+        'samples': samples,
+        'comparison': compare(samples['original'], samples['optimized'], alpha, confidence),
+    }
+
+def write_report(report: Dict[str, Any], path: str) -> None:
+    """
+    Save a benchmark report as JSON.
+
+    Args:
+        report (Dict[str, Any]): The report from benchmark_trees.
+        path (str): Where to write it.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
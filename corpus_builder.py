@@ -0,0 +1,384 @@
+import argparse
+import ast
+import hashlib
+import heapq
+import json
+import os
+import re
+import shutil
+import time
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from config_parser import load_config
+from parallel_optimization import AdaptiveExecutor
+
+FORMAT_VERSION = 1
+DEFAULT_EXTENSIONS = ('.py',)
+SKIPPED_DIRECTORIES = {'.git', '__pycache__', '.venv', 'venv', 'node_modules', '.tox', '.refactor_earth_cache'}
+INDEX_FILE = 'index.json'
+DOCUMENTS_FILE = 'documents.jsonl'
+# Identifiers, numbers and single punctuation characters; whitespace and layout are ignored
+TOKEN_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|\d+|\S')
+SHINGLE_MULTIPLIER = np.uint64(1_000_003)
+MINHASH_BLOCK = 4096
+
+def iter_source_files(directories: Iterable[str], extensions: Sequence[str] = DEFAULT_EXTENSIONS,
+                      max_file_bytes: Optional[int] = 1_000_000) -> Iterator[str]:
+    """
+    Walk directories, such as local repository checkouts, for source files.
+
+    Files are yielded in a stable order, so the same tree always gives the same corpus.
+
+    Args:
+        directories (Iterable[str]): Directories to search.
+        extensions (Sequence[str]): File extensions to include.
+        max_file_bytes (int, optional): Larger files (usually generated code or data) are skipped.
+
+    Yields:
+        str: Path of each source file.
+    """
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if d not in SKIPPED_DIRECTORIES and not d.startswith('.'))
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if name.endswith(tuple(extensions)) and (max_file_bytes is None or os.path.getsize(path) <= max_file_bytes):
+                    yield path
+
+def _permutations(num_perm: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    # Odd multipliers, so each hash function is a bijection before the shift
+    multipliers = rng.integers(1, 2 ** 63, num_perm, dtype=np.uint64) | np.uint64(1)
+    increments = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+    return multipliers, increments
+
+def minhash(text: str, num_perm: int = 128, shingle_size: int = 5, seed: int = 1) -> np.ndarray:
+    """
+    Compute the MinHash signature of a source file's token shingles.
+
+    The fraction of positions at which two signatures are equal estimates the Jaccard similarity
+    of the two files' sets of `shingle_size`-token sequences.
+
+    Args:
+        text (str): The source code.
+        num_perm (int): Number of hash functions, i.e. the signature length.
+        shingle_size (int): Tokens per shingle.
+        seed (int): Seed of the hash functions; signatures are only comparable with the same one.
+
+    Returns:
+        np.ndarray: The signature, as num_perm 32-bit values.
+    """
+    tokens = TOKEN_PATTERN.findall(text)
+    token_hashes = np.fromiter((zlib.crc32(token.encode()) for token in tokens), dtype=np.uint64, count=len(tokens))
+    count = max(1, len(tokens) - shingle_size + 1)
+    shingles = np.zeros(count, dtype=np.uint64)
+    for offset in range(min(shingle_size, len(tokens))):
+        # Overflow wraps around, which is what a hash wants
+        shingles = shingles * SHINGLE_MULTIPLIER + token_hashes[offset:offset + count]
+    shingles = np.unique(shingles)
+
+    multipliers, increments = _permutations(num_perm, seed)
+    signature = np.full(num_perm, np.iinfo(np.uint32).max, dtype=np.uint32)
+    for start in range(0, len(shingles), MINHASH_BLOCK):
+        block = shingles[start:start + MINHASH_BLOCK, None]
+        # Multiply-shift hashing: the high 32 bits of a * x + b
+        values = ((block * multipliers + increments) >> np.uint64(32)).astype(np.uint32)
+        signature = np.minimum(signature, values.min(axis=0))
+    return signature
+
+def lsh_parameters(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Choose how to split signatures into bands for locality-sensitive hashing.
+
+    Two files become candidates when all rows of any band are equal, which happens with a
+    probability that rises steeply around (1 / bands) ** (1 / rows). That point is put just below
+    the threshold, so near-duplicates are rarely missed; candidates are then checked against the
+    threshold itself.
+
+    Args:
+        threshold (float): Jaccard similarity from which files count as near-duplicates.
+        num_perm (int): Signature length.
+
+    Returns:
+        Tuple[int, int]: The number of bands and rows per band.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if (1 / bands) ** (1 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+def _scan(path: str) -> Tuple[int, str]:
+    with open(path, 'rb') as f:
+        content = f.read()
+    return len(content), hashlib.sha1(content).hexdigest()
+
+def _analyze(task: Tuple[str, int, int, int]) -> Tuple[str, Optional[np.ndarray]]:
+    path, num_perm, shingle_size, seed = task
+    with open(path, 'rb') as f:
+        content = f.read()
+    try:
+        text = content.decode('utf-8')
+    except UnicodeDecodeError:
+        return 'undecodable', None
+    if path.endswith('.py'):
+        try:
+            ast.parse(text)
+        except (SyntaxError, ValueError, RecursionError, MemoryError):
+            return 'unparseable', None
+    return 'ok', minhash(text, num_perm, shingle_size, seed)
+
+class CodeCorpus:
+    """
+    A corpus written by `build_corpus`: source files in shards that are read through memory maps.
+
+    Each shard is a file of concatenated UTF-8 documents with an array of their offsets; the
+    index lists the shards, and `documents.jsonl` each document's origin.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): The corpus directory.
+        """
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        if self.index.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a corpus of format version {FORMAT_VERSION}")
+        self.id = self.index['id']
+        self.shards = self.index['shards']
+        self._offsets = [np.load(os.path.join(path, shard['offsets'])) for shard in self.shards]
+        self._data: Dict[int, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return sum(shard['documents'] for shard in self.shards)
+
+    def _shard(self, shard: int) -> np.ndarray:
+        if shard not in self._data:
+            if self._offsets[shard][-1]:
+                self._data[shard] = np.memmap(os.path.join(self.path, self.shards[shard]['data']), dtype=np.uint8, mode='r')
+            else:  # np.memmap cannot map an empty file
+                self._data[shard] = np.zeros(0, dtype=np.uint8)
+        return self._data[shard]
+
+    def text(self, shard: int, index: int) -> str:
+        """
+        Get one document.
+
+        Args:
+            shard (int): The shard number.
+            index (int): The document's position in the shard.
+
+        Returns:
+            str: The source code.
+        """
+        offsets = self._offsets[shard]
+        return self._shard(shard)[offsets[index]:offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        for shard in range(len(self.shards)):
+            for index in range(len(self._offsets[shard]) - 1):
+                yield self.text(shard, index)
+
+    def documents(self) -> Iterator[Dict[str, Any]]:
+        """Yield each document's shard, position, source path, SHA-1 and size, in shard order."""
+        with open(os.path.join(self.path, DOCUMENTS_FILE)) as f:
+            for line in f:
+                yield json.loads(line)
+
+def _assign_shards(sizes: Sequence[int], shard_bytes: int, rng: np.random.Generator) -> List[List[int]]:
+    count = max(1, -(-sum(sizes) // shard_bytes))
+    # In random order, each document goes to the shard with the fewest bytes so far
+    heap = [(0, shard) for shard in range(count)]
+    shards: List[List[int]] = [[] for _ in range(count)]
+    for document in rng.permutation(len(sizes)):
+        size, shard = heapq.heappop(heap)
+        shards[shard].append(int(document))
+        heapq.heappush(heap, (size + sizes[document], shard))
+    return [shard for shard in shards if shard] or [[]]
+
+def build_corpus(directories: Sequence[str], output_directory: str, extensions: Sequence[str] = DEFAULT_EXTENSIONS,
+                 min_bytes: int = 64, max_bytes: int = 1_000_000, threshold: float = 0.85, num_perm: int = 128,
+                 shingle_size: int = 5, shard_bytes: int = 64 * 1024 * 1024, seed: int = 0,
+                 max_workers: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Build a deduplicated, sharded training corpus from local checkouts.
+
+    Files are filtered by size, then hashed in parallel threads; exact duplicates are dropped
+    before the expensive steps. The remaining files are checked to decode as UTF-8 and (Python
+    files) to parse with `ast`, and get a MinHash signature, in parallel processes. Walking the
+    files in the order given, a file is dropped as a near-duplicate when its estimated Jaccard
+    similarity to a file already kept reaches `threshold`; candidates are found with
+    locality-sensitive hashing instead of comparing all pairs. The kept files are shuffled into
+    shards of about `shard_bytes` each.
+
+    Args:
+        directories (Sequence[str]): Checkouts to collect source files from. When files are
+            duplicates, the one found first is kept, so list the canonical repositories first.
+        output_directory (str): Where to write the corpus; an existing corpus there is replaced.
+        extensions (Sequence[str]): File extensions to include.
+        min_bytes (int): Smaller files are skipped.
+        max_bytes (int): Larger files are skipped.
+        threshold (float): Jaccard similarity from which files count as near-duplicates.
+        num_perm (int): MinHash signature length; longer is more precise and slower.
+        shingle_size (int): Tokens per shingle.
+        shard_bytes (int): Target size of each shard.
+        seed (int): Seed of the shuffling and of the hash functions.
+        max_workers (int, optional): Threads and processes to use. Defaults to the CPU count.
+
+    Returns:
+        Dict[str, Any]: Counts of files and bytes seen, filtered, duplicated and kept, and the
+        build time in 'seconds'.
+
+    Raises:
+        FileExistsError: If `output_directory` exists and is not a corpus.
+    """
+    if os.path.exists(output_directory) and os.listdir(output_directory) \
+            and not os.path.exists(os.path.join(output_directory, INDEX_FILE)):
+        raise FileExistsError(f"{output_directory} exists and is not a corpus")
+    start = time.perf_counter()
+    stats = {key: 0 for key in ('files', 'bytes', 'too_small', 'too_large', 'exact_duplicates', 'undecodable',
+                                'unparseable', 'near_duplicates', 'duplicate_bytes', 'kept', 'kept_bytes')}
+
+    paths = []
+    for path in iter_source_files(directories, extensions, max_file_bytes=None):
+        size = os.path.getsize(path)
+        stats['files'] += 1
+        stats['bytes'] += size
+        if size < min_bytes:
+            stats['too_small'] += 1
+        elif size > max_bytes:
+            stats['too_large'] += 1
+        else:
+            paths.append(path)
+
+    # Reading and hashing is mostly I/O
+    with AdaptiveExecutor('thread', max_workers=max_workers, chunk_size=16) as executor:
+        scanned = list(executor.map(_scan, paths))
+    unique, sizes, digests, seen = [], [], [], set()
+    for path, (size, digest) in zip(paths, scanned):
+        if digest in seen:
+            stats['exact_duplicates'] += 1
+            stats['duplicate_bytes'] += size
+            continue
+        seen.add(digest)
+        unique.append(path)
+        sizes.append(size)
+        digests.append(digest)
+
+    # Parsing and MinHash are CPU-bound
+    with AdaptiveExecutor('process', max_workers=max_workers, chunk_size=16) as executor:
+        analyses = list(executor.map(_analyze, ((path, num_perm, shingle_size, seed) for path in unique)))
+
+    bands, rows = lsh_parameters(threshold, num_perm)
+    buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+    kept: List[int] = []
+    signatures: Dict[int, np.ndarray] = {}
+    for document, (status, signature) in enumerate(analyses):
+        if status != 'ok':
+            stats[status] += 1
+            continue
+        keys = [signature[band * rows:(band + 1) * rows].tobytes() for band in range(bands)]
+        candidates = {other for band, key in enumerate(keys) for other in buckets[band].get(key, ())}
+        if any(np.mean(signatures[other] == signature) >= threshold for other in candidates):
+            stats['near_duplicates'] += 1
+            stats['duplicate_bytes'] += sizes[document]
+            continue
+        for band, key in enumerate(keys):
+            buckets[band].setdefault(key, []).append(document)
+        signatures[document] = signature
+        kept.append(document)
+
+    # Written next to the final location and swapped in, so readers never see a half-written corpus
+    partial = output_directory.rstrip('/') + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    shards = []
+    corpus_digest = hashlib.sha1()
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(partial, DOCUMENTS_FILE), 'w') as documents_file:
+        for number, members in enumerate(_assign_shards([sizes[document] for document in kept], shard_bytes, rng)):
+            name = f"shard-{number:05d}"
+            offsets = [0]
+            with open(os.path.join(partial, name + '.bin'), 'wb') as out:
+                for position, member in enumerate(members):
+                    document = kept[member]
+                    with open(unique[document], 'rb') as f:
+                        content = f.read()
+                    out.write(content)
+                    offsets.append(offsets[-1] + len(content))
+                    corpus_digest.update(digests[document].encode())
+                    documents_file.write(json.dumps({'shard': number, 'index': position, 'path': unique[document],
+                                                     'sha1': digests[document], 'bytes': len(content)}) + '\n')
+            np.save(os.path.join(partial, name + '.offsets.npy'), np.asarray(offsets, dtype=np.int64))
+            shards.append({'data': name + '.bin', 'offsets': name + '.offsets.npy',
+                           'documents': len(members), 'bytes': offsets[-1]})
+            stats['kept'] += len(members)
+            stats['kept_bytes'] += offsets[-1]
+
+    stats['seconds'] = time.perf_counter() - start
+    index = {
+        'format_version': FORMAT_VERSION,
+        'id': corpus_digest.hexdigest(),  # Identifies the documents and their order
+        'built_at': time.time(),
+        'sources': [os.path.abspath(directory) for directory in directories],
+        'settings': {'extensions': list(extensions), 'min_bytes': min_bytes, 'max_bytes': max_bytes,
+                     'threshold': threshold, 'num_perm': num_perm, 'shingle_size': shingle_size, 'seed': seed},
+        'shards': shards,
+        'stats': stats,
+    }
+    with open(os.path.join(partial, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=2)
+    shutil.rmtree(output_directory, ignore_errors=True)
+    os.rename(partial, output_directory)
+    return stats
+
+def corpus_settings(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Read the build_corpus arguments from the 'corpus' section of config.yaml.
+
+    Args:
+        config (Dict[str, Any]): The loaded configuration.
+
+    Returns:
+        Dict[str, Any]: Keyword arguments for build_corpus.
+    """
+    settings = config.get('corpus', {})
+    return {
+        'directories': settings.get('sources') or [config['repository']['local_directory']],
+        'output_directory': settings.get('output_directory', './corpus'),
+        'extensions': settings.get('extensions', DEFAULT_EXTENSIONS),
+        'min_bytes': settings.get('min_bytes', 64),
+        'max_bytes': settings.get('max_bytes', 1_000_000),
+        'threshold': settings.get('near_duplicate_threshold', 0.85),
+        'num_perm': settings.get('num_perm', 128),
+        'shard_bytes': int(settings.get('shard_mb', 64) * 1024 * 1024),
+        'seed': settings.get('seed', 0),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a deduplicated, sharded code corpus from local checkouts.")
+    parser.add_argument('directories', nargs='*', help="Checkouts to collect source files from")
+    parser.add_argument('--output', help="Corpus directory")
+    parser.add_argument('--threshold', type=float, help="Jaccard similarity of near-duplicates")
+    parser.add_argument('--workers', type=int, help="Threads and processes to use")
+    args = parser.parse_args()
+
+    settings = corpus_settings(load_config('config.yaml'))
+    if args.directories:
+        settings['directories'] = args.directories
+    if args.output:
+        settings['output_directory'] = args.output
+    if args.threshold is not None:
+        settings['threshold'] = args.threshold
+    stats = build_corpus(**settings, max_workers=args.workers)
+
+    print(f"Scanned {stats['files']} files ({stats['bytes'] / 1e6:.1f} MB) in {stats['seconds']:.2f} seconds")
+    print(f"Skipped {stats['too_small']} too small, {stats['too_large']} too large, "
+          f"{stats['undecodable']} undecodable, {stats['unparseable']} unparseable")
+    print(f"Dropped {stats['exact_duplicates']} exact and {stats['near_duplicates']} near duplicates "
+          f"({stats['duplicate_bytes'] / max(stats['bytes'], 1):.1%} of the bytes)")
+    print(f"Kept {stats['kept']} files ({stats['kept_bytes'] / 1e6:.1f} MB) in {settings['output_directory']}")
@@ -0,0 +1,310 @@
+import argparse
+import io
+import logging
+import multiprocessing
+import os
+import resource
+import statistics
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import torch
+
+logger = logging.getLogger(__name__)
+
+# fp32: the model as trained. int8: Linear layers quantized to 8-bit integers, with activations
+# quantized on the fly. compiled: the forward pass compiled into an optimized graph by torch.compile.
+MODES = ('fp32', 'int8', 'compiled')
+# Short code prompts the optimized model must continue like the fp32 one
+CHECK_PROMPTS = (
+    "def fibonacci(n):\n",
+    "for i in range(len(items)):\n    total",
+    "import numpy as np\n\ndef normalize(values):\n",
+    "class Cache:\n    def __init__(self, size):\n",
+)
+
+def configure_threads(workers: int = 1, intra_op_threads: Optional[int] = None,
+                      inter_op_threads: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Size PyTorch's thread pools, so several processes serving the model on one host don't oversubscribe its cores.
+
+    This process only takes its share of the CPUs; it does not start the other processes.
+
+    Args:
+        workers (int): Processes on the host that each load the model and call this; each gets
+            an equal share of the CPUs.
+        intra_op_threads (int, optional): Threads within one operation. Defaults to the CPU share.
+        inter_op_threads (int, optional): Operations run in parallel. Defaults to 1, since
+            generation runs one operation after the other.
+
+    Returns:
+        Tuple[int, int]: The intra-op and inter-op thread counts in effect.
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    torch.set_num_threads(intra_op_threads or max(1, cpus // max(1, workers)))
+    try:
+        torch.set_num_interop_threads(inter_op_threads or 1)
+    except RuntimeError:
+        # Only possible before the first parallel operation of the process
+        logger.debug("Inter-op threads already fixed at %d", torch.get_num_interop_threads())
+    return torch.get_num_threads(), torch.get_num_interop_threads()
+
+def quantize_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Apply dynamic int8 quantization to a model's Linear layers.
+
+    Weights are stored as 8-bit integers and activations are quantized as they come, so there is
+    no calibration data to collect. Other layers stay in fp32.
+
+    Args:
+        model (torch.nn.Module): The model, in eval mode.
+
+    Returns:
+        torch.nn.Module: The quantized model; the original is left unchanged.
+    """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            break
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def compile_model(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Compile a model's forward pass into an optimized graph.
+
+    Generation calls the forward pass with a growing sequence, so the graph is compiled for
+    dynamic shapes instead of once per length. Compilation happens on the first call.
+
+    Args:
+        model (torch.nn.Module): The model, in eval mode.
+
+    Returns:
+        torch.nn.Module: The same model, with a compiled forward pass.
+    """
+    model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+def optimize_model(model: torch.nn.Module, mode: str) -> torch.nn.Module:
+    """
+    Prepare a model for CPU inference in the given mode.
+
+    Args:
+        model (torch.nn.Module): The fp32 model, in eval mode.
+        mode (str): One of MODES.
+
+    Returns:
+        torch.nn.Module: The optimized model.
+    """
+    if mode == 'fp32':
+        return model
+    if mode == 'int8':
+        return quantize_int8(model)
+    if mode == 'compiled':
+        return compile_model(model)
+    raise ValueError(f"Unknown inference mode {mode!r}; expected one of {', '.join(MODES)}")
+
+def greedy_outputs(model: torch.nn.Module, tokenizer: Any, prompts: Sequence[str],
+                   max_new_tokens: int = 16) -> List[List[int]]:
+    """
+    Generate greedily from each prompt, one at a time.
+
+    Args:
+        model (torch.nn.Module): A causal language model.
+        tokenizer: Its tokenizer.
+        prompts (Sequence[str]): The prompts.
+        max_new_tokens (int): Tokens to generate per prompt.
+
+    Returns:
+        List[List[int]]: The generated token ids of each prompt.
+    """
+    outputs = []
+    with torch.inference_mode():
+        for prompt in prompts:
+            encoded = tokenizer(prompt, return_tensors='pt')
+            output = model.generate(**encoded, max_new_tokens=max_new_tokens, do_sample=False,
+                                    pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None
+                                    else tokenizer.eos_token_id)
+            outputs.append(output[0, encoded['input_ids'].shape[1]:].tolist())
+    return outputs
+
+def agreement(reference: Sequence[Sequence[int]], candidate: Sequence[Sequence[int]]) -> float:
+    """
+    Measure how closely generated token sequences match reference ones.
+
+    Args:
+        reference (Sequence[Sequence[int]]): Tokens generated by the fp32 model.
+        candidate (Sequence[Sequence[int]]): Tokens generated by the optimized model, from the same prompts.
+
+    Returns:
+        float: The fraction of reference tokens matched, counting each sequence up to its first
+        difference, since greedy decoding diverges completely after one.
+    """
+    matched = total = 0
+    for expected, actual in zip(reference, candidate):
+        total += len(expected)
+        for a, b in zip(expected, actual):
+            if a != b:
+                break
+            matched += 1
+    return matched / total if total else 1.0
+
+def prepare_model(model: torch.nn.Module, tokenizer: Any, mode: str = 'fp32', min_agreement: Optional[float] = 0.9,
+                  prompts: Sequence[str] = CHECK_PROMPTS, max_new_tokens: int = 16) -> Tuple[torch.nn.Module, str]:
+    """
+    Optimize a model for CPU inference, keeping fp32 if the optimized one disagrees with it.
+
+    Args:
+        model (torch.nn.Module): The fp32 model.
+        tokenizer: Its tokenizer.
+        mode (str): One of MODES.
+        min_agreement (float, optional): Lowest acceptable `agreement` of the optimized model's
+            greedy generations with the fp32 model's. None skips the check.
+        prompts (Sequence[str]): Prompts of the check.
+        max_new_tokens (int): Tokens generated per prompt in the check.
+
+    Returns:
+        Tuple[torch.nn.Module, str]: The model to serve and the mode it is in.
+    """
+    model.eval()
+    if mode == 'fp32':
+        return model, mode
+    reference = greedy_outputs(model, tokenizer, prompts, max_new_tokens) if min_agreement is not None else None
+    optimized = optimize_model(model, mode)
+    if reference is not None:
+        score = agreement(reference, greedy_outputs(optimized, tokenizer, prompts, max_new_tokens))
+        if score < min_agreement:
+            logger.warning("%s model agrees with fp32 on %.1f%% of tokens (minimum %.1f%%); serving fp32",
+                           mode, 100 * score, 100 * min_agreement)
+            if mode == 'compiled':
+                del model.forward  # Back to the class's eager forward
+            return model, 'fp32'
+        logger.info("%s model agrees with fp32 on %.1f%% of tokens", mode, 100 * score)
+    return optimized, mode
+
+def load_model(model_name: str, settings: Optional[Dict[str, Any]] = None) -> Tuple[torch.nn.Module, Any, str]:
+    """
+    Load a causal language model and its tokenizer for CPU inference as the 'inference' section of config.yaml describes.
+
+    Args:
+        model_name (str): Name or path of the model.
+        settings (Dict[str, Any], optional): The 'inference' settings: mode, workers,
+            intra_op_threads, inter_op_threads and min_agreement (null to skip the check).
+
+    Returns:
+        Tuple[torch.nn.Module, Any, str]: The model, in eval mode, its tokenizer, and the mode it is
+        served in: the configured one, or 'fp32' if the optimized model failed the agreement check.
+    """
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    settings = settings or {}
+    configure_threads(settings.get('workers', 1), settings.get('intra_op_threads'), settings.get('inter_op_threads'))
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForCausalLM.from_pretrained(model_name)
+    model, mode = prepare_model(model, tokenizer, settings.get('mode', 'fp32'), settings.get('min_agreement', 0.9))
+    logger.info("Serving %s in %s mode with %d intra-op and %d inter-op threads",
+                model_name, mode, torch.get_num_threads(), torch.get_num_interop_threads())
+    return model, tokenizer, mode
+
+def model_size_mb(model: torch.nn.Module) -> float:
+    """Size of a model's weights as saved, in MB; quantized layers count their packed int8 weights."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+def _rss_mb() -> float:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+def _benchmark_worker(model_name: str, mode: str, prompts: Sequence[str], max_new_tokens: int, repeats: int,
+                      threads: Optional[int], conn) -> None:
+    try:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        configure_threads(intra_op_threads=threads)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = optimize_model(AutoModelForCausalLM.from_pretrained(model_name).eval(), mode)
+        start = time.perf_counter()
+        outputs = greedy_outputs(model, tokenizer, prompts[:1], max_new_tokens)  # Warm up, and compile
+        warmup = time.perf_counter() - start
+
+        latencies = []
+        for _ in range(repeats):
+            for prompt in prompts:
+                start = time.perf_counter()
+                greedy_outputs(model, tokenizer, [prompt], max_new_tokens)
+                latencies.append(time.perf_counter() - start)
+        outputs = greedy_outputs(model, tokenizer, prompts, max_new_tokens)
+        generated = sum(len(output) for output in outputs) * repeats
+        conn.send({
+            'warmup_seconds': warmup,
+            'latency_p50_ms': 1000 * statistics.median(latencies),
+            'latency_p95_ms': 1000 * sorted(latencies)[int(0.95 * (len(latencies) - 1))],
+            'tokens_per_second': generated / sum(latencies),
+            'model_mb': model_size_mb(model),
+            'rss_mb': _rss_mb(),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'outputs': outputs,
+        })
+    except Exception as e:
+        conn.send({'error': f"{type(e).__name__}: {e}"})
+    finally:
+        conn.close()
+
+def benchmark(model_name: str, modes: Sequence[str] = MODES, prompts: Sequence[str] = CHECK_PROMPTS,
+              max_new_tokens: int = 32, repeats: int = 3, threads: Optional[int] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Compare latency, throughput, memory and agreement with fp32 of the inference modes.
+
+    Each mode runs in a fresh process, so memory use and thread settings don't carry over.
+
+    Args:
+        model_name (str): Name or path of a causal language model; a small local one is enough.
+        modes (Sequence[str]): Modes to compare.
+        prompts (Sequence[str]): Prompts to generate from.
+        max_new_tokens (int): Tokens generated per prompt.
+        repeats (int): Measured passes over the prompts.
+        threads (int, optional): Intra-op threads. Defaults to all CPUs.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: Per mode: warm-up time, p50/p95 latency per prompt, tokens per
+        second, size of the weights, current and peak RSS, and 'agreement' with fp32 (or 'error').
+    """
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for mode in dict.fromkeys(('fp32',) + tuple(modes)):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_benchmark_worker,
+                                  args=(model_name, mode, list(prompts), max_new_tokens, repeats, threads, sender))
+        process.start()
+        sender.close()
+        try:
+            results[mode] = receiver.recv()
+        except EOFError:
+            results[mode] = {'error': f"worker exited with code {process.exitcode}"}
+        process.join()
+
+    reference = results['fp32'].get('outputs')
+    for result in results.values():
+        outputs = result.pop('outputs', None)
+        if reference is not None and outputs is not None:
+            result['agreement'] = agreement(reference, outputs)
+    return {mode: results[mode] for mode in modes}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CPU inference modes of a causal language model.")
+    parser.add_argument('model', help="Model name or path; a small local model is enough")
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES), help="Modes to compare")
+    parser.add_argument('--max-new-tokens', type=int, default=32, help="Tokens generated per prompt")
+    parser.add_argument('--repeats', type=int, default=3, help="Measured passes over the prompts")
+    parser.add_argument('--threads', type=int, help="Intra-op threads")
+    args = parser.parse_args()
+
+    for mode, result in benchmark(args.model, args.modes, max_new_tokens=args.max_new_tokens,
+                                  repeats=args.repeats, threads=args.threads).items():
+        if 'error' in result:
+            print(f"{mode:>9}: {result['error']}")
+            continue
+        print(f"{mode:>9}: p50 {result['latency_p50_ms']:.1f} ms, p95 {result['latency_p95_ms']:.1f} ms, "
+              f"{result['tokens_per_second']:.1f} tokens/sec, weights {result['model_mb']:.1f} MB, RSS {result['rss_mb']:.0f} MB "
+              f"(peak {result['peak_rss_mb']:.0f} MB), agreement {result.get('agreement', float('nan')):.1%}, "
+              f"warm-up {result['warmup_seconds']:.2f} s")
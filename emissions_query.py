@@ -0,0 +1,436 @@
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from emissions_store import TAG_COLUMNS, VALUE_COLUMNS, EmissionsStore
+
+MICROSECONDS = {'s': 1_000_000, 'm': 60_000_000, 'h': 3_600_000_000, 'd': 86_400_000_000, 'w': 604_800_000_000}
+# Group keys with fewer combinations than this are counted in a dense array instead of sorted
+DENSE_GROUP_LIMIT = 1 << 24
+AGGREGATIONS = ('count', 'sum', 'mean', 'min', 'max')
+
+def parse_duration(duration: Any) -> int:
+    """
+    Convert a duration to microseconds.
+
+    Args:
+        duration: Seconds as a number, or a string like '15m', '1h', '7d' or '2w'.
+
+    Returns:
+        int: The duration in microseconds.
+    """
+    if isinstance(duration, str):
+        return int(float(duration[:-1]) * MICROSECONDS[duration[-1]])
+    return int(float(duration) * 1_000_000)
+
+def time_buckets(timestamps: np.ndarray, width: Any) -> np.ndarray:
+    """
+    Round timestamps down to the start of their time bucket. Buckets are aligned to the epoch (UTC).
+
+    Args:
+        timestamps (np.ndarray): Microseconds since the epoch.
+        width: The bucket width; see parse_duration.
+
+    Returns:
+        np.ndarray: The bucket start of each timestamp.
+    """
+    step = parse_duration(width)
+    return timestamps - timestamps % step
+
+def group_index(keys: Sequence[np.ndarray]) -> Tuple[np.ndarray, List[np.ndarray]]:
+    """
+    Number the distinct combinations of several integer key columns.
+
+    Small key spaces are counted densely in O(n); larger ones fall back to sorting.
+
+    Args:
+        keys (Sequence[np.ndarray]): At least one integer array; all of equal length.
+
+    Returns:
+        Tuple[np.ndarray, List[np.ndarray]]: The group number of each row, and for each key
+        column its value in each group. Groups are ordered by their key values.
+    """
+    length = len(keys[0])
+    offsets = [int(key.min()) if len(key) else 0 for key in keys]
+    cardinalities = [int(key.max()) - offset + 1 if len(key) else 1 for key, offset in zip(keys, offsets)]
+    space = 1
+    for cardinality in cardinalities:
+        space *= cardinality
+    if space >= 1 << 62:
+        rows = np.stack([np.asarray(key, dtype=np.int64) for key in keys], axis=1)
+        unique, inverse = np.unique(rows, axis=0, return_inverse=True)
+        return inverse.reshape(-1), [unique[:, i] for i in range(len(keys))]
+
+    combined = np.zeros(length, dtype=np.int64)
+    for key, offset, cardinality in zip(keys, offsets, cardinalities):
+        combined *= cardinality
+        combined += np.asarray(key, dtype=np.int64) - offset
+    if space <= max(DENSE_GROUP_LIMIT, 4 * length):
+        present = np.bincount(combined, minlength=space) > 0
+        unique = np.flatnonzero(present)
+        rank = np.cumsum(present) - 1
+        inverse = rank[combined]
+    else:
+        unique, inverse = np.unique(combined, return_inverse=True)
+    values = np.unravel_index(unique, cardinalities)
+    return inverse, [value + offset for value, offset in zip(values, offsets)]
+
+def reduce_groups(inverse: np.ndarray, groups: int, values: np.ndarray, how: str) -> np.ndarray:
+    """
+    Aggregate values per group.
+
+    Args:
+        inverse (np.ndarray): The group number of each row, from group_index.
+        groups (int): The number of groups.
+        values (np.ndarray): The values to aggregate.
+        how (str): One of 'count', 'sum', 'mean', 'min', 'max', or a percentile like 'p95'.
+
+    Returns:
+        np.ndarray: One value per group.
+    """
+    if how == 'count':
+        return np.bincount(inverse, minlength=groups)
+    if how == 'sum':
+        return np.bincount(inverse, weights=values, minlength=groups)
+    if how == 'mean':
+        counts = np.bincount(inverse, minlength=groups)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.bincount(inverse, weights=values, minlength=groups) / counts
+    if how in ('min', 'max'):
+        result = np.full(groups, np.inf if how == 'min' else -np.inf)
+        (np.minimum if how == 'min' else np.maximum).at(result, inverse, values)
+        return result
+    if how.startswith('p'):
+        return group_percentile(inverse, groups, values, float(how[1:]) / 100)
+    raise ValueError(f"Unknown aggregation '{how}', expected one of {AGGREGATIONS} or a percentile like 'p95'")
+
+def group_percentile(inverse: np.ndarray, groups: int, values: np.ndarray, fraction: float) -> np.ndarray:
+    """
+    Compute a percentile per group, interpolating linearly like numpy.percentile.
+
+    Args:
+        inverse (np.ndarray): The group number of each row.
+        groups (int): The number of groups.
+        values (np.ndarray): The values.
+        fraction (float): The percentile as a fraction, e.g. 0.95.
+
+    Returns:
+        np.ndarray: One value per group (NaN for empty groups).
+    """
+    if groups == 1:
+        return np.array([np.quantile(values, fraction)]) if len(values) else np.array([np.nan])
+    # Sort by value, then stably by group; radix sort makes the second pass linear for up to 65536 groups
+    order = np.argsort(values)
+    group_of = inverse[order]
+    order = order[np.argsort(group_of.astype(np.uint16) if groups <= 1 << 16 else group_of, kind='stable')]
+    ordered = values[order]
+    counts = np.bincount(inverse, minlength=groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    position = (counts - 1).clip(min=0) * fraction
+    low = np.floor(position).astype(np.int64)
+    high = np.ceil(position).astype(np.int64)
+    result = np.full(groups, np.nan)
+    present = counts > 0
+    below = ordered[(starts + low)[present]]
+    above = ordered[(starts + high)[present]]
+    result[present] = below + (above - below) * (position - low)[present]
+    return result
+
+def aggregate(columns: Dict[str, np.ndarray], value: str = 'energy_consumed', by: Sequence[str] = (),
+              bucket: Any = None, how: str = 'sum') -> Dict[str, np.ndarray]:
+    """
+    Group records by tags and/or time buckets and aggregate a value column.
+
+    Args:
+        columns (Dict[str, np.ndarray]): Columns as returned by EmissionsStore.read.
+        value (str): The column to aggregate.
+        by (Sequence[str]): Tag columns to group by, e.g. ('script',).
+        bucket: Time-bucket width (see parse_duration), or None to not group by time.
+        how (str): The aggregation; see reduce_groups.
+
+    Returns:
+        Dict[str, np.ndarray]: 'bucket' (bucket starts, if bucketed), one array of tag ids per
+        `by` column, 'value' and 'count', with one entry per group.
+    """
+    keys, names = [], []
+    if bucket is not None:
+        # Bucket numbers rather than start times keep the key space small enough to count densely
+        keys.append(columns['timestamp'] // parse_duration(bucket))
+        names.append('bucket')
+    for name in by:
+        keys.append(columns[name])
+        names.append(name)
+    if keys:
+        inverse, unique = group_index(keys)
+        groups = len(unique[0])
+    else:
+        inverse, unique = np.zeros(len(columns['timestamp']), dtype=np.int64), []
+        groups = 1 if len(inverse) else 0
+    result = dict(zip(names, unique))
+    if bucket is not None:
+        result['bucket'] = result['bucket'] * parse_duration(bucket)
+    result['value'] = reduce_groups(inverse, groups, columns[value], how)
+    result['count'] = np.bincount(inverse, minlength=groups)
+    return result
+
+def rolling(result: Dict[str, np.ndarray], window: int, bucket: Any, by: Sequence[str] = (),
+            how: str = 'sum') -> Dict[str, np.ndarray]:
+    """
+    Compute a rolling sum or mean over a bucketed aggregate, e.g. a 7-day rolling total from daily sums.
+
+    Missing buckets count as zero, so every group gets a value for every bucket in the range.
+
+    Args:
+        result (Dict[str, np.ndarray]): The output of aggregate with a `bucket`.
+        window (int): The window length in buckets.
+        bucket: The bucket width used for the aggregate.
+        by (Sequence[str]): The tag columns the aggregate was grouped by.
+        how (str): 'sum' or 'mean' (the window sum divided by the number of buckets).
+
+    Returns:
+        Dict[str, np.ndarray]: 'bucket' and the tag columns for every bucket of every group, and
+        the rolling 'value'.
+    """
+    if not len(result['bucket']):
+        return {key: value[:0] for key, value in result.items() if key != 'count'}
+    step = parse_duration(bucket)
+    first = int(result['bucket'].min())
+    positions = (result['bucket'] - first) // step
+    width = int(positions.max()) + 1
+    if by:
+        series, tags = group_index([result[name] for name in by])
+        groups = len(tags[0])
+    else:
+        series, tags, groups = np.zeros(len(positions), dtype=np.int64), [], 1
+    dense = np.zeros((groups, width))
+    np.add.at(dense, (series, positions), result['value'])
+    totals = np.cumsum(dense, axis=1)
+    totals[:, window:] -= totals[:, :-window].copy()
+    if how == 'mean':
+        totals /= np.minimum(np.arange(1, width + 1), window)
+    output = {'bucket': np.tile(first + step * np.arange(width), groups)}
+    for name, tag in zip(by, tags):
+        output[name] = np.repeat(tag, width)
+    output['value'] = totals.reshape(-1)
+    return output
+
+def rolling_events(timestamps: np.ndarray, values: np.ndarray, window: Any) -> np.ndarray:
+    """
+    For each record, sum the values of all records in the trailing time window ending at it.
+
+    Args:
+        timestamps (np.ndarray): Microseconds since the epoch, sorted ascending.
+        values (np.ndarray): The values.
+        window: The window length; see parse_duration.
+
+    Returns:
+        np.ndarray: The trailing-window sum at each record.
+    """
+    totals = np.concatenate(([0.0], np.cumsum(values)))
+    starts = np.searchsorted(timestamps, timestamps - parse_duration(window), side='right')
+    return totals[1:] - totals[starts]
+
+class Rollup:
+    """
+    A precomputed per-bucket, per-tag aggregate that is updated incrementally as records arrive.
+
+    Keeps the count, sums, minimum and maximum of every value column per group, which is enough
+    to answer count/sum/mean/min/max queries without rescanning the store. Each update only reads
+    the records appended since the last one. A compaction rewrites the sealed segments, so after
+    one the rollup is rebuilt from scratch. The state can be saved next to the store so it
+    survives restarts.
+    """
+
+    def __init__(self, store: EmissionsStore, bucket: Any = '1h', by: Sequence[str] = ('script',),
+                 path: Optional[str] = None):
+        """
+        Args:
+            store (EmissionsStore): The store to roll up.
+            bucket: The time-bucket width; see parse_duration.
+            by (Sequence[str]): Tag columns to group by.
+            path (str, optional): An .npz file to load the state from and save it to.
+        """
+        self.store = store
+        self.bucket = bucket
+        self.by = tuple(by)
+        self.path = path
+        self._reset()
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def _reset(self) -> None:
+        self.segments: List[str] = []
+        self.position = 0
+        self.keys = {name: np.zeros(0, dtype=np.int64) for name in ('bucket',) + self.by}
+        self.stats = {'count': np.zeros(0)}
+        for column in VALUE_COLUMNS:
+            self.stats.update({f'{column}_sum': np.zeros(0), f'{column}_min': np.zeros(0), f'{column}_max': np.zeros(0)})
+
+    def _load(self) -> None:
+        with np.load(self.path, allow_pickle=False) as state:
+            if str(state['bucket_width']) != str(self.bucket) or list(state['by']) != list(self.by):
+                return
+            self.segments = [str(name) for name in state['segments']]
+            self.position = int(state['position'])
+            self.keys = {name: state[f'key_{name}'] for name in self.keys}
+            self.stats = {name: state[f'stat_{name}'] for name in self.stats}
+
+    def save(self) -> None:
+        """Save the state to `path`."""
+        arrays = {f'key_{name}': value for name, value in self.keys.items()}
+        arrays.update({f'stat_{name}': value for name, value in self.stats.items()})
+        temporary = self.path + '.tmp.npz'
+        np.savez(temporary, segments=np.array(self.segments, dtype=str), position=self.position,
+                 bucket_width=str(self.bucket), by=np.array(self.by, dtype=str), **arrays)
+        os.replace(temporary, self.path)
+
+    def update(self) -> int:
+        """
+        Fold the records appended since the last update into the rollup.
+
+        Returns:
+            int: The number of new records.
+        """
+        segments = self.store.sealed_segments()
+        if segments[:len(self.segments)] != self.segments:
+            self._reset()
+        chunks, seen = [], 0
+        for segment in self.store.iter_segments():
+            if seen + len(segment) > self.position:
+                chunks.append(segment[max(self.position - seen, 0):])
+            seen += len(segment)
+        new = sum(len(chunk) for chunk in chunks)
+        if new:
+            self._merge(np.concatenate(chunks))
+        self.segments = segments
+        self.position = seen
+        if self.path is not None:
+            self.save()
+        return new
+
+    def _merge(self, records: np.ndarray) -> None:
+        step = parse_duration(self.bucket)
+        keys = [np.concatenate((self.keys['bucket'], records['timestamp'])) // step]
+        keys += [np.concatenate((self.keys[name], records[name].astype(np.int64))) for name in self.by]
+        inverse, unique = group_index(keys)
+        groups = len(unique[0])
+        # Previous groups contribute their partial aggregates, new records their raw values
+        counts = np.concatenate((self.stats['count'], np.ones(len(records))))
+        stats = {'count': np.bincount(inverse, weights=counts, minlength=groups)}
+        for column in VALUE_COLUMNS:
+            values = records[column]
+            stats[f'{column}_sum'] = np.bincount(
+                inverse, weights=np.concatenate((self.stats[f'{column}_sum'], values)), minlength=groups)
+            for how in ('min', 'max'):
+                stats[f'{column}_{how}'] = reduce_groups(
+                    inverse, groups, np.concatenate((self.stats[f'{column}_{how}'], values)), how)
+        self.keys = dict(zip(('bucket',) + self.by, unique))
+        self.keys['bucket'] = self.keys['bucket'] * step
+        self.stats = stats
+
+    def result(self, value: str = 'energy_consumed', how: str = 'sum') -> Dict[str, np.ndarray]:
+        """
+        Read an aggregate from the rollup, in the same shape as aggregate's output.
+
+        Args:
+            value (str): The value column.
+            how (str): 'count', 'sum', 'mean', 'min' or 'max'.
+
+        Returns:
+            Dict[str, np.ndarray]: 'bucket', the tag columns, 'value' and 'count'.
+        """
+        count = self.stats['count']
+        if how == 'count':
+            values = count
+        elif how == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = self.stats[f'{value}_sum'] / count
+        elif how in ('sum', 'min', 'max'):
+            values = self.stats[f'{value}_{how}']
+        else:
+            raise ValueError(f"Rollups support {AGGREGATIONS}, not '{how}'")
+        return dict(self.keys, value=values, count=count.astype(np.int64))
+
+class EmissionsQuery:
+    """
+    Queries over an EmissionsStore, returning tag names instead of dictionary ids.
+
+    Example:
+        query = EmissionsQuery(EmissionsStore('./emissions_store'))
+        query.aggregate(by=('script',), bucket='1h')                  # energy per hour by script
+        query.rolling(value='carbon_emitted', bucket='1d', window=7)  # rolling 7-day carbon
+        query.aggregate(value='energy_consumed', by=('commit',), how='p95')
+    """
+
+    def __init__(self, store: EmissionsStore):
+        """
+        Args:
+            store (EmissionsStore): The store to query.
+        """
+        self.store = store
+
+    def decode(self, result: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """
+        Replace tag ids with their strings.
+
+        Args:
+            result (Dict[str, np.ndarray]): A query result.
+
+        Returns:
+            Dict[str, np.ndarray]: The same result with tag columns as object arrays of strings.
+        """
+        strings = self.store.strings()
+        return {key: strings[value] if key in TAG_COLUMNS else value for key, value in result.items()}
+
+    def aggregate(self, value: str = 'energy_consumed', by: Sequence[str] = (), bucket: Any = None,
+                  how: str = 'sum', start: Any = None, end: Any = None) -> Dict[str, np.ndarray]:
+        """
+        Aggregate a value column over a time range; see the module-level aggregate.
+
+        Args:
+            value (str): The column to aggregate.
+            by (Sequence[str]): Tag columns to group by.
+            bucket: Time-bucket width, or None.
+            how (str): The aggregation.
+            start: Only records at or after this time.
+            end: Only records before this time.
+
+        Returns:
+            Dict[str, np.ndarray]: The decoded result.
+        """
+        return self.decode(aggregate(self.store.read(start, end), value, by, bucket, how))
+
+    def rolling(self, value: str = 'carbon_emitted', bucket: Any = '1d', window: int = 7, by: Sequence[str] = (),
+                how: str = 'sum', start: Any = None, end: Any = None) -> Dict[str, np.ndarray]:
+        """
+        Rolling totals (or means) over time buckets, e.g. rolling 7-day carbon.
+
+        Args:
+            value (str): The column to aggregate.
+            bucket: The bucket width.
+            window (int): The window length in buckets.
+            by (Sequence[str]): Tag columns to group by.
+            how (str): 'sum' or 'mean'.
+            start: Only records at or after this time.
+            end: Only records before this time.
+
+        Returns:
+            Dict[str, np.ndarray]: The decoded result.
+        """
+        sums = aggregate(self.store.read(start, end), value, by, bucket, 'sum')
+        return self.decode(rolling(sums, window, bucket, by, how))
+
+    def rollup(self, bucket: Any = '1h', by: Sequence[str] = ('script',)) -> Rollup:
+        """
+        Get an incrementally updated rollup, persisted in the store's directory.
+
+        Args:
+            bucket: The bucket width.
+            by (Sequence[str]): Tag columns to group by.
+
+        Returns:
+            Rollup: The rollup, already brought up to date.
+        """
+        name = f"rollup-{bucket}-{'-'.join(by) or 'all'}.npz"
+        rollup = Rollup(self.store, bucket, by, os.path.join(self.store.path, name))
+        rollup.update()
+        return rollup
@@ -0,0 +1,384 @@
+import fcntl
+import json
+import os
+import re
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+
+FORMAT_VERSION = 1
+TAG_COLUMNS = ('script', 'commit', 'function')
+VALUE_COLUMNS = ('energy_consumed', 'carbon_emitted')
+# Timestamps are microseconds since the Unix epoch (UTC); tags are indexes into a string dictionary
+RECORD_DTYPE = np.dtype([('timestamp', '<i8')] + [(name, '<f8') for name in VALUE_COLUMNS]
+                        + [(name, '<u4') for name in TAG_COLUMNS])
+SEGMENT_PATTERN = re.compile(r'^segment-(\d{8})-(\d{8})\.rec$')
+ACTIVE_FILE = 'active.rec'
+DICTIONARY_FILE = 'strings.jsonl'
+FORMAT_FILE = 'format.json'
+LOCK_FILE = 'writer.lock'
+
+def to_timestamp(value: Any) -> int:
+    """
+    Convert a timestamp to microseconds since the Unix epoch.
+
+    Args:
+        value: Seconds since the epoch, a datetime, or an ISO 8601 string like '2024-07-13 12:00:00'.
+            Naive datetimes and strings are taken to be UTC.
+
+    Returns:
+        int: Microseconds since the epoch.
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp() * 1_000_000)
+    return int(float(value) * 1_000_000)
+
+def _segment_name(first: int, last: int) -> str:
+    return f"segment-{first:08d}-{last:08d}.rec"
+
+class EmissionsStore:
+    """
+    Append-only store of emissions records in fixed-width binary segments.
+
+    Records are appended to an active file in whole-record writes. When it reaches
+    `segment_records` records it is flushed to disk and atomically renamed into a sealed segment.
+    A crash can at worst leave a partial record at the end of the active file, which is dropped
+    when the store is next opened. Sealed segments are immutable and read through memory maps, so
+    reading needs no parsing and no copy of the data.
+
+    String tags (script, commit, function) are dictionary-encoded as 32-bit ids. The dictionary is
+    an append-only JSON-lines file that is written before any record that refers to it.
+
+    Compaction merges sealed segments into one, sorted by timestamp. The merged segment's name
+    covers the numbers of the segments it replaces, so if a crash leaves both behind, readers
+    ignore the replaced ones and the next compaction or writer open deletes them.
+    """
+
+    def __init__(self, path: str, segment_records: int = 1_000_000, buffer_records: int = 4096, durable: bool = False):
+        """
+        Args:
+            path (str): Directory of the store; created if missing.
+            segment_records (int): Records per sealed segment.
+            buffer_records (int): Records buffered in memory before they are written.
+            durable (bool): Whether to fsync after every buffer flush, not only at rollover.
+        """
+        self.path = path
+        self.segment_records = segment_records
+        self.buffer_records = buffer_records
+        self.durable = durable
+        os.makedirs(path, exist_ok=True)
+        self._check_format()
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+        self._load_dictionary()
+        self._buffer = np.zeros(buffer_records, dtype=RECORD_DTYPE)
+        self._buffered = 0
+        self._active = None
+        self._active_records = 0
+        self._lock_file = None
+
+    def _check_format(self) -> None:
+        format_path = os.path.join(self.path, FORMAT_FILE)
+        expected = {'version': FORMAT_VERSION, 'dtype': RECORD_DTYPE.descr}
+        if os.path.exists(format_path):
+            with open(format_path, 'r') as f:
+                found = json.load(f)
+            if found != json.loads(json.dumps(expected)):
+                raise ValueError(f"{self.path} uses an incompatible record format: {found}")
+        else:
+            with open(format_path, 'w') as f:
+                json.dump(expected, f)
+
+    def _load_dictionary(self) -> None:
+        dictionary_path = os.path.join(self.path, DICTIONARY_FILE)
+        if not os.path.exists(dictionary_path):
+            self._strings = ['']
+            with open(dictionary_path, 'w') as f:
+                f.write(json.dumps('') + '\n')
+        else:
+            with open(dictionary_path, 'r') as f:
+                for line in f:
+                    # A line cut short by a crash can't be referenced by any record, so it is ignored
+                    if line.endswith('\n'):
+                        self._strings.append(json.loads(line))
+        self._string_ids = {value: index for index, value in enumerate(self._strings)}
+
+    def _encode(self, value: Optional[str]) -> int:
+        value = '' if value is None else str(value)
+        index = self._string_ids.get(value)
+        if index is None:
+            index = len(self._strings)
+            with open(os.path.join(self.path, DICTIONARY_FILE), 'a') as f:
+                f.write(json.dumps(value) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._strings.append(value)
+            self._string_ids[value] = index
+        return index
+
+    def strings(self) -> np.ndarray:
+        """
+        Get the string dictionary, for decoding tag columns with `store.strings()[ids]`.
+
+        Returns:
+            np.ndarray: The strings as an object array indexed by id.
+        """
+        self._strings = []
+        self._load_dictionary()
+        return np.array(self._strings, dtype=object)
+
+    def _segments(self) -> List[Tuple[int, int, str]]:
+        found = []
+        for name in os.listdir(self.path):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                found.append((int(match.group(1)), int(match.group(2)), name))
+        # Keep only segments not covered by a wider (compacted) one
+        found.sort(key=lambda segment: (segment[0], -segment[1]))
+        live = []
+        for segment in found:
+            if live and segment[1] <= live[-1][1]:
+                continue
+            live.append(segment)
+        return live
+
+    def sealed_segments(self) -> List[str]:
+        """
+        List the sealed segments in read order.
+
+        Returns:
+            List[str]: Segment file names. Appends only add names at the end; a compaction replaces them.
+        """
+        return [name for _, _, name in self._segments()]
+
+    def _next_segment_number(self) -> int:
+        segments = self._segments()
+        return segments[-1][1] + 1 if segments else 1
+
+    # Writing
+
+    def _open_writer(self) -> None:
+        if self._active is not None:
+            return
+        self._lock_file = open(os.path.join(self.path, LOCK_FILE), 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise RuntimeError(f"Another process is writing to {self.path}")
+        self._remove_covered_segments()
+        active_path = os.path.join(self.path, ACTIVE_FILE)
+        self._active = open(active_path, 'ab')
+        size = self._active.seek(0, os.SEEK_END)
+        complete = size - size % RECORD_DTYPE.itemsize
+        if complete != size:
+            self._active.truncate(complete)
+            self._active.seek(complete)
+        self._active_records = complete // RECORD_DTYPE.itemsize
+
+    def _remove_covered_segments(self) -> None:
+        live = {name for _, _, name in self._segments()}
+        for name in os.listdir(self.path):
+            # Also clean up after a compaction that crashed before its rename
+            if (SEGMENT_PATTERN.match(name) and name not in live) or name.endswith('.rec.tmp'):
+                os.remove(os.path.join(self.path, name))
+
+    def append(self, timestamp: Any, energy_consumed: float, carbon_emitted: float,
+               script: Optional[str] = None, commit: Optional[str] = None, function: Optional[str] = None) -> None:
+        """
+        Buffer one record for writing.
+
+        Args:
+            timestamp: When it was measured; see to_timestamp.
+            energy_consumed (float): Energy in kWh.
+            carbon_emitted (float): Emissions in kg CO2eq.
+            script (str, optional): The script that was measured.
+            commit (str, optional): The commit the code was at.
+            function (str, optional): The function that was measured.
+        """
+        self._open_writer()
+        record = self._buffer[self._buffered]
+        record['timestamp'] = to_timestamp(timestamp)
+        record['energy_consumed'] = energy_consumed
+        record['carbon_emitted'] = carbon_emitted
+        record['script'] = self._encode(script)
+        record['commit'] = self._encode(commit)
+        record['function'] = self._encode(function)
+        self._buffered += 1
+        if self._buffered == self.buffer_records:
+            self.flush()
+
+    def extend(self, records: Iterable[Dict[str, Any]]) -> int:
+        """
+        Buffer many records given as dictionaries, e.g. rows from CodeCarbon or save_emissions_data.
+
+        Missing timestamps default to now, and 'emissions' is accepted for 'carbon_emitted'.
+
+        Args:
+            records (Iterable[Dict[str, Any]]): The records.
+
+        Returns:
+            int: The number of records added.
+        """
+        count = 0
+        for record in records:
+            self.append(
+                record.get('timestamp', time.time()),
+                record.get('energy_consumed', 0.0) or 0.0,
+                record.get('carbon_emitted', record.get('emissions', 0.0)) or 0.0,
+                record.get('script'), record.get('commit'), record.get('function'),
+            )
+            count += 1
+        return count
+
+    def flush(self) -> None:
+        """Write buffered records to the active file, rolling over into sealed segments as they fill."""
+        if self._active is None:
+            return
+        written = 0
+        while written < self._buffered:
+            take = min(self._buffered - written, self.segment_records - self._active_records)
+            self._active.write(self._buffer[written:written + take].tobytes())
+            written += take
+            self._active_records += take
+            if self._active_records >= self.segment_records:
+                self._roll_over()
+        self._buffered = 0
+        self._active.flush()
+        if self.durable:
+            os.fsync(self._active.fileno())
+
+    def _roll_over(self) -> None:
+        self._active.flush()
+        os.fsync(self._active.fileno())
+        self._active.close()
+        number = self._next_segment_number()
+        os.rename(os.path.join(self.path, ACTIVE_FILE), os.path.join(self.path, _segment_name(number, number)))
+        self._fsync_directory()
+        self._active = open(os.path.join(self.path, ACTIVE_FILE), 'ab')
+        self._active_records = 0
+
+    def _fsync_directory(self) -> None:
+        descriptor = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    def close(self) -> None:
+        """Flush buffered records and release the writer lock."""
+        if self._active is not None:
+            self.flush()
+            os.fsync(self._active.fileno())
+            self._active.close()
+            self._active = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self) -> 'EmissionsStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    # Compaction
+
+    def compact(self, min_segments: int = 2) -> Optional[str]:
+        """
+        Merge all sealed segments into one, sorted by timestamp.
+
+        Args:
+            min_segments (int): Do nothing if there are fewer sealed segments than this.
+
+        Returns:
+            Optional[str]: The name of the merged segment, or None if nothing was done.
+        """
+        self._open_writer()
+        segments = self._segments()
+        if len(segments) < min_segments:
+            return None
+        merged = np.concatenate([self._map(name) for _, _, name in segments])
+        merged = merged[np.argsort(merged['timestamp'], kind='stable')]
+        name = _segment_name(segments[0][0], segments[-1][1])
+        temporary = os.path.join(self.path, name + '.tmp')
+        with open(temporary, 'wb') as f:
+            f.write(merged.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        del merged
+        os.rename(temporary, os.path.join(self.path, name))
+        self._fsync_directory()
+        self._remove_covered_segments()
+        return name
+
+    # Reading
+
+    def _map(self, name: str) -> np.ndarray:
+        path = os.path.join(self.path, name)
+        records = os.path.getsize(path) // RECORD_DTYPE.itemsize
+        if records == 0:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        return np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(records,))
+
+    def iter_segments(self, include_active: bool = True) -> Iterator[np.ndarray]:
+        """
+        Iterate over the stored records one segment at a time, as read-only memory-mapped arrays.
+
+        Args:
+            include_active (bool): Whether to include the records not yet rolled into a sealed segment.
+
+        Yields:
+            np.ndarray: Structured arrays with the RECORD_DTYPE fields.
+        """
+        for _, _, name in self._segments():
+            yield self._map(name)
+        if include_active and os.path.exists(os.path.join(self.path, ACTIVE_FILE)):
+            yield self._map(ACTIVE_FILE)
+
+    def read(self, start: Any = None, end: Any = None, include_active: bool = True) -> Dict[str, np.ndarray]:
+        """
+        Read records as one NumPy array per column, optionally limited to a time range.
+
+        Args:
+            start: Only records at or after this time; see to_timestamp.
+            end: Only records before this time.
+            include_active (bool): Whether to include records not yet in a sealed segment.
+
+        Returns:
+            Dict[str, np.ndarray]: 'timestamp' (int64 microseconds), the value columns (float64)
+            and the tag columns (uint32 dictionary ids).
+        """
+        low = to_timestamp(start) if start is not None else None
+        high = to_timestamp(end) if end is not None else None
+        parts = []
+        for segment in self.iter_segments(include_active):
+            if low is not None or high is not None:
+                timestamps = segment['timestamp']
+                mask = np.ones(len(segment), dtype=bool)
+                if low is not None:
+                    mask &= timestamps >= low
+                if high is not None:
+                    mask &= timestamps < high
+                segment = segment[mask]
+            parts.append(segment)
+        records = np.concatenate(parts) if parts else np.zeros(0, dtype=RECORD_DTYPE)
+        return {name: np.ascontiguousarray(records[name]) for name in RECORD_DTYPE.names}
+
+    def count(self, include_active: bool = True) -> int:
+        """
+        Count the stored records without reading them.
+
+        Args:
+            include_active (bool): Whether to include records not yet in a sealed segment.
+
+        Returns:
+            int: The number of records.
+        """
+        return sum(len(segment) for segment in self.iter_segments(include_active))
@@ -0,0 +1,158 @@
+import ast
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Optional
+from analysis_cache import PersistentLRUCache
+from job_queue import JobCancelled
+
+def normalize_code(code: str) -> str:
+    """
+    Canonicalize source code so formatting and comments don't change its cache key.
+
+    Text that doesn't parse as Python (e.g. a natural-language description) only has its
+    whitespace normalized.
+
+    Args:
+        code (str): The source code or text.
+
+    Returns:
+        str: The normalized text.
+    """
+    try:
+        return ast.unparse(ast.parse(code))
+    except (SyntaxError, ValueError):
+        return '\n'.join(' '.join(line.split()) for line in code.strip().splitlines() if line.strip())
+
+def directory_fingerprint(path: str) -> str:
+    """
+    Identify the contents of a local model directory without reading the weights.
+
+    Every file's relative path, size and modification time are hashed, so saving a retrained
+    model into the same directory gives a new fingerprint.
+
+    Args:
+        path (str): The model directory.
+
+    Returns:
+        str: The first 16 hex digits of a SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            stat = os.stat(file_path)
+            digest.update(f"{os.path.relpath(file_path, path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+class GenerationCache:
+    """
+    Persistent cache of model responses keyed by model identity, generation parameters, task and normalized input.
+
+    Concurrent requests for the same key are coalesced: the first caller runs the model and the
+    others wait for its result instead of generating it again. If the first caller's job is
+    cancelled, one of the waiting callers generates the response instead.
+    """
+
+    # Seconds between a waiting caller's cancellation checks
+    POLL_INTERVAL = 0.25
+
+    def __init__(self, path: str = './.refactor_earth_cache/generation.sqlite', max_bytes: int = 64 * 1024 * 1024):
+        """
+        Args:
+            path (str): Path to the SQLite database file.
+            max_bytes (int): Size limit of the stored responses.
+        """
+        self.store = PersistentLRUCache(path, max_bytes)
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, Future] = {}
+
+    @staticmethod
+    def make_key(model_id: str, task: str, text: str, params: Optional[Dict[str, Any]] = None) -> str:
+        """
+        Build the cache key for a generation request.
+
+        Args:
+            model_id (str): Identifies the model weights, e.g. name plus revision.
+            task (str): Which prompt template the input goes into, e.g. 'refactor'.
+            text (str): The input code or description.
+            params (Dict[str, Any], optional): Generation parameters that affect the output.
+
+        Returns:
+            str: A hex SHA-256 digest.
+        """
+        payload = json.dumps(
+            {'model': model_id, 'task': task, 'params': params or {}, 'input': normalize_code(text)},
+            sort_keys=True, default=str,
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_or_generate(self, model_id: str, task: str, text: str, generate: Callable[[], str],
+                        params: Optional[Dict[str, Any]] = None, check: Optional[Callable[[], None]] = None) -> str:
+        """
+        Return the cached response for a request, generating it if needed.
+
+        Args:
+            model_id (str): Identifies the model weights.
+            task (str): Which prompt template the input goes into.
+            text (str): The input code or description.
+            generate (Callable[[], str]): Runs the model; only called on a miss.
+            params (Dict[str, Any], optional): Generation parameters that affect the output.
+            check (Callable[[], None], optional): Called while waiting for another caller's
+                generation, and may raise to stop waiting, e.g. JobContext.check.
+
+        Returns:
+            str: The model's response.
+        """
+        key = self.make_key(model_id, task, text, params)
+        while True:
+            cached = self.store.get(key)
+            if cached is not None:
+                return cached
+
+            with self._lock:
+                future = self._in_flight.get(key)
+                leader = future is None
+                if leader:
+                    future = Future()
+                    self._in_flight[key] = future
+                else:
+                    self.coalesced += 1
+            if leader:
+                break
+            while True:
+                try:
+                    return future.result(timeout=None if check is None else self.POLL_INTERVAL)
+                except FutureTimeout:
+                    check()
+                except JobCancelled:
+                    # The leader's job was cancelled, not ours: start over, generating the response
+                    # ourselves unless another waiting caller already does
+                    break
+
+        try:
+            response = generate()
+            self.store.put(key, response)
+        except BaseException as e:
+            # Out of the in-flight table first, so a waiting caller that wakes up starts a new generation
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._in_flight[key]
+        future.set_result(response)
+        return response
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Report hit/miss counters, coalesced requests and size.
+
+        Returns:
+            Dict[str, int]: The PersistentLRUCache counters plus 'coalesced'.
+        """
+        return dict(self.store.stats(), coalesced=self.coalesced)
@@ -1,6 +1,320 @@
-import cupy as cp  # Importing CuPy for super-fast GPU computations
-import numpy as np  # Importing NumPy for standard CPU-based computations
+import argparse  # Choosing between the calibration table and the GPU/CPU comparison
+import importlib  # Importing optional backends only when they are used
+import importlib.util  # Checking whether an optional backend is installed, without importing it
+import json  # Caching the calibration results
+import math  # Comparing sizes on a log scale
+import os  # Counting CPUs and managing the cache file
+import platform  # Describing the host the calibration ran on
+import socket  # Naming the host the calibration ran on
 import time  # Importing time to measure how fast our code runs
+from functools import lru_cache  # Sharing one dispatcher per process
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np  # Importing NumPy for standard CPU-based computations
+
+# Array operations the backends implement. Element-wise ones return an array, reductions a float.
+OPERATIONS = ('add', 'multiply', 'sum', 'dot')
+CALIBRATION_SIZES = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+DEFAULT_CACHE_PATH = './.refactor_earth_cache/array_backends.json'
+
+def _installed(module_name: str) -> bool:
+    return importlib.util.find_spec(module_name) is not None
+
+class NumpyBackend:
+    """NumPy on the CPU: always available, and the fastest choice for small arrays."""
+
+    name = 'numpy'
+
+    @staticmethod
+    def available() -> bool:
+        return True
+
+    def thread_options(self) -> List[Optional[int]]:
+        return [None]
+
+    def run(self, operation: str, arrays: Sequence[np.ndarray], threads: Optional[int] = None) -> Any:
+        if operation == 'add':
+            return np.add(arrays[0], arrays[1])
+        if operation == 'multiply':
+            return np.multiply(arrays[0], arrays[1])
+        if operation == 'sum':
+            return float(np.sum(arrays[0]))
+        return float(np.dot(arrays[0], arrays[1]))
+
+def _numba_kernels() -> Dict[str, Any]:
+    numba = importlib.import_module('numba')
+
+    # parallel=True splits the loops over Numba's threads; cache=True keeps the machine code on disk
+    @numba.njit(parallel=True, cache=True)
+    def add(a, b):
+        out = np.empty_like(a)
+        for i in numba.prange(a.shape[0]):
+            out[i] = a[i] + b[i]
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def multiply(a, b):
+        out = np.empty_like(a)
+        for i in numba.prange(a.shape[0]):
+            out[i] = a[i] * b[i]
+        return out
+
+    @numba.njit(parallel=True, cache=True)
+    def total(a):
+        result = 0.0
+        for i in numba.prange(a.shape[0]):
+            result += a[i]
+        return result
+
+    @numba.njit(parallel=True, cache=True)
+    def dot(a, b):
+        result = 0.0
+        for i in numba.prange(a.shape[0]):
+            result += a[i] * b[i]
+        return result
+
+    return {'add': add, 'multiply': multiply, 'sum': total, 'dot': dot}
+
+class NumbaBackend:
+    """Numba-compiled loops spread over several CPU threads: worth it for large arrays on many cores."""
+
+    name = 'numba'
+
+    def __init__(self):
+        self._numba = importlib.import_module('numba')
+        self._kernels = _numba_kernels()
+        self._numpy = NumpyBackend()
+
+    @staticmethod
+    def available() -> bool:
+        return _installed('numba')
+
+    def thread_options(self) -> List[Optional[int]]:
+        most = self._numba.config.NUMBA_NUM_THREADS
+        return sorted({1, max(1, most // 2), most})
+
+    def run(self, operation: str, arrays: Sequence[np.ndarray], threads: Optional[int] = None) -> Any:
+        if operation in ('add', 'multiply'):
+            # Raises for incompatible shapes, as NumPy would
+            np.broadcast_shapes(arrays[0].shape, arrays[1].shape)
+        # The kernels loop over one dimension of equally long arrays: they neither broadcast nor
+        # multiply matrices, so anything else is left to NumPy
+        if operation != 'sum' and (arrays[0].shape != arrays[1].shape or (operation == 'dot' and arrays[0].ndim != 1)):
+            return self._numpy.run(operation, arrays)
+        previous = self._numba.get_num_threads()
+        if threads is not None:
+            self._numba.set_num_threads(threads)
+        try:
+            result = self._kernels[operation](*(array.ravel() for array in arrays))
+        finally:
+            self._numba.set_num_threads(previous)
+        if operation in ('add', 'multiply'):
+            return result.reshape(arrays[0].shape)
+        return float(result)
+
+class CupyBackend:
+    """CuPy on a GPU. Inputs and results are NumPy arrays, so the transfers are part of its cost."""
+
+    name = 'cupy'
+
+    def __init__(self):
+        self._cp = importlib.import_module('cupy')
+
+    @staticmethod
+    def available() -> bool:
+        if not _installed('cupy'):
+            return False
+        try:
+            return importlib.import_module('cupy').cuda.runtime.getDeviceCount() > 0
+        except Exception:  # Installed, but no usable GPU or driver
+            return False
+
+    def thread_options(self) -> List[Optional[int]]:
+        return [None]
+
+    def run(self, operation: str, arrays: Sequence[np.ndarray], threads: Optional[int] = None) -> Any:
+        cp = self._cp
+        device_arrays = [cp.asarray(array) for array in arrays]
+        if operation == 'add':
+            return cp.asnumpy(device_arrays[0] + device_arrays[1])
+        if operation == 'multiply':
+            return cp.asnumpy(device_arrays[0] * device_arrays[1])
+        if operation == 'sum':
+            return float(cp.sum(device_arrays[0]))
+        return float(cp.dot(device_arrays[0], device_arrays[1]))
+
+BACKENDS = (NumpyBackend, NumbaBackend, CupyBackend)
+
+def available_backends() -> Dict[str, Any]:
+    """
+    Create every backend that can run on this host. Nothing that isn't installed is imported.
+
+    Returns:
+        Dict[str, Any]: Backend instances by name; NumPy is always present.
+    """
+    backends = {}
+    for backend_class in BACKENDS:
+        if backend_class.available():
+            try:
+                backends[backend_class.name] = backend_class()
+            except Exception:  # E.g. a broken installation
+                continue
+    return backends
+
+def host_fingerprint(backends: Sequence[str]) -> str:
+    """Describe the host and software a calibration is valid for."""
+    parts = [socket.gethostname(), platform.machine(), str(os.cpu_count()), f"numpy {np.__version__}"]
+    for name in sorted(backends):
+        if name != 'numpy':
+            parts.append(f"{name} {getattr(importlib.import_module(name), '__version__', '?')}")
+    return ' | '.join(parts)
+
+def _time_call(backend: Any, operation: str, arrays: Sequence[np.ndarray], threads: Optional[int]) -> float:
+    backend.run(operation, arrays, threads)  # Warm up: compilation, GPU context, caches
+    # Enough calls per measurement to make small sizes measurable; the best of 3 measurements
+    calls = max(1, 100_000 // arrays[0].size)
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(calls):
+            backend.run(operation, arrays, threads)
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+class ArrayDispatcher:
+    """
+    Runs array operations on whichever backend a calibration found fastest for their size.
+
+    The calibration times every operation on every available backend (and thread count) at a few
+    array sizes, once per host; the results are cached, so later processes start dispatching
+    right away. A call uses the choice made for the calibrated size nearest to its own.
+    """
+
+    def __init__(self, cache_path: str = DEFAULT_CACHE_PATH, sizes: Sequence[int] = CALIBRATION_SIZES,
+                 backends: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            cache_path (str): JSON file with the calibration results of each host.
+            sizes (Sequence[int]): Array sizes to calibrate at.
+            backends (Dict[str, Any], optional): Backends to choose from. Defaults to all available ones.
+        """
+        self.cache_path = cache_path
+        self.sizes = tuple(sorted(sizes))
+        self.backends = backends if backends is not None else available_backends()
+        self.fingerprint = host_fingerprint(self.backends)
+        self.calibration: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def calibrate(self, force: bool = False) -> Dict[str, Dict[str, Any]]:
+        """
+        Time the operations on each backend, or load the cached results for this host.
+
+        Args:
+            force (bool): Measure again even if results for this host are cached.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: Per operation and size, the chosen 'backend' and 'threads'
+            and the seconds per call of every candidate in 'timings'.
+        """
+        cached = self._load()
+        entry = cached.get(self.fingerprint)
+        if not force and entry is not None and entry['sizes'] == list(self.sizes):
+            self.calibration = entry['results']
+            return self.calibration
+
+        rng = np.random.default_rng(0)
+        results = {}
+        for size in self.sizes:
+            arrays = [rng.random(size), rng.random(size)]
+            for operation in OPERATIONS:
+                operands = arrays[:1] if operation == 'sum' else arrays
+                timings = {}
+                for name, backend in self.backends.items():
+                    for threads in backend.thread_options():
+                        try:
+                            timings[f"{name}:{threads}"] = _time_call(backend, operation, operands, threads)
+                        except Exception:  # A backend that fails is simply never chosen
+                            continue
+                best = min(timings, key=timings.get)
+                name, threads = best.split(':')
+                results.setdefault(operation, {})[str(size)] = {
+                    'backend': name,
+                    'threads': None if threads == 'None' else int(threads),
+                    'timings': timings,
+                }
+
+        cached[self.fingerprint] = {'sizes': list(self.sizes), 'calibrated_at': time.time(), 'results': results}
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(cached, f, indent=2)
+        os.replace(temporary, self.cache_path)
+        self.calibration = results
+        return results
+
+    def choose(self, operation: str, size: int) -> Tuple[str, Optional[int]]:
+        """
+        Pick the backend and thread count for an operation on arrays of a given size.
+
+        Args:
+            operation (str): One of OPERATIONS.
+            size (int): Number of elements.
+
+        Returns:
+            Tuple[str, Optional[int]]: The backend name and thread count (None for the backend's default).
+        """
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation: {operation}")
+        if self.calibration is None:
+            self.calibrate()
+        nearest = min(self.sizes, key=lambda calibrated: abs(math.log(max(size, 1)) - math.log(calibrated)))
+        choice = self.calibration[operation][str(nearest)]
+        if choice['backend'] not in self.backends:
+            return 'numpy', None
+        return choice['backend'], choice['threads']
+
+    def run(self, operation: str, *arrays: Any) -> Any:
+        """
+        Run an operation on the backend chosen for its size.
+
+        Args:
+            operation (str): One of OPERATIONS.
+            *arrays: The operands: one for 'sum', two of the same shape otherwise.
+
+        Returns:
+            Any: A NumPy array for element-wise operations, a float for reductions.
+        """
+        arrays = [np.ascontiguousarray(array, dtype=np.float64) for array in arrays]
+        name, threads = self.choose(operation, arrays[0].size)
+        return self.backends[name].run(operation, arrays, threads)
+
+@lru_cache(maxsize=None)
+def get_dispatcher() -> ArrayDispatcher:
+    """Get the process-wide dispatcher; it calibrates, or loads the cached calibration, on first use."""
+    return ArrayDispatcher()
+
+def add(a: Any, b: Any) -> np.ndarray:
+    """Element-wise a + b, on the fastest backend for their size."""
+    return get_dispatcher().run('add', a, b)
+
+def multiply(a: Any, b: Any) -> np.ndarray:
+    """Element-wise a * b, on the fastest backend for their size."""
+    return get_dispatcher().run('multiply', a, b)
+
+def array_sum(a: Any) -> float:
+    """The sum of a's elements, on the fastest backend for its size."""
+    return get_dispatcher().run('sum', a)
+
+def dot(a: Any, b: Any) -> float:
+    """The dot product of two vectors, on the fastest backend for their size."""
+    return get_dispatcher().run('dot', a, b)
 
 def gpu_acceleration_example(n: int):
     """
@@ -11,16 +325,24 @@ def gpu_acceleration_example(n: int):
 
     Returns:
     tuple: The result of the addition and the time it took to run.
+
+    Raises:
+    RuntimeError: If CuPy or a GPU is not available.
     """
+    if not CupyBackend.available():
+        raise RuntimeError("CuPy with a usable GPU is not available on this host")
+    cp = importlib.import_module('cupy')  # Importing CuPy for super-fast GPU computations
     # Create two arrays directly on the GPU
     a_gpu = cp.arange(n)  # GPU array with values from 0 to n-1
     b_gpu = cp.arange(n)  # Another GPU array with values from 0 to n-1
-    
-    start_time = time.time()  # Start the timer
+    a_gpu + b_gpu  # Warm up, so the timing excludes compiling the kernel
+    cp.cuda.Stream.null.synchronize()
+
+    start_time = time.perf_counter()  # Start the timer
     c_gpu = a_gpu + b_gpu  # Perform element-wise addition on the GPU
     cp.cuda.Stream.null.synchronize()  # Make sure all GPU operations are done
-    
-    end_time = time.time()  # Stop the timer
+
+    end_time = time.perf_counter()  # Stop the timer
     return c_gpu, end_time - start_time  # Return the result and the execution time
 
 def cpu_acceleration_example(n: int):
@@ -36,25 +358,35 @@ def cpu_acceleration_example(n: int):
     # Create two arrays on the CPU
     a_cpu = np.arange(n)  # CPU array with values from 0 to n-1
     b_cpu = np.arange(n)  # Another CPU array with values from 0 to n-1
-    
-    start_time = time.time()  # Start the timer
+
+    start_time = time.perf_counter()  # Start the timer
     c_cpu = a_cpu + b_cpu  # Perform element-wise addition on the CPU
-    
-    end_time = time.time()  # Stop the timer
+
+    end_time = time.perf_counter()  # Stop the timer
     return c_cpu, end_time - start_time  # Return the result and the execution time
 
 if __name__ == "__main__":
-    n = 100_000_000  # We'll use a large array size to really see the difference in speed
-    
-    # Benchmark the GPU example to see how much faster it is
-    gpu_result, gpu_time = gpu_acceleration_example(n)
-    print(f"GPU Execution Time: {gpu_time:.6f} seconds")  # Print how long the GPU took
-    
-    # Benchmark the CPU example to compare
-    cpu_result, cpu_time = cpu_acceleration_example(n)
-    print(f"CPU Execution Time: {cpu_time:.6f} seconds")  # Print how long the CPU took
-    
-    # Calculate and print the speedup gained by using the GPU over the CPU
-    speedup = cpu_time / gpu_time
-    print(f"GPU Speedup: {speedup:.2f}x")
+    parser = argparse.ArgumentParser(description="Calibrate the array backends, or compare GPU and CPU.")
+    parser.add_argument('--recalibrate', action='store_true', help="Measure again even if results are cached")
+    parser.add_argument('--compare', type=int, metavar='N', help="Time an N-element add on the GPU and the CPU")
+    args = parser.parse_args()
 
+    if args.compare:
+        # Benchmark the CPU example, and the GPU one if there is a GPU, to compare
+        cpu_result, cpu_time = cpu_acceleration_example(args.compare)
+        print(f"CPU Execution Time: {cpu_time:.6f} seconds")  # Print how long the CPU took
+        try:
+            gpu_result, gpu_time = gpu_acceleration_example(args.compare)
+            print(f"GPU Execution Time: {gpu_time:.6f} seconds")  # Print how long the GPU took
+            # Calculate and print the speedup gained by using the GPU over the CPU
+            print(f"GPU Speedup: {cpu_time / gpu_time:.2f}x")
+        except RuntimeError as e:
+            print(e)
+    else:
+        dispatcher = ArrayDispatcher()
+        calibration = dispatcher.calibrate(force=args.recalibrate)
+        print(f"Backends: {', '.join(dispatcher.backends)} on {dispatcher.fingerprint}")
+        for operation, by_size in calibration.items():
+            for size, choice in by_size.items():
+                timings = ', '.join(f"{name} {seconds * 1e6:.1f}us" for name, seconds in choice['timings'].items())
+                print(f"{operation:>8} {int(size):>10}: {choice['backend']} (threads {choice['threads']})  [{timings}]")
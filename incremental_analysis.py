@@ -0,0 +1,233 @@
+import ast
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from git import Repo, NULL_TREE
+from gitdb.exc import BadName
+from analysis_cache import AnalysisCache, iter_function_nodes
+
+# Matches trailing ancestry operators of a revision, e.g. the "~3^2" of "main~3^2"
+ANCESTRY_SUFFIX = re.compile(r'(?:[~^]\d*)+$')
+# Matches the new-file side of a unified diff hunk header, e.g. "@@ -10,2 +12,3 @@"
+HUNK_HEADER = re.compile(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@', re.MULTILINE)
+
+def changed_line_ranges(patch: str) -> List[Tuple[int, int]]:
+    """
+    Get the line ranges a patch touches in the new version of a file.
+
+    Args:
+        patch (str): A unified diff for one file.
+
+    Returns:
+        List[Tuple[int, int]]: Inclusive (first_line, last_line) ranges. A pure deletion is reported
+        as the two lines around the point where lines were removed.
+    """
+    ranges = []
+    for match in HUNK_HEADER.finditer(patch):
+        start = int(match.group(1))
+        count = int(match.group(2)) if match.group(2) is not None else 1
+        if count == 0:
+            ranges.append((start, start + 1))
+        else:
+            ranges.append((start, start + count - 1))
+    return ranges
+
+def touched_functions(tree: ast.AST, ranges: Iterable[Tuple[int, int]]) -> Set[str]:
+    """
+    Find the functions whose source overlaps any of the given line ranges.
+
+    A change inside a method touches the method and every function enclosing it, since their
+    metrics include its body. Decorator lines count as part of the function.
+
+    Args:
+        tree (ast.AST): The parsed new version of the file.
+        ranges (Iterable[Tuple[int, int]]): Changed line ranges, as from changed_line_ranges.
+
+    Returns:
+        Set[str]: Qualified names of the touched functions.
+    """
+    ranges = list(ranges)
+    touched = set()
+    for name, node in iter_function_nodes(tree):
+        first = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+        if any(start <= node.end_lineno and end >= first for start, end in ranges):
+            touched.add(name)
+    return touched
+
+class IncrementalAnalyzer:
+    """
+    Analyzes a repository's history commit by commit, re-running metrics only for changed functions.
+
+    Per-function results for every analyzed blob are stored under the blob's SHA, so a file
+    version is analyzed at most once across runs, and unchanged functions in a modified file are
+    carried over from the previous version of the file.
+    """
+
+    def __init__(self, repo_path: str, cache: Optional[AnalysisCache] = None):
+        """
+        Args:
+            repo_path (str): Path to the repository (bare or with a working tree).
+            cache (AnalysisCache, optional): Where results are stored. Defaults to the shared analysis cache.
+        """
+        self.repo = Repo(repo_path)
+        self.cache = cache if cache is not None else AnalysisCache()
+        self.analyzed = 0
+        self.reused = 0
+
+    def _blob_results(self, blob, previous: Optional[Dict[str, Any]] = None, patch: Optional[str] = None) -> Dict[str, Any]:
+        key = f"blob:{blob.hexsha}"
+        stored = self.cache.store.get(key)
+        if stored is not None:
+            self.reused += len(stored)
+            return stored
+
+        try:
+            tree = ast.parse(blob.data_stream.read().decode('utf-8'))
+        except (SyntaxError, UnicodeDecodeError, ValueError):
+            self.cache.store.put(key, {})
+            return {}
+
+        if previous is not None and patch is not None:
+            touched = touched_functions(tree, changed_line_ranges(patch))
+        else:
+            touched = None  # Nothing to carry over, analyze every function
+
+        results = {}
+        for name, node in iter_function_nodes(tree):
+            if touched is not None and name not in touched and name in previous:
+                results[name] = dict(previous[name], lineno=node.lineno, end_lineno=node.end_lineno)
+                self.reused += 1
+            else:
+                results[name] = self.cache.analyze_function(node)
+                self.analyzed += 1
+        self.cache.store.put(key, results)
+        return results
+
+    def _snapshot(self, commit, check: Optional[Callable[[], None]] = None) -> Dict[str, Dict[str, Any]]:
+        snapshot = {}
+        for item in commit.tree.traverse():
+            if item.type == 'blob' and item.path.endswith('.py'):
+                if check is not None:
+                    check()
+                snapshot[item.path] = self._blob_results(item)
+        return snapshot
+
+    def _resolve_range(self, rev_range: str) -> str:
+        start, separator, end = rev_range.partition('..')
+        base = ANCESTRY_SUFFIX.sub('', start)
+        if not separator or end.startswith('.') or base == start:
+            return rev_range
+        try:
+            self.repo.rev_parse(start)
+        except (BadName, ValueError, IndexError):
+            # An ancestor of an existing revision that goes past the root commit, e.g. HEAD~1 of a single commit
+            self.repo.rev_parse(base or 'HEAD')
+            return end or 'HEAD'
+        return rev_range
+
+    def analyze_range(self, rev_range: str = 'HEAD',
+                      progress: Optional[Callable[[int, int], None]] = None,
+                      check: Optional[Callable[[], None]] = None) -> List[Dict[str, Any]]:
+        """
+        Walk a range of commits oldest first and build a per-commit metric timeline.
+
+        Only the first-parent history is walked, so a merge counts as one commit that brings in
+        all of its branch's changes, and the totals are those of the mainline after each commit.
+
+        Args:
+            rev_range (str): A revision range understood by `git rev-list`, e.g. 'v1.0..main'. A start
+                before the root commit, e.g. 'HEAD~1' in a single-commit repository, covers the
+                whole history.
+            progress (Callable[[int, int], None], optional): Called with (commits done, total commits)
+                after each commit.
+            check (Callable[[], None], optional): Called before each file is analyzed; raising from it,
+                e.g. when a job is cancelled, stops the walk.
+
+        Returns:
+            List[Dict[str, Any]]: One record per commit with the keys 'commit', 'date', 'summary',
+            'files_changed', 'functions_analyzed', 'functions_reused' and 'totals'.
+        """
+        commits = list(self.repo.iter_commits(self._resolve_range(rev_range), reverse=True, first_parent=True))
+        if not commits:
+            return []
+
+        # Start from the state just before the first commit in the range
+        parent = commits[0].parents[0] if commits[0].parents else None
+        snapshot = self._snapshot(parent, check) if parent is not None else {}
+
+        timeline = []
+        for commit in commits:
+            analyzed_before, reused_before = self.analyzed, self.reused
+            files_changed = 0
+            if commit.parents:
+                diffs = commit.parents[0].diff(commit, create_patch=True, unified=0)
+            else:
+                diffs = commit.diff(NULL_TREE, create_patch=True, unified=0)
+
+            for diff in diffs:
+                old_path = diff.a_path if diff.a_blob is not None else None
+                new_path = diff.b_path if diff.b_blob is not None else None
+                if not ((old_path or '').endswith('.py') or (new_path or '').endswith('.py')):
+                    continue
+                files_changed += 1
+                if check is not None:
+                    check()
+                previous = snapshot.pop(old_path, None) if old_path else None
+                if new_path is None or not new_path.endswith('.py'):
+                    continue  # Deleted, or renamed to a non-Python file
+                patch = diff.diff.decode('utf-8', errors='replace') if diff.diff else None
+                snapshot[new_path] = self._blob_results(diff.b_blob, previous, patch)
+
+            timeline.append({
+                'commit': commit.hexsha,
+                'date': commit.committed_datetime.isoformat(),
+                'summary': commit.summary,
+                'files_changed': files_changed,
+                'functions_analyzed': self.analyzed - analyzed_before,
+                'functions_reused': self.reused - reused_before,
+                'totals': aggregate_metrics(snapshot),
+            })
+            if progress is not None:
+                progress(len(timeline), len(commits))
+        return timeline
+
+def aggregate_metrics(snapshot: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Summarize per-function metrics across a whole repository snapshot.
+
+    Args:
+        snapshot (Dict[str, Dict[str, Any]]): Function metrics keyed by file path, then by function name.
+
+    Returns:
+        Dict[str, Any]: Function count, summed energy and carbon estimates, mean quality scores
+        and the deepest loop nesting.
+    """
+    functions = [metrics for results in snapshot.values() for metrics in results.values()]
+    count = len(functions)
+
+    def mean(key):
+        return round(sum(f[key] for f in functions) / count, 2) if count else 0.0
+
+    return {
+        'files': len(snapshot),
+        'functions': count,
+        'energy_consumption': sum(f['energy_consumption'] for f in functions),
+        'carbon_footprint': sum(f['carbon_footprint'] for f in functions),
+        'maintainability_index': mean('maintainability_index'),
+        'code_quality': mean('code_quality'),
+        'sustainability_score': mean('sustainability_score'),
+        'max_loop_depth': max((f['max_loop_depth'] for f in functions), default=0),
+    }
+
+def analyze_commit_range(repo_path: str, rev_range: str = 'HEAD', cache: Optional[AnalysisCache] = None) -> List[Dict[str, Any]]:
+    """
+    Build a per-commit metric timeline, re-analyzing only the functions each commit changes.
+
+    Args:
+        repo_path (str): Path to the repository.
+        rev_range (str): A revision range, e.g. 'HEAD~100..HEAD'.
+        cache (AnalysisCache, optional): Where results are stored. Defaults to the shared analysis cache.
+
+    Returns:
+        List[Dict[str, Any]]: The timeline, oldest commit first. See IncrementalAnalyzer.analyze_range.
+    """
+    return IncrementalAnalyzer(repo_path, cache).analyze_range(rev_range)
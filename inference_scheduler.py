@@ -0,0 +1,204 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+import torch
+
+class InferenceRequest:
+    """A prompt waiting to be generated, with the future its caller is waiting on."""
+    __slots__ = ('prompt', 'max_new_tokens', 'future', 'enqueued_at')
+
+    def __init__(self, prompt: str, max_new_tokens: int):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+class InferenceScheduler:
+    """
+    Gathers concurrent generation requests into micro-batches and runs them on one model.
+
+    A background thread takes the first waiting request, then keeps collecting requests until the
+    batch is full or `max_wait_ms` has passed. Each batch is padded to its own longest prompt and
+    generates only as many tokens as its largest request asked for. The queue is bounded, so
+    callers get backpressure instead of unbounded memory growth when the model falls behind.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 8, max_wait_ms: float = 20.0,
+                 max_queue_size: int = 64, generation_kwargs: Optional[Dict[str, Any]] = None):
+        """
+        Args:
+            model: A causal language model supporting `generate`.
+            tokenizer: The model's tokenizer.
+            max_batch_size (int): Maximum number of prompts generated together.
+            max_wait_ms (float): How long to wait for more requests before running a partial batch.
+            max_queue_size (int): Maximum number of requests waiting to be batched.
+            generation_kwargs (Dict[str, Any], optional): Extra arguments for `model.generate`.
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.generation_kwargs = dict(generation_kwargs or {'do_sample': False})
+
+        # Decoder-only models continue from the end of the prompt, so pad on the left
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stats_lock = threading.Lock()
+        self._stats = {'requests': 0, 'batches': 0, 'generated_tokens': 0,
+                       'generation_seconds': 0.0, 'queue_seconds': 0.0, 'max_queue_seconds': 0.0}
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name='inference-scheduler', daemon=True)
+        self._worker.start()
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Count the tokens in a piece of text.
+
+        Args:
+            text (str): The text to tokenize.
+
+        Returns:
+            int: The number of tokens.
+        """
+        return len(self.tokenizer(text, add_special_tokens=False)['input_ids'])
+
+    def submit(self, prompt: str, max_new_tokens: int = 256, timeout: Optional[float] = None) -> Future:
+        """
+        Queue a prompt for generation.
+
+        Args:
+            prompt (str): The prompt to continue.
+            max_new_tokens (int): The most tokens to generate for this prompt.
+            timeout (float, optional): How long to wait for room in the queue. Defaults to waiting forever.
+
+        Returns:
+            Future: Resolves to the generated continuation, without the prompt.
+
+        Raises:
+            queue.Full: If the queue stays full for longer than `timeout`.
+            RuntimeError: If the scheduler has been closed.
+        """
+        if self._closed:
+            raise RuntimeError("The inference scheduler is closed.")
+        request = InferenceRequest(prompt, max_new_tokens)
+        self._queue.put(request, timeout=timeout)
+        return request.future
+
+    def generate(self, prompt: str, max_new_tokens: int = 256, timeout: Optional[float] = None) -> str:
+        """
+        Generate a continuation and wait for it.
+
+        Args:
+            prompt (str): The prompt to continue.
+            max_new_tokens (int): The most tokens to generate.
+            timeout (float, optional): How long to wait for room in the queue.
+
+        Returns:
+            str: The generated continuation.
+        """
+        return self.submit(prompt, max_new_tokens, timeout).result()
+
+    def _next_batch(self) -> List[InferenceRequest]:
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # Put the shutdown marker back so the loop sees it after this batch
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            # Callers may have cancelled while waiting in the queue
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                # Fail this batch's callers and keep serving; a dead worker would leave every future waiting
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _run_batch(self, batch: List[InferenceRequest]) -> None:
+        started = time.perf_counter()
+        encoded = self.tokenizer([request.prompt for request in batch], return_tensors='pt', padding=True)
+        prompt_length = encoded['input_ids'].shape[1]
+        with torch.inference_mode():
+            output = self.model.generate(
+                **encoded,
+                max_new_tokens=max(request.max_new_tokens for request in batch),
+                pad_token_id=self.tokenizer.pad_token_id,
+                **self.generation_kwargs,
+            )
+        finished = time.perf_counter()
+
+        generated_tokens = 0
+        for row, request in zip(output, batch):
+            tokens = row[prompt_length:prompt_length + request.max_new_tokens].tolist()
+            # Everything after the end-of-sequence token is padding for the longer rows in the batch
+            if self.tokenizer.eos_token_id in tokens:
+                tokens = tokens[:tokens.index(self.tokenizer.eos_token_id)]
+            generated_tokens += len(tokens)
+            request.future.set_result(self.tokenizer.decode(tokens, skip_special_tokens=True))
+
+        with self._stats_lock:
+            stats = self._stats
+            stats['requests'] += len(batch)
+            stats['batches'] += 1
+            stats['generated_tokens'] += generated_tokens
+            stats['generation_seconds'] += finished - started
+            for request in batch:
+                waited = started - request.enqueued_at
+                stats['queue_seconds'] += waited
+                stats['max_queue_seconds'] = max(stats['max_queue_seconds'], waited)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Report throughput and latency since the scheduler started.
+
+        Returns:
+            Dict[str, float]: Request and batch counts, mean batch size, tokens per second of
+            generation time, and mean/max time requests spent queued.
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        requests, batches = stats['requests'], stats['batches']
+        return {
+            'requests': requests,
+            'batches': batches,
+            'mean_batch_size': requests / batches if batches else 0.0,
+            'generated_tokens': stats['generated_tokens'],
+            'tokens_per_second': stats['generated_tokens'] / stats['generation_seconds'] if stats['generation_seconds'] else 0.0,
+            'mean_queue_latency_ms': 1000 * stats['queue_seconds'] / requests if requests else 0.0,
+            'max_queue_latency_ms': 1000 * stats['max_queue_seconds'],
+            'queue_depth': self._queue.qsize(),
+        }
+
+    def close(self) -> None:
+        """Stop accepting requests, finish the queued ones and stop the worker thread."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._worker.join()
@@ -1,6 +1,32 @@
-from numba import jit, prange  # Importing JIT compilation and parallel processing tools from Numba
-import numpy as np  # Using NumPy for efficient numerical computations
+import argparse  # Parsing the command-line options of the demo and the hotspot report
+import ast  # Reading functions out of analysed source code
+import builtins  # Telling builtins apart from module globals a kernel would depend on
+import copy  # Giving every timed call its own copy of the arguments
+import hashlib  # Naming cached kernels after their source
+import importlib.util  # Loading generated kernel modules
+import json  # Persisting the registry
+import multiprocessing  # Compiling analysed code away from the caller's process
+import os  # Managing the cache directory
+import shutil  # Removing scratch directories
+import statistics  # Taking the median of repeated timings
+import sys  # Registering loaded kernel modules
+import tempfile  # Scratch directories for sample arguments
 import time  # Importing time to measure how fast our functions run
+import warnings  # Silencing Numba's deprecation warnings for reflected lists
+from typing import Any, Callable, Dict, List, Optional, Set
+import numpy as np  # Using NumPy for efficient numerical computations
+from script_runner import DEFAULT_LIMITS, limit_resources  # Bounding what analysed code may consume
+
+try:
+    from numba import jit, njit, prange  # Importing JIT compilation and parallel processing tools from Numba
+except ImportError:
+    # Without Numba everything runs as plain Python: the registry falls back for every kernel
+    njit = None
+
+    def jit(*args, **kwargs):
+        return lambda function: function
+
+    prange = range
 
 # Why JIT Compilation?
 # RefactorEarth aims to optimize and refactor Python code to be more efficient and sustainable.
@@ -10,10 +36,11 @@ import time  # Importing time to measure how fast our functions run
 # This is essential for RefactorEarth, as we're often dealing with large datasets and complex calculations
 # that need to be performed quickly and efficiently to minimize energy consumption and carbon footprint.
 
-# Let's start by using JIT to speed up a function that adds up all the numbers from 0 to n-1, 
+# Let's start by using JIT to speed up a function that adds up all the numbers from 0 to n-1,
 # and we'll take advantage of parallel processing to make it even faster.
+# With cache=True the machine code is saved to __pycache__, so later runs skip the compilation.
 
-@jit(nopython=True, parallel=True)
+@jit(nopython=True, parallel=True, cache=True)
 def compute_sum(n: int) -> int:
     """
     Add up all the numbers from 0 to n-1 using parallel execution.
@@ -31,7 +58,7 @@ def compute_sum(n: int) -> int:
     return total  # Return the final sum
 
 # Now, let's use JIT again, but this time with NumPy, which is already designed for high performance.
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def compute_sum_numpy(n: int) -> int:
     """
     Add up all the numbers from 0 to n-1 using NumPy, which is the go-to library for fast numerical operations.
@@ -46,28 +73,373 @@ def compute_sum_numpy(n: int) -> int:
     return np.sum(np.arange(n))
 
 # This function will help us see how much time it takes for our functions to run.
-def benchmark(func, n: int) -> None:
+def benchmark(func, n: int, repeats: int = 5) -> Dict[str, Any]:
     """
     Measure how fast the provided function runs.
 
+    The first call is timed on its own: for a JIT-compiled function it includes compiling (or
+    loading the compiled code from the cache). The steady-state time is the median of the
+    following calls.
+
     Args:
     func (Callable[[int], int]): The function you want to test.
     n (int): The number you want to pass to the function.
+    repeats (int): Number of calls timed after the first one.
 
     Returns:
-    None
+    Dict[str, Any]: The 'result', the 'first_call' time and the 'steady_state' time, in seconds.
     """
-    start_time = time.time()  # Start the clock
+    start_time = time.perf_counter()  # Start the clock
     result = func(n)  # Run the function with the input number
-    end_time = time.time()  # Stop the clock
+    first_call = time.perf_counter() - start_time  # Stop the clock
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func(n)
+        timings.append(time.perf_counter() - start_time)
+    steady_state = statistics.median(timings)
+    name = getattr(func, '__name__', repr(func))
     # Print out the result and how long it took
-    print(f"{func.__name__} result: {result}")
-    print(f"{func.__name__} execution time: {end_time - start_time:.6f} seconds")
+    print(f"{name} result: {result}")
+    print(f"{name} first call (including compilation): {first_call:.6f} seconds")
+    print(f"{name} steady-state execution time: {steady_state:.6f} seconds")
+    return {'result': result, 'first_call': first_call, 'steady_state': steady_state}
+
+# Now the registry, which does the same for functions found in the code we analyse. Each function
+# is written to its own module in the cache directory and compiled with cache=True, so Numba keeps
+# the machine code on disk and every later process loads it instead of compiling again.
+
+DEFAULT_CACHE_DIRECTORY = './.refactor_earth_cache/jit'
+KERNEL_GLOBALS = {'np', 'numpy', 'math'}  # Modules a kernel may use; anything else global makes it fall back
+KERNEL_HEADER = '''# Generated by jit_optimization.JitRegistry from analysed code. Do not edit: Numba's on-disk
+# cache of the compiled kernel is tied to this file.
+import math
+import numpy
+import numpy as np
+'''
+
+def _free_names(function: ast.AST) -> Set[str]:
+    """Names a function reads that are neither its parameters, nor assigned in it, nor builtins."""
+    assigned = {arg.arg for arg in ast.walk(function.args) if isinstance(arg, ast.arg)}
+    loaded = set()
+    for node in ast.walk(function):
+        if isinstance(node, ast.Name):
+            (loaded if isinstance(node.ctx, ast.Load) else assigned).add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and node is not function:
+            assigned.add(node.name)
+    return loaded - assigned - set(dir(builtins))
+
+def _as_array(value: Any) -> Any:
+    # Numba converts a list argument on every call; an array is passed as it is
+    if isinstance(value, list) and value:
+        try:
+            array = np.asarray(value)
+        except ValueError:  # Ragged nested lists
+            return value
+        if array.dtype.kind in 'biuf':
+            return array
+    return value
+
+def _array_args(args: List[Any]) -> List[Any]:
+    """Convert lists of numbers, and rectangular lists of lists of numbers, to NumPy arrays."""
+    return [_as_array(arg) for arg in args]
+
+def _same_result(expected: Any, actual: Any, rtol: float = 1e-9) -> bool:
+    # Compiled code may sum floating-point numbers in another order, so numbers only need to be close
+    numeric = (int, float, complex, np.number, np.ndarray, list, tuple)
+    try:
+        if isinstance(expected, numeric) and isinstance(actual, numeric):
+            expected_array, actual_array = _as_array(expected), _as_array(actual)
+            if isinstance(expected_array, (np.ndarray, np.number, int, float, complex)) and \
+                    isinstance(actual_array, (np.ndarray, np.number, int, float, complex)):
+                expected_array, actual_array = np.asarray(expected_array), np.asarray(actual_array)
+                return expected_array.shape == actual_array.shape and \
+                    bool(np.allclose(expected_array, actual_array, rtol=rtol, equal_nan=True))
+        if isinstance(expected, (list, tuple)) and isinstance(actual, (list, tuple)):
+            return len(expected) == len(actual) and all(_same_result(e, a, rtol) for e, a in zip(expected, actual))
+        return bool(expected == actual)
+    except Exception:
+        return False
+
+def _median_time(function: Callable, args: List[Any], repeats: int, copy_args: bool) -> float:
+    timings = []
+    for _ in range(repeats):
+        call_args = copy.deepcopy(args) if copy_args else args
+        start = time.perf_counter()
+        function(*call_args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+class JitRegistry:
+    """
+    Registry of JIT-compiled kernels with an on-disk cache, a correctness check and a fallback.
+
+    A function is registered from its source and keyed by its name and a digest of that source, so
+    functions of the same name from different modules, or different versions of one function,
+    never share an entry. It is then compiled with sample arguments, checked
+    against the plain Python version on the same arguments, and timed. The verdict is saved with
+    the registry, so later processes know without trying again whether to use the compiled
+    kernel or the Python function. Anything that goes wrong (Numba missing, unsupported code,
+    different results, no speedup) falls back to the Python function.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIRECTORY):
+        """
+        Args:
+            directory (str): Where the kernel modules, their compiled code and the registry are kept.
+        """
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'registry.json')
+        os.makedirs(directory, exist_ok=True)
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        self._modules: Dict[str, Any] = {}
+
+    def _save(self) -> None:
+        temporary = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.index_path)
+
+    def register(self, source: str, name: str) -> Dict[str, Any]:
+        """
+        Add a function to the registry.
+
+        Args:
+            source (str): Source code containing the function, e.g. a whole analysed module.
+            name (str): The name of a top-level function in it.
+
+        Returns:
+            Dict[str, Any]: The function's entry: its registry 'key', 'name', source 'digest' and
+            kernel 'module' file, and after compile, its 'status' ('jit' or 'fallback'), the
+            'reason' for a fallback and the timings.
+        """
+        tree = ast.parse(source)
+        function = next((node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name == name), None)
+        if function is None:
+            raise ValueError(f"No top-level function named {name}")
+        function.decorator_list = []
+        function_source = ast.unparse(function)
+        digest = hashlib.sha256(function_source.encode()).hexdigest()[:16]
+        key = f"{name}_{digest}"
+        if key in self.entries:
+            return self.entries[key]
+
+        module_path = os.path.join(self.directory, f"kernel_{key}.py")
+        if not os.path.exists(module_path):
+            # Written once: rewriting it would invalidate the compiled code cached for it
+            with open(module_path, 'w') as f:
+                f.write(f"{KERNEL_HEADER}\n{function_source}\n")
+        entry = {'key': key, 'name': name, 'digest': digest, 'module': module_path, 'status': None, 'reason': None}
+        free = _free_names(function) - KERNEL_GLOBALS
+        if free:
+            entry.update(status='fallback', reason=f"depends on module globals: {', '.join(sorted(free))}")
+        self.entries[key] = entry
+        self._save()
+        return entry
+
+    def _load(self, key: str) -> Any:
+        if key not in self._modules:
+            entry = self.entries[key]
+            module_name = f"jit_kernel_{key}"
+            spec = importlib.util.spec_from_file_location(module_name, entry['module'])
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[module_name] = module
+            spec.loader.exec_module(module)
+            self._modules[key] = module
+        return self._modules[key]
+
+    def python_function(self, key: str) -> Callable:
+        """Get the plain Python version of a registered function, given its registry key."""
+        return getattr(self._load(key), self.entries[key]['name'])
+
+    def kernel(self, key: str) -> Callable:
+        """
+        Get the best version of a registered function: the compiled kernel if it was verified, the Python function otherwise.
+
+        Args:
+            key (str): The function's registry key, as returned by register.
+
+        Returns:
+            Callable: The function to call.
+        """
+        entry = self.entries[key]
+        name = entry['name']
+        module = self._load(key)
+        if entry['status'] != 'jit' or njit is None:
+            return getattr(module, name)
+        if not hasattr(module, '_kernel'):
+            module._kernel = njit(cache=True)(getattr(module, name))
+        if not entry.get('array_args'):
+            return module._kernel
+        compiled = module._kernel
+
+        def call(*args):
+            return compiled(*_array_args(args))
+
+        call.__name__ = name
+        return call
+
+    def compile(self, key: str, args: List[Any], repeats: int = 5) -> Dict[str, Any]:
+        """
+        Compile a registered function, check it against the Python version and time both.
+
+        Args:
+            key (str): The function's registry key, as returned by register.
+            args (List[Any]): Sample arguments; each call gets its own copy.
+            repeats (int): Calls timed per version for the steady-state times.
+
+        Returns:
+            Dict[str, Any]: The updated entry, with 'first_call' (compiling or loading the cached
+            kernel, plus one call), 'cache_hit', 'jit_time' and 'python_time' (steady-state
+            seconds per call), 'speedup', and 'array_args', whether lists are passed to the
+            kernel as NumPy arrays.
+        """
+        entry = self.entries[key]
+        if entry['status'] == 'fallback' and entry['reason'].startswith('depends on module globals'):
+            return entry
+        entry.update(status=None, reason=None, array_args=False)
+        python_function = self.python_function(key)
+        try:
+            python_args = copy.deepcopy(args)
+            expected = python_function(*python_args)
+            # Functions that modify their arguments need a fresh copy for every call
+            mutates = not all(_same_result(before, after) for before, after in zip(args, python_args))
+            entry['python_time'] = _median_time(python_function, args, repeats, mutates)
+        except Exception as e:
+            entry.update(status='fallback', reason=f"the Python function failed: {type(e).__name__}: {e}")
+            self._save()
+            return entry
+        if njit is None:
+            entry.update(status='fallback', reason="numba is not installed")
+            self._save()
+            return entry
+
+        module = self._load(key)
+        kernel = module._kernel = njit(cache=True)(python_function)
+        # Lists become arrays, unless the function modifies them: the caller would not see the changes
+        candidates = [args]
+        if not mutates and any(converted is not arg for converted, arg in zip(_array_args(args), args)):
+            candidates.insert(0, _array_args(args))
+        for call_args in candidates:
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    kernel_args = copy.deepcopy(call_args) if mutates else call_args
+                    start = time.perf_counter()
+                    actual = kernel(*kernel_args)
+                    entry['first_call'] = time.perf_counter() - start
+                    entry['cache_hit'] = bool(sum(kernel.stats.cache_hits.values()))
+                    entry['jit_time'] = _median_time(kernel, call_args, repeats, mutates)
+                entry['array_args'] = call_args is not args
+                break
+            except Exception as e:
+                message = str(e).strip().splitlines()[0] if str(e).strip() else ''
+                entry.update(status='fallback', reason=f"numba could not compile it: {type(e).__name__}: {message}")
+        else:
+            self._save()
+            return entry
+
+        entry.update(status=None, reason=None)
+        entry['speedup'] = entry['python_time'] / entry['jit_time'] if entry['jit_time'] > 0 else None
+        if not _same_result(expected, actual) or not all(map(_same_result, python_args, kernel_args)):
+            entry.update(status='fallback', reason="the compiled kernel returns a different result")
+        elif entry['jit_time'] >= entry['python_time']:
+            entry.update(status='fallback', reason="the compiled kernel is not faster")
+        else:
+            entry['status'] = 'jit'
+        self._save()
+        return entry
+
+def _hotspot_worker(directory: str, source: str, names: List[str], size: int,
+                    limits: Dict[str, Optional[int]], conn) -> None:
+    limit_resources(limits)
+    # Imported here, as rewrite_rules is only needed to build sample arguments
+    from rewrite_rules import make_sample_args
+    registry = JitRegistry(directory)
+    tree = ast.parse(source)
+    functions = {node.name: node for node in tree.body if isinstance(node, ast.FunctionDef)}
+    report = {}
+    workdir = tempfile.mkdtemp(prefix='jit_check_')
+    try:
+        for name in names:
+            if name not in functions:
+                continue
+            try:
+                entry = registry.register(source, name)
+                args = make_sample_args(functions[name], size, workdir)
+                if args is None:
+                    entry.update(status='fallback', reason="cannot generate sample arguments")
+                elif entry['status'] != 'fallback':
+                    entry = registry.compile(entry['key'], args)
+            except Exception as e:
+                entry = {'name': name, 'status': 'fallback', 'reason': f"{type(e).__name__}: {e}"}
+            report[name] = entry
+        registry._save()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    conn.send(report)
+    conn.close()
+
+def jit_hotspots(source: str, names: Set[str], size: int = 1000, directory: str = DEFAULT_CACHE_DIRECTORY,
+                 timeout: float = 120.0, limits: Optional[Dict[str, Optional[int]]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Try to JIT-compile hot functions of analysed code, e.g. those selected by sampling_profiler.hot_functions.
+
+    The functions run with sample arguments of the given size, in a separate process, since the
+    analysed code is not trusted.
+
+    Args:
+        source (str): Source code of the module containing the functions.
+        names (Set[str]): Names of the top-level functions to compile.
+        size (int): Input size of the sample arguments.
+        directory (str): The registry's cache directory.
+        timeout (float): Seconds before the attempt is abandoned.
+        limits (Dict[str, Optional[int]], optional): CPU time, memory and file size limits for the
+            process (see script_runner.limit_resources). Defaults to DEFAULT_LIMITS.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: The registry entry of each function (see JitRegistry.compile).
+    """
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_hotspot_worker,
+                                      args=(directory, source, sorted(names), size,
+                                            DEFAULT_LIMITS if limits is None else limits, child_conn), daemon=True)
+    process.start()
+    child_conn.close()
+    try:
+        if parent_conn.poll(timeout):
+            return parent_conn.recv()
+        return {name: {'name': name, 'status': 'fallback', 'reason': f"timed out after {timeout}s"} for name in names}
+    except EOFError:
+        return {name: {'name': name, 'status': 'fallback', 'reason': "compile process crashed"} for name in names}
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        parent_conn.close()
 
 if __name__ == "__main__":
-    n = 100_000_000  # We'll use a large number to really test the speed improvements
-    # Benchmark the compute_sum function to see how fast it is
-    benchmark(compute_sum, n)
-    # Benchmark the compute_sum_numpy function to see how it compares
-    benchmark(compute_sum_numpy, n)
+    parser = argparse.ArgumentParser(description="Benchmark the JIT examples, or JIT-compile functions of a file.")
+    parser.add_argument('file', nargs='?', help="A Python file whose functions to compile")
+    parser.add_argument('functions', nargs='*', help="Names of the functions to compile")
+    parser.add_argument('--size', type=int, default=1000, help="Input size of the sample arguments")
+    args = parser.parse_args()
 
+    if args.file:
+        with open(args.file) as f:
+            report = jit_hotspots(f.read(), set(args.functions), args.size)
+        for name, entry in report.items():
+            if entry['status'] == 'jit':
+                print(f"{name}: compiled, {entry['speedup']:.1f}x faster "
+                      f"(first call {entry['first_call']:.3f}s, cache {'hit' if entry['cache_hit'] else 'miss'})")
+            else:
+                print(f"{name}: kept as Python ({entry['reason']})")
+    else:
+        n = 100_000_000  # We'll use a large number to really test the speed improvements
+        # Benchmark the compute_sum function to see how fast it is
+        benchmark(compute_sum, n)
+        # Benchmark the compute_sum_numpy function to see how it compares
+        benchmark(compute_sum_numpy, n)
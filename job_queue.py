@@ -0,0 +1,439 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+from config_parser import load_config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = './.refactor_earth_cache/jobs.sqlite'
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+ACTIVE = (QUEUED, RUNNING)
+FINISHED = (DONE, FAILED, CANCELLED)
+COLUMNS = ('id', 'kind', 'args', 'status', 'progress', 'message', 'result', 'error', 'owner',
+           'cancel_requested', 'subscribers', 'submitted', 'started', 'finished')
+
+class JobCancelled(Exception):
+    """Raised inside a job when cancellation was requested."""
+
+class JobContext:
+    """
+    Passed to a running job, to report its progress and to notice cancellation.
+    """
+
+    def __init__(self, queue: 'JobQueue', job_id: str):
+        self.queue = queue
+        self.job_id = job_id
+        self._last_write = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether cancellation of the job was requested, by this process or another."""
+        return self.queue._cancel_requested(self.job_id)
+
+    def check(self) -> None:
+        """
+        Stop the job if it was cancelled.
+
+        Raises:
+            JobCancelled: If cancellation was requested.
+        """
+        if self.cancelled:
+            raise JobCancelled(self.job_id)
+
+    def progress(self, fraction: float, message: Optional[str] = None) -> None:
+        """
+        Report how far the job has got. Also a cancellation point.
+
+        Updates are written at most every `progress_interval` seconds, so jobs can report often.
+
+        Args:
+            fraction (float): Between 0 and 1.
+            message (str, optional): What the job is doing, for display.
+
+        Raises:
+            JobCancelled: If cancellation was requested.
+        """
+        self.check()
+        now = time.monotonic()
+        if now - self._last_write >= self.queue.progress_interval or fraction >= 1:
+            self._last_write = now
+            self.queue._update(self.job_id, progress=min(max(fraction, 0.0), 1.0), message=message)
+
+class JobQueue:
+    """
+    Runs registered jobs on a pool of worker threads and keeps their state in SQLite.
+
+    A job is identified by its kind and arguments, so submitting a job that is already queued or
+    running returns the existing one instead of starting the work again; the job counts its
+    submitters and is only cancelled once all of them have cancelled it. A finished job's
+    result is reused until it is older than the kind's `max_age`. Callers poll `get` for the
+    status, progress and result, which is cheap enough to do on every Streamlit rerun.
+
+    Several processes can share the database file: a job queued or running in another live
+    process on the same host is not started again, and jobs left behind by a process that exited
+    are marked failed.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH, workers: int = 2, retention: float = 3600.0,
+                 progress_interval: float = 0.25):
+        """
+        Open (or create) the job database and start the worker pool.
+
+        Args:
+            path (str): Path to the SQLite database file.
+            workers (int): Number of jobs run at the same time.
+            retention (float): Seconds finished jobs are kept, and by default reused.
+            progress_interval (float): Minimum seconds between stored progress updates of a job.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.workers = workers
+        self.retention = retention
+        self.progress_interval = progress_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.coalesced = 0
+        self.reused = 0
+        self._functions: Dict[str, Callable[..., Any]] = {}
+        self._max_age: Dict[str, Optional[float]] = {}
+        self._futures: Dict[str, Future] = {}
+        self._cancelled = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, args TEXT NOT NULL, status TEXT NOT NULL, "
+            "progress REAL NOT NULL, message TEXT, result TEXT, error TEXT, owner TEXT NOT NULL, "
+            "cancel_requested INTEGER NOT NULL, subscribers INTEGER NOT NULL DEFAULT 1, submitted REAL NOT NULL, "
+            "started REAL, finished REAL)"
+        )
+        # Databases created before submitters were counted
+        if 'subscribers' not in {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN subscribers INTEGER NOT NULL DEFAULT 1")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished)")
+        self._conn.commit()
+        self._recover()
+
+    def register(self, kind: str, function: Callable[..., Any], max_age: Optional[float] = None) -> None:
+        """
+        Make a kind of job available for submission.
+
+        Args:
+            kind (str): Name of the job kind.
+            function (Callable[..., Any]): Called as function(context, *args) on a worker thread;
+                returns a JSON-serialisable result.
+            max_age (float, optional): Seconds a finished result is reused for identical submissions;
+                defaults to the retention. 0 always runs the job again.
+        """
+        self._functions[kind] = function
+        self._max_age[kind] = max_age
+
+    @staticmethod
+    def job_id(kind: str, args: tuple) -> str:
+        """
+        Identify a job by its kind and arguments.
+
+        Args:
+            kind (str): The job kind.
+            args (tuple): JSON-serialisable arguments.
+
+        Returns:
+            str: A hex SHA-256 digest.
+        """
+        payload = json.dumps({'kind': kind, 'args': list(args)}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def submit(self, kind: str, *args: Any, force: bool = False) -> str:
+        """
+        Queue a job, unless an identical one is already queued, running or recently finished.
+
+        Args:
+            kind (str): A registered job kind.
+            *args: JSON-serialisable arguments for the job function.
+            force (bool): Run the job again even if a finished result could be reused.
+
+        Returns:
+            str: The job's id.
+
+        Raises:
+            KeyError: If the kind is not registered.
+        """
+        if kind not in self._functions:
+            raise KeyError(f"Unknown job kind: {kind}")
+        job_id = self.job_id(kind, args)
+        now = time.time()
+        max_age = self._max_age[kind]
+        max_age = self.retention if max_age is None else max_age
+        with self._lock:
+            self._prune(now)
+            row = self._row(job_id)
+            if row is not None and row['status'] in ACTIVE and self._alive(row):
+                if row['cancel_requested']:
+                    # Every earlier submitter cancelled it; this one withdraws the request and is now
+                    # the only submitter. A run that already stopped is started again (see _run).
+                    self._set(job_id, cancel_requested=0, subscribers=1)
+                    self._cancelled.discard(job_id)
+                else:
+                    self._conn.execute("UPDATE jobs SET subscribers = subscribers + 1 WHERE id = ?", (job_id,))
+                    self._conn.commit()
+                self.coalesced += 1
+                return job_id
+            if row is not None and row['status'] == DONE and not force and now - row['finished'] < max_age:
+                self.reused += 1
+                return job_id
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO jobs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                (job_id, kind, json.dumps(list(args), default=str), QUEUED, 0.0, None, None, None, self.owner,
+                 0, 1, now, None, None),
+            )
+            self._conn.commit()
+            self._cancelled.discard(job_id)
+            self._futures[job_id] = self._executor.submit(self._run, job_id, kind, args)
+        logger.info("Queued %s job %s", kind, job_id[:12])
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a job.
+
+        Args:
+            job_id (str): The id returned by `submit`.
+
+        Returns:
+            Optional[Dict[str, Any]]: The job's 'id', 'kind', 'status', 'progress', 'message',
+            'result', 'error' and timestamps, or None if it is unknown or was pruned.
+        """
+        with self._lock:
+            row = self._row(job_id)
+        if row is None:
+            return None
+        row['args'] = json.loads(row['args'])
+        row['result'] = json.loads(row['result']) if row['result'] is not None else None
+        return row
+
+    def wait(self, job_id: str, timeout: Optional[float] = None, interval: float = 0.1) -> Optional[Dict[str, Any]]:
+        """
+        Block until a job has finished, for scripts; the dashboard polls `get` instead.
+
+        Args:
+            job_id (str): The job's id.
+            timeout (float, optional): Seconds to wait at most.
+            interval (float): Seconds between polls.
+
+        Returns:
+            Optional[Dict[str, Any]]: The job, as from `get`.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        job = self.get(job_id)
+        while job is not None and job['status'] in ACTIVE and (deadline is None or time.monotonic() < deadline):
+            time.sleep(interval)
+            job = self.get(job_id)
+        return job
+
+    def cancel(self, job_id: str, force: bool = False) -> bool:
+        """
+        Cancel a job on behalf of one of its submitters.
+
+        A queued job never starts; a running job stops at its next progress report or cancellation
+        check. A job submitted several times keeps running until every submission was cancelled,
+        and submitting it again before it stopped withdraws the cancellation.
+
+        Args:
+            job_id (str): The job's id.
+            force (bool): Cancel the job even if other submitters are still waiting for it.
+
+        Returns:
+            bool: Whether the job is being cancelled; False if it had already finished, or if other
+            submitters are still waiting for it.
+        """
+        with self._lock:
+            row = self._row(job_id)
+            if row is None or row['status'] not in ACTIVE:
+                return False
+            if not force:
+                leaving = self._conn.execute(
+                    "UPDATE jobs SET subscribers = subscribers - 1 WHERE id = ? AND subscribers > 1", (job_id,))
+                self._conn.commit()
+                if leaving.rowcount:
+                    return False
+            future = self._futures.get(job_id)
+            if future is not None and future.cancel():
+                self._futures.pop(job_id, None)
+                self._set(job_id, status=CANCELLED, finished=time.time())
+                return True
+            self._cancelled.add(job_id)
+            self._set(job_id, cancel_requested=1)
+        return True
+
+    def list(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        List the most recently submitted jobs, without their arguments and results.
+
+        Args:
+            limit (int): Maximum number of jobs.
+
+        Returns:
+            List[Dict[str, Any]]: Jobs, newest first.
+        """
+        columns = [c for c in COLUMNS if c not in ('args', 'result')]
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(columns)} FROM jobs ORDER BY submitted DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Count jobs by status, plus submissions served by an existing job in this process.
+
+        Returns:
+            Dict[str, int]: A count per status, and 'coalesced' and 'reused'.
+        """
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return dict({status: counts.get(status, 0) for status in ACTIVE + FINISHED},
+                    coalesced=self.coalesced, reused=self.reused)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Cancel queued and running jobs and stop the workers.
+
+        Args:
+            wait (bool): Whether to wait for running jobs to stop, and then close the database.
+        """
+        for job_id in list(self._futures):
+            self.cancel(job_id, force=True)
+        self._executor.shutdown(wait=wait)
+        if wait:
+            with self._lock:
+                self._conn.close()
+
+    def _run(self, job_id: str, kind: str, args: tuple) -> None:
+        context = JobContext(self, job_id)
+        restart = False
+        try:
+            if context.cancelled:
+                raise JobCancelled(job_id)
+            self._update(job_id, status=RUNNING, started=time.time())
+            result = self._functions[kind](context, *args)
+            self._update(job_id, status=DONE, progress=1.0, result=json.dumps(result, default=str),
+                         finished=time.time())
+            logger.info("Finished %s job %s", kind, job_id[:12])
+        except JobCancelled:
+            if self._cancel_requested(job_id):
+                self._update(job_id, status=CANCELLED, finished=time.time())
+                logger.info("Cancelled %s job %s", kind, job_id[:12])
+            else:
+                restart = True  # Submitted again after the job saw the cancellation
+        except Exception as e:
+            self._update(job_id, status=FAILED, error=str(e) or type(e).__name__, finished=time.time())
+            logger.exception("%s job %s failed", kind, job_id[:12])
+        finally:
+            with self._lock:
+                self._futures.pop(job_id, None)
+                self._cancelled.discard(job_id)
+                if restart:
+                    self._set(job_id, status=QUEUED, progress=0.0, message=None, started=None)
+                    self._futures[job_id] = self._executor.submit(self._run, job_id, kind, args)
+
+    def _cancel_requested(self, job_id: str) -> bool:
+        if job_id in self._cancelled:
+            return True
+        with self._lock:
+            row = self._conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is None or bool(row[0])
+
+    def _row(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn.execute(f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row is not None else None
+
+    def _set(self, job_id: str, **fields: Any) -> None:
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        self._conn.commit()
+
+    def _update(self, job_id: str, **fields: Any) -> None:
+        with self._lock:
+            self._set(job_id, **fields)
+
+    def _alive(self, row: Dict[str, Any]) -> bool:
+        if row['owner'] == self.owner:
+            return row['id'] in self._futures
+        host, _, pid = row['owner'].rpartition(':')
+        if host != socket.gethostname():
+            return True  # Can't tell from here; assume the other host is still working on it
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, ValueError):
+            pass
+        return True
+
+    def _recover(self) -> None:
+        # Jobs of a process that exited while they were queued or running will never finish
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE status IN (?, ?)", ACTIVE
+            ).fetchall()
+            for row in rows:
+                row = dict(zip(COLUMNS, row))
+                if not self._alive(row):
+                    self._set(row['id'], status=FAILED, error="Interrupted: the process running the job exited",
+                              finished=time.time())
+
+    def _prune(self, now: float) -> None:
+        self._conn.execute(
+            "DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ? AND status IN (?, ?, ?)",
+            (now - self.retention, *FINISHED),
+        )
+
+def job_queue(config: Dict[str, Any]) -> JobQueue:
+    """
+    Create the job queue described by the 'jobs' section of config.yaml.
+
+    Args:
+        config (Dict[str, Any]): The loaded configuration.
+
+    Returns:
+        JobQueue: The queue, with no job kinds registered yet.
+    """
+    settings = config.get('jobs', {})
+    return JobQueue(
+        path=settings.get('path', DEFAULT_PATH),
+        workers=settings.get('workers', 2),
+        retention=settings.get('retention', 3600),
+        progress_interval=settings.get('progress_interval', 0.25),
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List or cancel the dashboard's background jobs.")
+    parser.add_argument('--limit', type=int, default=20, help="Number of recent jobs to list")
+    parser.add_argument('--cancel', metavar='JOB_ID', help="Cancel a queued or running job (an id prefix is enough)")
+    args = parser.parse_args()
+
+    queue = job_queue(load_config('config.yaml'))
+    if args.cancel:
+        matches = [job['id'] for job in queue.list(limit=1000) if job['id'].startswith(args.cancel)]
+        if len(matches) != 1:
+            parser.error(f"{len(matches)} jobs match {args.cancel!r}")
+        print("Cancellation requested." if queue.cancel(matches[0], force=True) else "The job has already finished.")
+    else:
+        for job in queue.list(args.limit):
+            submitted = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['submitted']))
+            detail = job['error'] or job['message'] or ''
+            print(f"{job['id'][:12]}  {submitted}  {job['kind']:<16} {job['status']:<9} "
+                  f"{job['progress']:>4.0%}  {detail}")
+        print(queue.stats())
+    queue.shutdown(wait=False)
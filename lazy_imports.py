@@ -0,0 +1,78 @@
+import importlib
+import subprocess
+import sys
+import threading
+
+class LazyModule:
+    """
+    Stands in for a module and imports it the first time one of its attributes is used.
+
+    This keeps heavy dependencies (streamlit, plotly, transformers, ...) off the import path of
+    tools that only need the lightweight parts of a module.
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): The dotted module name, e.g. 'plotly.graph_objects'.
+        """
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    Get a module that is only imported when first used.
+
+    Args:
+        name (str): The dotted module name.
+
+    Returns:
+        LazyModule: A proxy that forwards attribute access to the real module.
+    """
+    return LazyModule(name)
+
+def measure_import_time(module_name: str, python: str = sys.executable) -> float:
+    """
+    Measure how long a cold import of a module takes in a fresh interpreter.
+
+    Args:
+        module_name (str): The module to import.
+        python (str): The interpreter to use. Defaults to the current one.
+
+    Returns:
+        float: The import time in seconds.
+    """
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        f"import {module_name}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    output = subprocess.run([python, '-c', code], check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    # Import-time budget check, e.g. `python lazy_imports.py metrics 1.0`
+    module = sys.argv[1] if len(sys.argv) > 1 else 'metrics'
+    budget = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    elapsed = measure_import_time(module)
+    print(f"import {module}: {elapsed:.3f}s (budget {budget:.3f}s)")
+    sys.exit(0 if elapsed <= budget else 1)
@@ -1,67 +1,149 @@
 import os
-import streamlit as st
-import plotly.graph_objects as go
-import plotly.express as px
-import pandas as pd
-import ast
-import git
-from git import Repo
-from git.exc import NoSuchPathError, GitCommandError
 import json
 import logging
 import re
 import math
+import subprocess
+import threading
+import time
 from collections import Counter
-from memory_profiler import memory_usage, profile
-from codecarbon import EmissionsTracker
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+from concurrent.futures import TimeoutError as FutureTimeout
+from functools import lru_cache
+from lazy_imports import lazy_import
+from analysis_cache import AnalysisCache
+from generation_cache import GenerationCache, directory_fingerprint
+from job_queue import ACTIVE, DONE, FAILED, job_queue
+from rewrite_rules import optimize_source
+from config_parser import load_config
+from logging_config import setup_logging
+from repo_mirror import mirror_cache, same_repository
+from tracking_session import configure as configure_tracking, track
 
-# Load our fine-tuned CodeBERT model for generating and refactoring code
+# Heavy dependencies are imported on first use, so importing this module for the static metrics stays cheap
+st = lazy_import('streamlit')
+go = lazy_import('plotly.graph_objects')
+px = lazy_import('plotly.express')
+pd = lazy_import('pandas')
+git = lazy_import('git')
+transformers = lazy_import('transformers')
+incremental_analysis = lazy_import('incremental_analysis')
+inference_scheduler = lazy_import('inference_scheduler')
+cpu_inference = lazy_import('cpu_inference')
+
+# Our fine-tuned CodeBERT model for generating and refactoring code
 model_name = "finetunecodebert"
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-model = AutoModelForCausalLM.from_pretrained(model_name)
-code_generator = pipeline("text-generation", model=model, tokenizer=tokenizer)
-
-# Set up logging to keep track of our app’s activities
-logging.basicConfig(filename='sustainability_dashboard.log', level=logging.INFO, format='%(asctime)s %(levelname)s:%(message)s')
-
-# Function to track emissions with CodeCarbon
-def track_emissions(func):
-    def wrapper(*args, **kwargs):
-        tracker = EmissionsTracker()
-        tracker.start()
-        result = func(*args, **kwargs)
-        emissions = tracker.stop()
-        return result, emissions
-    return wrapper
-
-# Function to track and log function details like memory usage, time, and emissions
-def function_tracker(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        mem_usage_before = memory_usage()[0]
-        result, emissions = track_emissions(func)(*args, **kwargs)
-        mem_usage_after = memory_usage()[0]
-        duration = time.time() - start_time
-        mem_diff = mem_usage_after - mem_usage_before
-
-        logging.info(f"Function {func.__name__}: Duration: {duration}s, Memory Usage: {mem_diff} MiB, Emissions: {emissions} CO2eq")
-        return result
-    return wrapper
-
-@function_tracker
+_model_lock = threading.Lock()
+
+GENERATION_KWARGS = {'do_sample': False}
+
+@lru_cache(maxsize=None)
+def _load_inference_scheduler():
+    # On CPU-only hosts the model can be quantized or compiled, with threads pinned per worker
+    model, tokenizer, mode = cpu_inference.load_model(model_name, load_config('config.yaml').get('inference', {}))
+    return inference_scheduler.InferenceScheduler(model, tokenizer, generation_kwargs=GENERATION_KWARGS), mode
+
+def get_inference_scheduler():
+    # The model is loaded once per process, on the first generation request, and every
+    # generation path shares its batching queue
+    with _model_lock:
+        return _load_inference_scheduler()[0]
+
+def get_served_mode():
+    # An int8 or compiled model is only served if it passes the agreement check against fp32,
+    # which needs the model; fp32 is known from the config alone
+    if load_config('config.yaml').get('inference', {}).get('mode', 'fp32') == 'fp32':
+        return 'fp32'
+    with _model_lock:
+        return _load_inference_scheduler()[1]
+
+@lru_cache(maxsize=None)
+def get_model_id():
+    # Reading the config is enough to identify the weights, without loading them. A local directory
+    # has no commit hash, so its files identify it, and a retrained model doesn't reuse old responses.
+    config = transformers.AutoConfig.from_pretrained(model_name)
+    revision = getattr(config, '_commit_hash', None)
+    if revision is None and os.path.isdir(model_name):
+        revision = directory_fingerprint(model_name)
+    # Quantized outputs may differ from fp32 ones, so each served mode has its own responses
+    return f"{model_name}@{revision or config.name_or_path}:{get_served_mode()}"
+
+@lru_cache(maxsize=None)
+def get_generation_cache():
+    # Responses are deterministic for a given model, input and parameters, so reruns reuse them
+    return GenerationCache()
+
+def cached_generate(task, text, prompt, factor=None, minimum=64, maximum=512, check=None):
+    # With a factor, the token budget scales with the input; otherwise it is fixed at `maximum`.
+    # `check` is called while waiting for the model and may raise to stop waiting, e.g. JobContext.check
+    params = dict(GENERATION_KWARGS, factor=factor, minimum=minimum, maximum=maximum)
+
+    def generate():
+        max_new_tokens = generation_budget(text, factor, minimum, maximum) if factor else maximum
+        future = get_inference_scheduler().submit(prompt, max_new_tokens=max_new_tokens)
+        try:
+            while check is not None:
+                try:
+                    return future.result(timeout=0.25)
+                except FutureTimeout:
+                    check()
+            return future.result()
+        except BaseException:
+            # A request still queued is dropped; one already generating finishes unobserved
+            future.cancel()
+            raise
+
+    return get_generation_cache().get_or_generate(get_model_id(), task, text, generate, params, check)
+
+def generation_budget(code, factor=1.5, minimum=64, maximum=1024):
+    # A rewrite of some code needs about as many tokens as the code itself, plus some slack
+    needed = int(get_inference_scheduler().count_tokens(code) * factor) + minimum
+    return min(needed, maximum)
+
+@lru_cache(maxsize=None)
+def get_mirror_cache():
+    # Repositories are cloned once into a shared local mirror; each analysis gets a worktree of it
+    return mirror_cache(load_config('config.yaml'))
+
+@lru_cache(maxsize=None)
+def get_analysis_cache():
+    # Analysis results are cached on disk, so unchanged code is never analyzed twice
+    return AnalysisCache()
+
+# Functions decorated with @track share one process-wide tracking session: a single energy
+# sampler, sampled timings and memory, and per-function histograms that are logged at exit
+@track
 def your_function():
     # Example function logic
     for i in range(1000000):
         pass
 
+@lru_cache(maxsize=None)
+def get_job_queue():
+    # One worker pool per dashboard process, shared by every session: the script thread only submits
+    # and polls, and identical requests from several users run once
+    config = load_config('config.yaml')
+    queue = job_queue(config)
+    queue.register('analyze_code', analysis_job)
+    # A range like HEAD~1..HEAD moves when the repository does, so it is reanalyzed as often as the mirror is fetched
+    queue.register('analyze_commits', commit_analysis_job,
+                   max_age=config.get('repository', {}).get('refresh_interval', 300))
+    queue.register('generate', generation_job)
+    queue.register('refactor', refactor_job)
+    return queue
+
 # Streamlit Dashboard
 def main():
     st.set_page_config(layout="wide")
+    config = load_config('config.yaml')
+    # Set up logging to keep track of our app’s activities
+    setup_logging(config)
+    configure_tracking(config)
     st.title("Enhanced Code Sustainability Dashboard with CodeBERT")
 
     # Set up the sidebar for user inputs and actions
     configure_sidebar()
+    running = poll_jobs()
+    display_refactored_code()
 
     # Display the main sections of the dashboard
     display_primary_metrics()
@@ -73,24 +155,29 @@ def main():
     display_benchmarking_and_goals()
     display_expanded_metrics()
 
+    if running:
+        # Rerun to pick up progress and results; widget interactions interrupt the wait
+        time.sleep(config.get('jobs', {}).get('poll_interval', 1.0))
+        st.rerun()
+
 def configure_sidebar():
     st.sidebar.header("Input Code")
     user_code = st.sidebar.text_area("Enter your Python code here:", height=200, value=st.session_state.get('user_code', ''))
     if st.sidebar.button("Analyze Code"):
         if user_code.strip():
             st.session_state.user_code = user_code
-            analyze_code(user_code)
+            submit_job('analyze_code', user_code)
         else:
             st.sidebar.error("Please enter some code to analyze.")
 
     st.sidebar.header("Git Integration")
     repo_url = st.sidebar.text_input("Repository URL:", "https://github.com/ShaliniAnandaPhD/Temporal--Odyssey")
-    repo_path = os.path.join(os.getcwd(), repo_url.split('/')[-1].replace('.git', ''))
+    # One checkout per repository, so repositories with the same name don't share a directory
+    repo_path = os.path.join(os.getcwd(), os.path.basename(get_mirror_cache().mirror_path(repo_url))[:-len('.git')])
 
     if st.sidebar.button("Analyze Last Commit"):
         if repo_url:
-            clone_or_open_repo(repo_url, repo_path)
-            analyze_last_commit(repo_path)
+            submit_job('analyze_commits', repo_url, repo_path, 'HEAD~1..HEAD')
         else:
             st.sidebar.error("Please enter a repository URL.")
 
@@ -98,17 +185,16 @@ def configure_sidebar():
     description = st.sidebar.text_area("Enter a description for code generation:", height=100)
     if st.sidebar.button("Generate Code"):
         if description:
-            generated_code = generate_sustainable_code(description)
-            st.session_state.generated_code = generated_code
-            st.sidebar.code(generated_code, language='python')
-            analyze_code(generated_code)
+            submit_job('generate', description)
         else:
             st.sidebar.error("Please enter a description for code generation.")
+    if 'generated_code' in st.session_state:
+        st.sidebar.code(st.session_state.generated_code, language='python')
 
     st.sidebar.header("Refactor Code")
     if st.sidebar.button("Refactor Code"):
         if 'user_code' in st.session_state:
-            refactor_code(st.session_state.user_code)
+            submit_job('refactor', st.session_state.user_code)
         else:
             st.sidebar.error("Please analyze code before refactoring.")
 
@@ -116,43 +202,183 @@ def configure_sidebar():
     if st.sidebar.button("Download Logs"):
         download_logs()
 
-def analyze_code(code):
+JOB_LABELS = {
+    'analyze_code': "Analyzing code",
+    'analyze_commits': "Analyzing commits",
+    'generate': "Generating code",
+    'refactor': "Refactoring code",
+}
+
+def submit_job(kind, *args):
+    # A session follows one job per kind; a new request replaces the one it was waiting for, which is
+    # cancelled unless other sessions still wait for it
+    jobs = st.session_state.setdefault('jobs', {})
+    previous = jobs.get(kind)
+    if previous == get_job_queue().job_id(kind, args):
+        job = get_job_queue().get(previous)
+        if job is not None and job['status'] in ACTIVE:
+            return  # Already following it; submitting again would count this session twice
+    if previous is not None:
+        get_job_queue().cancel(previous)
+    jobs[kind] = get_job_queue().submit(kind, *args)
+
+def poll_jobs():
+    # Shows progress of this session's jobs and applies finished results; returns whether any are still running
+    jobs = st.session_state.setdefault('jobs', {})
+    running = False
+    for kind, job_id in list(jobs.items()):
+        job = get_job_queue().get(job_id)
+        label = JOB_LABELS[kind]
+        if job is None:
+            del jobs[kind]
+        elif job['status'] in ACTIVE:
+            running = True
+            st.sidebar.progress(job['progress'], text=f"{label}: {job['message'] or job['status']}")
+            if st.sidebar.button("Cancel", key=f"cancel_{job_id}") and not get_job_queue().cancel(job_id):
+                # Other sessions still wait for the job, so it keeps running for them; this one stops following it
+                del jobs[kind]
+                st.sidebar.info(f"{label} was cancelled.")
+        else:
+            del jobs[kind]
+            if job['status'] == DONE:
+                JOB_RESULTS[kind](job['result'])
+            elif job['status'] == FAILED:
+                st.sidebar.error(f"{label} failed: {job['error']}")
+            else:
+                st.sidebar.info(f"{label} was cancelled.")
+    return running
+
+def analysis_job(context, code):
+    context.progress(0.0, "Analyzing code")
+    # One traversal computes every metric, per module and per function, unless the code was seen before
+    results = get_analysis_cache().analyze(code)
+    logging.info("Analysis cache: %s", get_analysis_cache().stats())
+    # The results are cached either way; a cancelled job just doesn't report them
+    context.check()
+    return results
+
+def commit_analysis_job(context, repo_url, repo_path, rev_range):
+    cloned = os.path.isdir(get_mirror_cache().mirror_path(repo_url))
+    context.progress(0.0, f"Fetching {repo_url}" if cloned else f"Cloning {repo_url}")
+    clone_or_open_repo(repo_url, repo_path)
+    # Only the functions touched by each commit are re-analyzed; everything else comes from the cache
+    analyzer = incremental_analysis.IncrementalAnalyzer(repo_path, get_analysis_cache())
+    context.check()
+    return analyzer.analyze_range(
+        rev_range, progress=lambda done, total: context.progress(done / total, f"Analyzed {done} of {total} commits"),
+        check=context.check)
+
+def generation_job(context, description):
+    context.progress(0.0, "Generating code")
+    generated_code = generate_sustainable_code(description, check=context.check)
+    context.progress(0.9, "Analyzing the generated code")
+    return {'code': generated_code, 'analysis': analyze_if_valid(generated_code)}
+
+def refactor_job(context, code):
+    context.progress(0.0, "Applying rewrite rules")
+    # Known anti-patterns are fixed by verified rewrite rules; the model only handles what they don't cover
     try:
-        tree = ast.parse(code)
-        st.session_state.time_complexity = calculate_time_complexity(tree)
-        st.session_state.space_complexity = calculate_space_complexity(tree)
-        st.session_state.code_quality = calculate_code_quality(tree)
-        st.session_state.scalability_score = calculate_scalability(tree)
-        st.session_state.maintainability_index = calculate_maintainability_index(tree)
-        st.session_state.test_coverage = calculate_test_coverage(code)
-
-        energy_consumption, carbon_footprint, sustainability_score, energy_by_operation = analyze_energy_and_carbon_footprint(tree)
-
-        st.session_state.energy_consumption = energy_consumption
-        st.session_state.carbon_footprint = carbon_footprint
-        st.session_state.sustainability_score = sustainability_score
-        st.session_state.energy_by_operation = energy_by_operation
-
-        st.success("Code analysis completed successfully.")
-    except Exception as e:
-        st.error(f"Error analyzing code: {str(e)}")
-        logging.error(f"Error analyzing code: {str(e)}")
-
-def generate_sustainable_code(description):
-    prompt = f"Generate sustainable and efficient Python code based on the following description:\n\n{description}\n\nPython code:"
-    generated_code = code_generator(prompt, max_length=1000, num_return_sequences=1)[0]['generated_text']
-    return generated_code.strip()
+        rule_result = optimize_source(code, check=context.check)
+    except SyntaxError:
+        rule_result = {'source': code, 'rewrites': [], 'remaining': []}
+    refactored_code = rule_result['source']
+    applied = sorted({rule for rewrite in rule_result['rewrites'] for rule in rewrite['rules']})
+    if rule_result['remaining'] or not rule_result['rewrites']:
+        context.progress(0.1, "Generating the refactored code")
+        prompt = f"Refactor the following Python code to improve its sustainability and efficiency:\n\n{refactored_code}\n\nRefactored code:"
+        refactored_code = cached_generate('refactor', refactored_code, prompt, factor=1.5, maximum=1024,
+                                          check=context.check)
+    context.progress(0.9, "Analyzing the refactored code")
+    return {'code': refactored_code, 'rules': applied, 'analysis': analyze_if_valid(refactored_code)}
+
+def analyze_if_valid(code):
+    try:
+        return get_analysis_cache().analyze(code)
+    except SyntaxError as e:
+        logging.error("Error analyzing code: %s", e)
+        return None
+
+def apply_analysis(results):
+    if results is None:
+        st.error("Error analyzing code: the code could not be parsed.")
+        return
+    module_metrics = results['module']
+    st.session_state.time_complexity = module_metrics['time_complexity']
+    st.session_state.space_complexity = module_metrics['space_complexity']
+    st.session_state.code_quality = module_metrics['code_quality']
+    st.session_state.scalability_score = module_metrics['scalability_score']
+    st.session_state.maintainability_index = module_metrics['maintainability_index']
+    st.session_state.test_coverage = module_metrics['test_coverage']
+
+    st.session_state.energy_consumption = module_metrics['energy_consumption']
+    st.session_state.carbon_footprint = module_metrics['carbon_footprint']
+    st.session_state.sustainability_score = module_metrics['sustainability_score']
+    st.session_state.energy_by_operation = module_metrics['energy_by_operation']
+    st.session_state.function_metrics = results['functions']
+
+    st.success("Code analysis completed successfully.")
 
-def refactor_code(code):
+def apply_commit_analysis(timeline):
+    st.session_state.commit_timeline = timeline
+    if timeline:
+        latest = timeline[-1]
+        st.session_state.commit_metrics = latest['totals']
+        st.sidebar.success(
+            f"Analyzed {latest['commit'][:8]}: {latest['functions_analyzed']} functions re-analyzed, "
+            f"{latest['functions_reused']} reused."
+        )
+
+def apply_generation(result):
+    st.session_state.generated_code = result['code']
+    st.sidebar.code(result['code'], language='python')
+    apply_analysis(result['analysis'])
+
+def apply_refactor(result):
+    st.session_state.refactored_code = result['code']
+    st.session_state.refactor_rules = result['rules']
+    apply_analysis(result['analysis'])
+
+JOB_RESULTS = {
+    'analyze_code': apply_analysis,
+    'analyze_commits': apply_commit_analysis,
+    'generate': apply_generation,
+    'refactor': apply_refactor,
+}
+
+def display_refactored_code():
+    if 'refactored_code' not in st.session_state:
+        return
     st.subheader("Refactored Code for Improved Sustainability")
-    prompt = f"Refactor the following Python code to improve its sustainability and efficiency:\n\n{code}\n\nRefactored code:"
-    refactored_code = code_generator(prompt, max_length=2000, num_return_sequences=1)[0]['generated_text']
-    st.code(refactored_code, language='python')
-    analyze_code(refactored_code)
+    if st.session_state.refactor_rules:
+        st.caption(f"Rule-based rewrites applied: {', '.join(st.session_state.refactor_rules)}")
+    st.code(st.session_state.refactored_code, language='python')
+
+def clone_or_open_repo(repo_url, repo_path):
+    try:
+        branch = load_config('config.yaml').get('repository', {}).get('branch')
+        get_mirror_cache().checkout(repo_url, repo_path, branch)
+    except FileExistsError:
+        # A clone made before the mirror cache existed is used as it is, if it is a clone of this repository
+        try:
+            repo = git.Repo(repo_path)
+        except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+            repo = None
+        if repo is None or not any(same_repository(remote.url, repo_url) for remote in repo.remotes):
+            raise RuntimeError(f"Error opening repository: {repo_path} exists and is not a clone of {repo_url}")
+        return repo
+    except subprocess.CalledProcessError as e:
+        logging.error("Error opening repository: %s", e.stderr)
+        raise RuntimeError(f"Error opening repository: {e.stderr}") from e
+    return git.Repo(repo_path)
+
+def generate_sustainable_code(description, check=None):
+    prompt = f"Generate sustainable and efficient Python code based on the following description:\n\n{description}\n\nPython code:"
+    generated_code = cached_generate('generate', description, prompt, maximum=512, check=check)
+    return generated_code.strip()
 
 def get_optimization_suggestions(code):
     prompt = f"Provide optimization suggestions to improve the sustainability and efficiency of the following Python code:\n\n{code}\n\nOptimization suggestions:"
-    suggestions = code_generator(prompt, max_length=1000, num_return_sequences=1)[0]['generated_text']
+    suggestions = cached_generate('suggest', code, prompt, factor=0.5, maximum=512)
     return suggestions.split('\n') if suggestions else ["No suggestions available"]
 
 if __name__ == "__main__":
@@ -0,0 +1,480 @@
+import argparse
+import ast
+import hashlib
+import json
+import logging
+import os
+import re
+import statistics
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+from benchmark_harness import mann_whitney_u
+from config_parser import load_config
+from logging_config import setup_logging
+from parallel_optimization import AdaptiveExecutor
+from regression_benchmarks import benchmark_function
+from rewrite_rules import DEFAULT_RULES, FUNCTION_NODES, check_equivalence, rewrite_function
+from script_runner import resource_limits
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOG_FILE = './reports/optimization_log.jsonl'
+# A generator gets the module source, the current best version of a function and the history of
+# earlier iterations, and proposes (label, function source) candidates
+CandidateGenerator = Callable[[str, str, List[Dict[str, Any]]], List[Tuple[str, str]]]
+MODEL_PROMPTS = (
+    "Rewrite the following Python function to use less CPU time and energy. Keep its name, "
+    "signature and behaviour exactly the same.\n\n{code}\n\nOptimized function:\n",
+    "Optimize this Python function: replace slow loops, repeated work and inefficient data "
+    "structures, without changing its results or side effects.\n\n{code}\n\nFaster version:\n",
+    "The following Python function is a performance hotspot. Return an equivalent, more "
+    "efficient implementation with the same name.\n\n{code}\n\nEfficient implementation:\n",
+)
+
+def _digest(source: str) -> str:
+    return hashlib.sha1(source.encode()).hexdigest()[:16]
+
+def _normalize(source: str) -> str:
+    try:
+        return ast.unparse(ast.parse(source))
+    except SyntaxError:
+        return source
+
+def rule_candidates(module_source: str, function_source: str, history: List[Dict[str, Any]]) -> List[Tuple[str, str]]:
+    """
+    Propose rewrites of a function by the rewrite rules: each rule on its own, and all of them together.
+
+    Args:
+        module_source (str): Source of the module.
+        function_source (str): Source of the function's current best version.
+        history (List[Dict[str, Any]]): Earlier iterations (unused).
+
+    Returns:
+        List[Tuple[str, str]]: (label, function source) pairs.
+    """
+    function = ast.parse(function_source).body[0]
+    candidates = []
+    for label, rules in [('rules', DEFAULT_RULES)] + [(f"rule:{rule.name}", [rule]) for rule in DEFAULT_RULES]:
+        rewritten, applied = rewrite_function(function, rules)
+        if applied:
+            candidates.append((label, ast.unparse(rewritten)))
+    return candidates
+
+def extract_function(text: str, name: str) -> Optional[str]:
+    """
+    Find the definition of a function in generated text.
+
+    Args:
+        text (str): Model output, possibly with prose or Markdown code fences around the code.
+        name (str): The function's name.
+
+    Returns:
+        Optional[str]: The function's source, or None if there is no parseable definition of it.
+    """
+    blocks = re.findall(r"```(?:python)?\n(.*?)```", text, re.DOTALL) + [text]
+    for block in blocks:
+        lines = block.splitlines()
+        # Drop prose before the code, trying later and later starting lines until it parses
+        for start in range(len(lines)):
+            if not lines[start].lstrip().startswith(('def ', 'async def ', '@', 'import ', 'from ')):
+                continue
+            try:
+                tree = ast.parse('\n'.join(lines[start:]))
+            except SyntaxError:
+                continue
+            for node in tree.body:
+                if isinstance(node, FUNCTION_NODES) and node.name == name:
+                    return ast.unparse(node)
+    return None
+
+def model_candidates(generate: Callable[[str], str], prompts: Sequence[str] = MODEL_PROMPTS) -> CandidateGenerator:
+    """
+    Make a generator that asks a language model for rewrites, one per prompt.
+
+    After an iteration in which every candidate was rejected, the prompts say why, so the model
+    does not propose the same kind of change again.
+
+    Args:
+        generate (Callable[[str], str]): Called with a prompt; returns the model's text, e.g. a
+            wrapper around metrics.cached_generate.
+        prompts (Sequence[str]): Prompt templates with a {code} placeholder.
+
+    Returns:
+        CandidateGenerator: The generator.
+    """
+    def candidates(module_source: str, function_source: str, history: List[Dict[str, Any]]) -> List[Tuple[str, str]]:
+        name = ast.parse(function_source).body[0].name
+        feedback = ''
+        if history:
+            details = [candidate['detail'] for candidate in history[-1]['candidates']
+                       if candidate['label'].startswith('model') and not candidate['equivalent']]
+            if details:
+                feedback = "Earlier attempts changed the behaviour (" + '; '.join(sorted(set(details))) + ").\n"
+        results = []
+        for number, prompt in enumerate(prompts):
+            function = extract_function(generate(feedback + prompt.format(code=function_source)), name)
+            if function is not None:
+                results.append((f"model:{number}", function))
+        return results
+
+    return candidates
+
+def _measure(task: Tuple[str, str, str, str, int, int, float, bool, Optional[Dict[str, Optional[int]]]]) -> Dict[str, Any]:
+    module_source, original, candidate, name, size, repeats, timeout, track_energy, limits = task
+    # The candidate replaces the function in the module, so the benchmark sees it in context
+    module = ast.parse(module_source)
+    for index, node in enumerate(module.body):
+        if isinstance(node, FUNCTION_NODES) and node.name == name:
+            module.body[index] = ast.parse(candidate).body[0]
+    measurement = benchmark_function(ast.unparse(module), name, size, repeats, timeout, track_energy, limits)
+    return {'status': measurement['status'], 'error': measurement['error'],
+            'time': measurement.get('time'), 'energy_consumed': measurement.get('energy_consumed')}
+
+def _evaluate(task: Tuple[str, str, str, str, int, int, float, bool, Optional[Dict[str, Optional[int]]]]) -> Dict[str, Any]:
+    module_source, original, candidate = task[:3]
+    result = {'equivalent': True, 'detail': 'original'}
+    if _normalize(candidate) != _normalize(original):
+        result = check_equivalence(module_source, original, candidate, timeout=task[6], limits=task[8])
+        if not result['equivalent']:
+            return result
+    result.update(_measure(task))
+    return result
+
+def _median(runs: List[Dict[str, Any]], metric: str) -> Optional[float]:
+    values = [run[metric] for run in runs]
+    return statistics.median(values) if values and all(value is not None for value in values) else None
+
+def _samples(runs: List[Dict[str, Any]], reference: List[Dict[str, Any]]) -> Tuple[List[float], List[float]]:
+    # Energy if every run of both has it; run time is a proxy for energy otherwise
+    metric = 'energy_consumed' if all(run.get('energy_consumed') for run in runs + reference) else 'time'
+    return [run[metric] for run in runs], [run[metric] for run in reference]
+
+def _compare(runs: List[Dict[str, Any]], reference: List[Dict[str, Any]]) -> Tuple[Optional[float], float]:
+    """The reduction of the median cost of some runs against reference runs, and its Mann-Whitney p-value."""
+    if not runs or not reference:
+        return None, 1.0
+    samples, reference_samples = _samples(runs, reference)
+    if not statistics.median(reference_samples):
+        return None, 1.0
+    reduction = 1 - statistics.median(samples) / statistics.median(reference_samples)
+    return reduction, mann_whitney_u(reference_samples, samples)['p_value']
+
+def read_log(path: str) -> List[Dict[str, Any]]:
+    """
+    Read the iteration records of earlier searches.
+
+    Args:
+        path (str): The JSON-lines log.
+
+    Returns:
+        List[Dict[str, Any]]: The records, oldest first; an incomplete last line is skipped.
+    """
+    records = []
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+class OptimizationLoop:
+    """
+    Searches for faster, equivalent versions of functions, iteration by iteration.
+
+    Each iteration asks the generators for candidate rewrites of the current best version, then
+    checks every new candidate for equivalence with the original function and benchmarks it, in
+    separate processes, several at a time. The original and the best version so far are
+    benchmarked in the same batches, `rounds` times in a rotating order, so all versions are
+    compared under the same load and a single noisy run decides nothing. A candidate becomes the
+    new best if its median cost improves on the best's by at least `min_improvement` and a
+    Mann-Whitney test finds it significantly faster than the best. The search stops when the target
+    reduction is reached, after `patience` iterations without improvement, when the generators
+    have nothing new, or after `max_iterations`.
+
+    Every iteration is appended to a JSON-lines log. A search for a function whose original
+    source matches a logged one resumes where the log ends.
+    """
+
+    def __init__(self, generators: Sequence[CandidateGenerator], max_iterations: int = 10, target_reduction: float = 0.10,
+                 min_improvement: float = 0.02, patience: int = 2, size: int = 200, repeats: int = 5,
+                 rounds: int = 5, alpha: float = 0.05, timeout: float = 30.0, workers: Optional[int] = None,
+                 track_energy: bool = False, log_file: Optional[str] = DEFAULT_LOG_FILE,
+                 limits: Optional[Dict[str, Optional[int]]] = None):
+        """
+        Args:
+            generators (Sequence[CandidateGenerator]): Where candidates come from.
+            max_iterations (int): Most iterations per function.
+            target_reduction (float): Stop once the cost is reduced by this fraction of the original's.
+            min_improvement (float): Smallest reduction, as a fraction of the original's cost, that
+                counts as an improvement on the best so far.
+            patience (int): Iterations without improvement before giving up.
+            size (int): Input size of the benchmarks (see rewrite_rules.make_sample_args).
+            repeats (int): Timed calls per benchmark.
+            rounds (int): Benchmarks of every version per iteration, each in a new process. With
+                fewer than 4, no difference is ever significant at the default alpha.
+            alpha (float): Significance level of the test a candidate must pass to be kept.
+            timeout (float): Seconds allowed for each equivalence check and benchmark.
+            workers (int, optional): Candidates evaluated at once. Defaults to the CPU count.
+            track_energy (bool): Whether to measure energy with CodeCarbon; otherwise run time is the cost.
+            log_file (str, optional): Where iterations are logged. None disables logging and resuming.
+            limits (Dict[str, Optional[int]], optional): CPU time, memory and file size limits for the
+                checks and benchmarks (see script_runner.limit_resources). Defaults to DEFAULT_LIMITS.
+        """
+        self.generators = list(generators)
+        self.max_iterations = max_iterations
+        self.target_reduction = target_reduction
+        self.min_improvement = min_improvement
+        self.patience = patience
+        self.size = size
+        self.repeats = repeats
+        self.rounds = max(1, rounds)
+        self.alpha = alpha
+        self.timeout = timeout
+        self.workers = workers or os.cpu_count() or 1
+        self.track_energy = track_energy
+        self.log_file = log_file
+        self.limits = limits
+
+    def _log(self, record: Dict[str, Any]) -> None:
+        if self.log_file is None:
+            return
+        directory = os.path.dirname(self.log_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.log_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def optimize_function(self, module_source: str, name: str, file: str = '<source>') -> Dict[str, Any]:
+        """
+        Search for a better version of one top-level function.
+
+        Args:
+            module_source (str): Source of the module the function is in.
+            name (str): The function's name.
+            file (str): The module's path, for the log.
+
+        Returns:
+            Dict[str, Any]: 'source' (the best version), 'reduction' (its cost reduction against
+            the original, 0.0 if none was found), 'label' (where it came from), 'iterations' and
+            'stopped' (why the search ended).
+        """
+        node = next(node for node in ast.parse(module_source).body
+                    if isinstance(node, FUNCTION_NODES) and node.name == name)
+        original = ast.unparse(node)
+        key = {'file': file, 'function': name, 'original': _digest(original)}
+
+        history = [record for record in (read_log(self.log_file) if self.log_file else [])
+                   if all(record.get(field) == value for field, value in key.items())]
+        best = {'source': original, 'reduction': 0.0, 'label': 'original'}
+        seen = {_normalize(original)}
+        stale = 0
+        for record in history:
+            seen.update(_normalize(candidate['source']) for candidate in record['candidates'])
+            best, stale = record['best'], record['stale']
+        if history:
+            logger.info("Resuming %s.%s after iteration %d", file, name, history[-1]['iteration'])
+            if history[-1]['stopped']:
+                return dict(best, iterations=history[-1]['iteration'], stopped=history[-1]['stopped'])
+
+        iteration = history[-1]['iteration'] if history else 0
+        stopped = None
+        while stopped is None:
+            if iteration >= self.max_iterations:
+                stopped = 'max_iterations'
+                break
+            iteration += 1
+            candidates = []
+            for generator in self.generators:
+                try:
+                    proposed = generator(module_source, best['source'], history)
+                except Exception as e:
+                    logger.warning("Candidate generator failed on %s.%s: %s", file, name, e)
+                    continue
+                for label, source in proposed:
+                    normalized = _normalize(source)
+                    if normalized not in seen:
+                        seen.add(normalized)
+                        candidates.append({'label': label, 'source': source})
+            if not candidates:
+                stopped = 'exhausted'
+                self._log(dict(key, iteration=iteration, timestamp=time.time(), control=None, candidates=[],
+                               best=best, stale=stale, stopped=stopped))
+                break
+
+            # The original goes first, as the control every candidate is compared with, then the best
+            # version so far, which a candidate must beat
+            previous = [original] if best['source'] == original else [original, best['source']]
+            versions = previous + [candidate['source'] for candidate in candidates]
+            tasks = [(module_source, original, version, name, self.size, self.repeats, self.timeout, self.track_energy,
+                      self.limits)
+                     for version in versions]
+            with AdaptiveExecutor('thread', max_workers=self.workers) as executor:
+                results = list(executor.map(_evaluate, tasks))
+                # Only equivalent versions are measured again; equivalence needs checking once
+                measured = [index for index, result in enumerate(results)
+                            if result['equivalent'] and result.get('status') == 'ok']
+                runs = [[result] if index in measured else [] for index, result in enumerate(results)]
+                for round_number in range(1, self.rounds if measured else 1):
+                    # Rotated every round, so drift in machine load is spread over all versions
+                    shift = round_number % len(measured)
+                    order = measured[shift:] + measured[:shift]
+                    for index, result in zip(order, executor.map(_measure, [tasks[index] for index in order])):
+                        if result['status'] == 'ok':
+                            runs[index].append(result)
+            control = results[0]
+            if control.get('status') != 'ok':
+                stopped = 'unmeasurable'
+                logger.warning("Leaving %s.%s unchanged: the original could not be benchmarked (%s)",
+                               file, name, control.get('error') or control['status'])
+            best_runs = runs[len(previous) - 1]
+            improved = False
+            for candidate, result, candidate_runs in zip(candidates, results[len(previous):], runs[len(previous):]):
+                reduction, p_value = _compare(candidate_runs, runs[0])
+                candidate.update(equivalent=bool(result['equivalent']), detail=result.get('detail') or result.get('error'),
+                                 time=_median(candidate_runs, 'time'), energy_consumed=_median(candidate_runs, 'energy_consumed'),
+                                 reduction=reduction, p_value=p_value, runs=len(candidate_runs))
+                if reduction is None or reduction < best['reduction'] + self.min_improvement:
+                    continue
+                against_best, p_best = _compare(candidate_runs, best_runs)
+                if against_best is not None and against_best > 0 and p_best < self.alpha:
+                    best = {'source': candidate['source'], 'reduction': reduction, 'label': candidate['label']}
+                    improved = True
+            stale = 0 if improved else stale + 1
+            if stopped is None and best['reduction'] >= self.target_reduction:
+                stopped = 'target_reached'
+            elif stopped is None and stale >= self.patience:
+                stopped = 'plateau'
+
+            record = dict(key, iteration=iteration, timestamp=time.time(),
+                          control={'time': _median(runs[0], 'time'), 'energy_consumed': _median(runs[0], 'energy_consumed'),
+                                   'error': control.get('error'), 'runs': len(runs[0])},
+                          candidates=candidates, best=best, stale=stale, stopped=stopped)
+            self._log(record)
+            history.append(record)
+            logger.info("%s.%s iteration %d: %d candidates, %d equivalent, best reduction %.1f%% (%s)%s",
+                        file, name, iteration, len(candidates), sum(c['equivalent'] for c in candidates),
+                        100 * best['reduction'], best['label'], f", stopped: {stopped}" if stopped else '')
+        return dict(best, iterations=iteration, stopped=stopped)
+
+    def optimize_file(self, path: str, functions: Optional[Set[str]] = None, write: bool = True) -> Dict[str, Any]:
+        """
+        Search for better versions of a file's top-level functions and splice the improved ones in.
+
+        Functions that can't be called with generated sample arguments (see
+        rewrite_rules.make_sample_args), and `main`, are skipped.
+
+        Args:
+            path (str): The Python file.
+            functions (Set[str], optional): Only these functions, e.g. the hot ones. Defaults to all.
+            write (bool): Whether to save the improved file.
+
+        Returns:
+            Dict[str, Any]: 'file', 'source' (the new code) and 'functions', the search result of each function.
+        """
+        with open(path) as f:
+            source = f.read()
+        tree = ast.parse(source)
+        results, edits = {}, []
+        for node in tree.body:
+            if not isinstance(node, FUNCTION_NODES) or node.name == 'main' \
+                    or (functions is not None and node.name not in functions) or node.decorator_list:
+                continue
+            args = node.args
+            if args.vararg or args.kwarg or args.kwonlyargs or args.posonlyargs \
+                    or any(arg.arg in ('self', 'cls') for arg in args.args):
+                continue
+            result = self.optimize_function(source, node.name, path)
+            results[node.name] = result
+            if result['reduction'] > 0:
+                edits.append((node.lineno, node.end_lineno, result['source'] + '\n'))
+
+        lines = source.splitlines(keepends=True)
+        # Splice from the bottom up so earlier line numbers stay valid
+        for start, end, text in sorted(edits, reverse=True):
+            lines[start - 1:end] = [text]
+        new_source = ''.join(lines)
+        if write and edits:
+            with open(path, 'w') as f:
+                f.write(new_source)
+        return {'file': path, 'source': new_source, 'functions': results}
+
+    def optimize_directory(self, directory: str, functions: Optional[Dict[str, Set[str]]] = None,
+                           write: bool = True) -> List[Dict[str, Any]]:
+        """
+        Run the search on every Python file under a directory, or on the given hot files.
+
+        Args:
+            directory (str): The root directory.
+            functions (Dict[str, Set[str]], optional): Only these top-level functions, keyed by file
+                path (e.g. the hot functions from a profile). Other files are skipped.
+            write (bool): Whether to save improved files.
+
+        Returns:
+            List[Dict[str, Any]]: One optimize_file result per file that could be parsed.
+        """
+        if functions is not None:
+            paths = sorted(os.path.abspath(path) for path in functions)
+            functions = {os.path.abspath(path): names for path, names in functions.items()}
+        else:
+            paths = sorted(os.path.join(root, file) for root, _, files in os.walk(directory)
+                           for file in files if file.endswith('.py'))
+        results = []
+        for path in paths:
+            try:
+                results.append(self.optimize_file(path, functions.get(path) if functions else None, write))
+            except (SyntaxError, UnicodeDecodeError):
+                continue
+        return results
+
+def optimization_loop(config: Dict[str, Any], generators: Optional[Sequence[CandidateGenerator]] = None) -> OptimizationLoop:
+    """
+    Create the search described by the 'optimization' section of config.yaml.
+
+    The target reduction is the larger of the energy and carbon targets: at a given carbon
+    intensity, carbon emissions fall in proportion to energy.
+
+    Args:
+        config (Dict[str, Any]): The loaded configuration.
+        generators (Sequence[CandidateGenerator], optional): Defaults to the rewrite rules; an
+            empty sequence means no candidates at all.
+
+    Returns:
+        OptimizationLoop: The search.
+    """
+    settings = config.get('optimization', {})
+    targets = settings.get('target_metrics', {})
+    return OptimizationLoop(
+        [rule_candidates] if generators is None else generators,
+        max_iterations=settings.get('max_iterations', 10),
+        target_reduction=max(targets.get('energy_reduction', 0.10), targets.get('carbon_reduction', 0.10)),
+        min_improvement=settings.get('min_improvement', 0.02),
+        patience=settings.get('patience', 2),
+        size=settings.get('benchmark_size', 200),
+        repeats=settings.get('benchmark_repeats', 5),
+        rounds=settings.get('benchmark_rounds', 5),
+        alpha=settings.get('alpha', 0.05),
+        timeout=settings.get('timeout', 30.0),
+        workers=settings.get('workers'),
+        track_energy=settings.get('track_energy', False),
+        log_file=settings.get('log_file', DEFAULT_LOG_FILE),
+        limits=resource_limits(config),
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search for faster, equivalent versions of a file's functions.")
+    parser.add_argument('file', help="Python file to optimize")
+    parser.add_argument('functions', nargs='*', help="Functions to optimize; defaults to all")
+    parser.add_argument('--write', action='store_true', help="Save the improved file")
+    args = parser.parse_args()
+
+    config = load_config('config.yaml')
+    setup_logging(config)
+    loop = optimization_loop(config)
+    outcome = loop.optimize_file(args.file, set(args.functions) or None, write=args.write)
+    for function, result in outcome['functions'].items():
+        print(f"{function}: {result['reduction']:.1%} reduction from {result['label']} "
+              f"after {result['iterations']} iterations ({result['stopped']})")
@@ -1,6 +1,16 @@
+import argparse  # Importing argparse to choose between the demo and the benchmark
 import concurrent.futures  # Importing the concurrent.futures module for parallel execution
+import os  # Importing os to count the CPUs available to this process
+import pickle  # Importing pickle to check whether a function can be sent to worker processes
+import statistics  # Importing statistics to take the median of the calibration measurements
 import time  # Importing the time module for sleep and timing execution
-from typing import List, Callable, Any  # Importing type annotations for better code readability and type checking
+from itertools import chain, islice  # Importing chain and islice to consume the tasks lazily, one chunk at a time
+from typing import List, Callable, Any, Dict, Iterable, Iterator, Optional, Tuple  # Importing type annotations for better code readability and type checking
+
+KINDS = ('inline', 'thread', 'process')
+TARGET_CHUNK_SECONDS = 0.01  # Work per chunk: enough to amortize the cost of handing a chunk to a worker
+PROCESS_STARTUP_SECONDS = 0.05  # Rough cost of starting worker processes, to be won back by running in parallel
+CALIBRATION_TASKS = 5  # Tasks measured before choosing, so one unusually fast or slow task does not decide
 
 def process_task(task_id: int) -> str:
     """
@@ -16,6 +26,18 @@ def process_task(task_id: int) -> str:
     time.sleep(1)  # Simulate a time-consuming task with a 1-second sleep
     return f"Task {task_id} completed"  # Return a message indicating the task is completed
 
+def cpu_task(task_id: int) -> int:
+    """
+    Function to simulate a CPU-bound task, which holds the GIL for its whole duration.
+
+    Args:
+    task_id (int): Identifier for the task.
+
+    Returns:
+    int: A checksum of the work done.
+    """
+    return sum(i * i % (task_id + 7) for i in range(200_000))
+
 def parallel_processing(tasks: List[int], worker_function: Callable[[int], Any], max_workers: int = None) -> List[Any]:
     """
     Function to process tasks in parallel using a pool of threads.
@@ -34,22 +56,313 @@ def parallel_processing(tasks: List[int], worker_function: Callable[[int], Any],
         results = list(executor.map(worker_function, tasks))
     return results  # Return the list of results from processing the tasks
 
+def _run_chunk(worker_function: Callable[[Any], Any], chunk: List[Any]) -> Tuple[List[Tuple[bool, Any]], float, float]:
+    """
+    Run a chunk of tasks in a worker, keeping each task's error to itself.
+
+    Args:
+    worker_function (Callable[[Any], Any]): The function to execute for each task.
+    chunk (List[Any]): The tasks.
+
+    Returns:
+    Tuple[List[Tuple[bool, Any]], float, float]: Per task, whether it succeeded and its result or
+    exception; then the wall-clock and CPU seconds of the worker thread running the chunk.
+    """
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    results = []
+    for task in chunk:
+        try:
+            results.append((True, worker_function(task)))
+        except Exception as e:
+            results.append((False, e))
+    return results, time.perf_counter() - wall_start, time.thread_time() - cpu_start
+
+def _cpus() -> int:
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+def _is_picklable(worker_function: Callable[[Any], Any]) -> bool:
+    try:
+        pickle.dumps(worker_function)
+        return True
+    except Exception:
+        return False
+
+def choose_kind(wall_time: float, cpu_time: float, remaining_tasks: int, picklable: bool = True,
+                cpus: Optional[int] = None) -> str:
+    """
+    Pick how to run the remaining tasks from measurements of a few of them.
+
+    Tasks that mostly wait (for I/O, sleeps or locks) overlap well in threads. Tasks that mostly
+    compute hold the GIL, so they only run in parallel in processes, and only if there is more
+    than one CPU and enough work to pay for starting the processes; otherwise running them
+    inline avoids all the overhead.
+
+    Args:
+    wall_time (float): Mean wall-clock seconds per measured task.
+    cpu_time (float): Mean CPU seconds per measured task, in the calling thread.
+    remaining_tasks (int): Number of tasks still to run.
+    picklable (bool): Whether the function and tasks can be sent to worker processes.
+    cpus (int, optional): CPUs available. Defaults to those this process may run on.
+
+    Returns:
+    str: 'inline', 'thread' or 'process'.
+    """
+    if cpus is None:
+        cpus = _cpus()
+    if remaining_tasks <= 1:
+        return 'inline'
+    if wall_time > 0 and cpu_time / wall_time < 0.5:
+        return 'thread'  # Mostly waiting
+    if cpus > 1 and picklable and wall_time * remaining_tasks > PROCESS_STARTUP_SECONDS * cpus:
+        return 'process'
+    return 'inline'
+
+class AdaptiveExecutor:
+    """
+    Executor that runs tasks inline, in threads or in processes, and streams their results.
+
+    The kind of execution is given, or chosen by measuring the first few tasks, run in threads so
+    that waiting tasks already overlap (see choose_kind).
+    Small tasks are grouped into chunks, so each hand-off to a worker carries enough work to be
+    worth it. Results are yielded as they complete, with a bounded number of chunks in flight or
+    waiting for earlier ones, so a long or endless stream of tasks never materializes. Closing the result iterator, or an
+    error in a task, cancels the tasks that have not started.
+    """
+
+    def __init__(self, kind: str = 'auto', max_workers: Optional[int] = None, chunk_size: Optional[int] = None,
+                 max_in_flight: Optional[int] = None):
+        """
+        Args:
+        kind (str): 'auto', 'inline', 'thread' or 'process'.
+        max_workers (int, optional): Number of threads or processes. Defaults to the executor's own default.
+        chunk_size (int, optional): Tasks per chunk. Defaults to what the calibration suggests, or 1.
+        max_in_flight (int, optional): Chunks submitted but not yet yielded, including those held back
+        to keep the order. Defaults to twice the workers.
+        """
+        if kind not in KINDS + ('auto',):
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.last_kind = None  # The kind used by the latest stream, once chosen
+        self._executors: Dict[str, concurrent.futures.Executor] = {}
+
+    def _workers(self, kind: str) -> int:
+        if self.max_workers:
+            return self.max_workers
+        # The same defaults as ThreadPoolExecutor and ProcessPoolExecutor
+        return min(32, _cpus() + 4) if kind == 'thread' else _cpus()
+
+    def _executor(self, kind: str) -> concurrent.futures.Executor:
+        # Pools are kept between calls, so process workers are started only once
+        if kind not in self._executors:
+            if kind == 'thread':
+                self._executors[kind] = concurrent.futures.ThreadPoolExecutor(max_workers=self._workers(kind))
+            else:
+                self._executors[kind] = concurrent.futures.ProcessPoolExecutor(max_workers=self._workers(kind))
+        return self._executors[kind]
+
+    def stream(self, worker_function: Callable[[Any], Any], tasks: Iterable[Any], ordered: bool = False,
+               return_exceptions: bool = False) -> Iterator[Tuple[int, Any]]:
+        """
+        Run the worker function on every task and yield the results as they become available.
+
+        Args:
+        worker_function (Callable[[Any], Any]): The function to execute for each task.
+        tasks (Iterable[Any]): The tasks; consumed lazily, so it may be a generator.
+        ordered (bool): Yield in the order of the tasks instead of the order of completion.
+        return_exceptions (bool): Yield a task's exception as its result instead of raising it.
+
+        Yields:
+        Tuple[int, Any]: The index of each task and its result.
+
+        Raises:
+        Exception: The first exception raised by a task, unless return_exceptions is set; the
+        remaining tasks are cancelled.
+        """
+        tasks = iter(tasks)
+        kind = self.kind
+        chunk_size = self.chunk_size or 1
+        in_flight = {}  # Maps each future to the index of its chunk's first task
+        buffered = {}  # Maps the first index of each chunk waiting for earlier ones to its results, when ordered
+        next_index = 0  # The next index to yield, when ordered
+        index = 0  # The index of the next task to submit
+
+        def submit(executor: concurrent.futures.Executor, size: int) -> bool:
+            nonlocal index
+            chunk = list(islice(tasks, size))
+            if not chunk:
+                return False
+            in_flight[executor.submit(_run_chunk, worker_function, chunk)] = index
+            index += len(chunk)
+            return True
+
+        def collect(future: concurrent.futures.Future) -> Iterator[Tuple[int, Any]]:
+            nonlocal next_index
+            first = in_flight.pop(future)
+            results, _, _ = future.result()
+            for offset, (succeeded, result) in enumerate(results):
+                if not succeeded and not return_exceptions:
+                    raise result
+            if not ordered:
+                for offset, (_, result) in enumerate(results):
+                    yield first + offset, result
+                return
+            buffered[first] = results
+            while next_index in buffered:
+                for _, result in buffered.pop(next_index):
+                    yield next_index, result
+                    next_index += 1
+
+        try:
+            if kind == 'auto':
+                # Fill the thread pool with the first tasks and decide once a few finish; the others keep
+                # running meanwhile, so waiting tasks lose no time to the calibration
+                threads = self._executor('thread')
+                wall_start, cpu_start = time.perf_counter(), time.process_time()
+                for _ in range(self._workers('thread')):
+                    submit(threads, 1)
+                if not in_flight:
+                    return
+                done = set()
+                while len(done) < min(CALIBRATION_TASKS, len(in_flight)):
+                    finished, _ = concurrent.futures.wait(set(in_flight) - done,
+                                                          return_when=concurrent.futures.FIRST_COMPLETED)
+                    done |= finished
+                # With the GIL, the process's CPU time over the elapsed time tells computing from waiting
+                busy = (time.process_time() - cpu_start) / max(time.perf_counter() - wall_start, 1e-9)
+                timings = [future.result()[1:] for future in done]
+                wall_time = statistics.median(wall for wall, _ in timings)
+                cpu_time = statistics.median(cpu for _, cpu in timings)
+                task_time = cpu_time if busy >= 0.5 else wall_time
+                # Peek at the rest to know how much work is left, without materializing a long stream
+                lookahead = list(islice(tasks, 1000))
+                tasks = chain(lookahead, tasks)
+                picklable = _is_picklable(worker_function) and (not lookahead or _is_picklable(lookahead[0]))
+                kind = choose_kind(task_time, task_time * busy, len(lookahead), picklable=picklable)
+                if self.chunk_size is None and task_time > 0:
+                    chunk_size = max(1, int(TARGET_CHUNK_SECONDS / task_time))
+            self.last_kind = kind
+
+            if kind == 'inline':
+                # Tasks still running from the calibration come first
+                while in_flight:
+                    yield from collect(next(iter(in_flight)))
+                for task in tasks:
+                    try:
+                        result = worker_function(task)
+                    except Exception as e:
+                        if not return_exceptions:
+                            raise
+                        result = e
+                    yield index, result
+                    index += 1
+                return
+
+            executor = self._executor(kind)
+            max_in_flight = self.max_in_flight or 2 * self._workers(kind)
+
+            def refill() -> None:
+                # Chunks held back for the order count too, so a slow chunk cannot make the buffer grow
+                while len(in_flight) + len(buffered) < max_in_flight and submit(executor, chunk_size):
+                    pass
+
+            refill()
+            while in_flight:
+                done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from collect(future)
+                    # Refill as results are yielded, so at most max_in_flight chunks are pending
+                    refill()
+        finally:
+            # Reached on errors and when the caller stops early: drop the work that has not started
+            for future in in_flight:
+                future.cancel()
+
+    def map(self, worker_function: Callable[[Any], Any], tasks: Iterable[Any],
+            return_exceptions: bool = False) -> Iterator[Any]:
+        """
+        Like the built-in map, but in parallel: yield the results in the order of the tasks.
+
+        Args:
+        worker_function (Callable[[Any], Any]): The function to execute for each task.
+        tasks (Iterable[Any]): The tasks.
+        return_exceptions (bool): Yield a task's exception as its result instead of raising it.
+
+        Yields:
+        Any: The result of each task.
+        """
+        for _, result in self.stream(worker_function, tasks, ordered=True, return_exceptions=return_exceptions):
+            yield result
+
+    def shutdown(self) -> None:
+        """Stop the worker pools, cancelling queued work."""
+        for executor in self._executors.values():
+            executor.shutdown(wait=True, cancel_futures=True)
+        self._executors = {}
+
+    def __enter__(self) -> 'AdaptiveExecutor':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+
+def _quiet_process_task(task_id: int) -> str:
+    # process_task without the print, so printing does not dominate the benchmark
+    time.sleep(1)
+    return f"Task {task_id} completed"
+
+def benchmark(tasks: int = 20, repeats: int = 1) -> Dict[str, Dict[str, float]]:
+    """
+    Compare the throughput of parallel_processing and AdaptiveExecutor on a sleeping and a CPU-bound workload.
+
+    Args:
+    tasks (int): Number of tasks per workload.
+    repeats (int): Runs per method; the best is kept.
+
+    Returns:
+    Dict[str, Dict[str, float]]: Per workload and method, the tasks completed per second.
+    """
+    results = {}
+    for name, worker_function in (('process_task', _quiet_process_task), ('cpu_task', cpu_task)):
+        timings = {'parallel_processing': [], 'adaptive': []}
+        for _ in range(repeats):
+            start = time.perf_counter()
+            parallel_processing(list(range(tasks)), worker_function)
+            timings['parallel_processing'].append(time.perf_counter() - start)
+            with AdaptiveExecutor() as executor:
+                start = time.perf_counter()
+                for _ in executor.stream(worker_function, range(tasks)):
+                    pass
+                timings['adaptive'].append(time.perf_counter() - start)
+                kind = executor.last_kind
+        results[name] = {method: tasks / min(times) for method, times in timings.items()}
+        results[name]['adaptive_kind'] = kind
+    return results
+
 if __name__ == "__main__":
-    # Define a list of task IDs to be processed
-    tasks = list(range(1, 11))  # Creating a list of tasks from 1 to 10
-
-    # Record the start time of the parallel processing
-    start_time = time.time()
-    
-    # Call the parallel_processing function with the list of tasks and the worker function
-    results = parallel_processing(tasks, process_task)
-    
-    # Record the end time of the parallel processing
-    end_time = time.time()
-    
-    # Print the results of each processed task
-    for result in results:
-        print(result)
-    
-    # Calculate and print the total execution time for processing all tasks
-    print(f"Total execution time: {end_time - start_time:.2f} seconds")
+    parser = argparse.ArgumentParser(description="Process tasks in parallel, or benchmark the executors.")
+    parser.add_argument('--benchmark', action='store_true', help="Compare parallel_processing and AdaptiveExecutor")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        for workload, throughput in benchmark().items():
+            print(workload, throughput)
+    else:
+        # Define a list of task IDs to be processed
+        tasks = list(range(1, 11))  # Creating a list of tasks from 1 to 10
+
+        # Record the start time of the parallel processing
+        start_time = time.time()
+
+        # Process the tasks, printing each result as soon as it is ready
+        with AdaptiveExecutor() as executor:
+            for task_index, result in executor.stream(process_task, tasks):
+                print(result)
+
+        # Record the end time of the parallel processing
+        end_time = time.time()
+
+        # Calculate and print the total execution time for processing all tasks
+        print(f"Total execution time: {end_time - start_time:.2f} seconds")
@@ -1,36 +1,52 @@
 import os
+import shutil
 import subprocess
 from codecarbon import EmissionsTracker
 from github import Github
-from refactor_earth import RefactorEarth
+from benchmark_harness import benchmark_trees, write_report
+from optimization_loop import model_candidates, optimization_loop, rule_candidates
+from sampling_profiler import format_hotspots, hot_functions, hotspots, profile_script, top_level_function, write_collapsed
+from config_parser import load_config
+from logging_config import setup_logging
+from repo_mirror import mirror_cache
+from script_runner import ScriptRunner, resource_limits, script_runner
 
-def clone_repository(repo_url, target_dir):
+def clone_repository(repo_url, target_dir, config=None):
     """
-    Clone the target GitHub repository into a specified directory.
+    Check out the target GitHub repository into a specified directory.
+
+    The repository is cloned once into the local mirror cache and only fetched on later runs;
+    the directory is a worktree of the mirror. An earlier checkout in the directory is reset.
 
     Args:
         repo_url (str): The URL of the GitHub repository to clone.
         target_dir (str): The directory where the repository will be cloned.
+        config (dict, optional): Configuration whose 'repository' section sets the branch and
+            the mirror cache options.
 
     Raises:
         subprocess.CalledProcessError: If the cloning process fails.
     """
+    config = config or {}
     try:
         print(f"Cloning repository from {repo_url} into {target_dir}...")
-        # Run the Git command to clone the repository
-        subprocess.run(['git', 'clone', repo_url, target_dir], check=True)
-        print("Repository cloned successfully.")
+        branch = config.get('repository', {}).get('branch')
+        commit = mirror_cache(config).checkout(repo_url, target_dir, branch)
+        print(f"Repository checked out at {commit[:12]}.")
     except subprocess.CalledProcessError as e:
         print(f"Error occurred while cloning the repository: {e}")
         raise
 
-def calculate_initial_metrics(directory, script_name='example_script.py'):
+def calculate_initial_metrics(directory, script_name='example_script.py', timeout=None, runner=None):
     """
     Calculate initial energy consumption and sustainability metrics for the code.
 
     Args:
         directory (str): The directory containing the code to analyze.
         script_name (str): The name of the script to run for measuring metrics.
+        timeout (float, optional): Maximum time (in seconds) to allow the script to run.
+        runner (ScriptRunner, optional): The sandboxed runner to run the script with. Defaults to
+            a new runner without resource limits.
 
     Returns:
         dict: A dictionary containing the initial metrics, such as energy consumption and carbon emissions.
@@ -38,6 +54,7 @@ def calculate_initial_metrics(directory, script_name='example_script.py'):
     Raises:
         FileNotFoundError: If the specified script is not found in the directory.
         subprocess.CalledProcessError: If the script execution fails.
+        subprocess.TimeoutExpired: If the script runs longer than the timeout.
     """
     tracker = EmissionsTracker()
 
@@ -46,12 +63,19 @@ def calculate_initial_metrics(directory, script_name='example_script.py'):
     if not os.path.isfile(script_path):
         raise FileNotFoundError(f"The script {script_name} was not found in the directory {directory}.")
 
+    own_runner = runner is None
+    if own_runner:
+        runner = ScriptRunner(preload=())
     try:
         print(f"Calculating initial metrics for the script {script_name}...")
         tracker.start()  # Start the emissions tracker
 
-        # Execute the script to measure its energy consumption
-        subprocess.run(['python', script_path], check=True)
+        # Execute the script, isolated from this process, to measure its energy consumption
+        result = runner.run(script_path, timeout=timeout)
+        if result['status'] == 'timeout':
+            raise subprocess.TimeoutExpired(script_path, timeout, result['stdout'], result['stderr'])
+        if result['status'] != 'ok':
+            raise subprocess.CalledProcessError(result['returncode'], script_path, result['stdout'], result['stderr'])
 
         tracker.stop()  # Stop the emissions tracker
 
@@ -62,19 +86,123 @@ def calculate_initial_metrics(directory, script_name='example_script.py'):
         }
         print("Initial metrics calculated successfully.")
         return metrics
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
         print(f"Error occurred while executing the script: {e}")
+        if e.stderr:
+            print(e.stderr)
         raise
     finally:
         tracker.stop()  # Ensure the tracker is stopped even if an error occurs
+        if own_runner:
+            runner.close()
+
+def find_hot_functions(directory, script_name, config):
+    """
+    Profile the script and pick the functions that use enough CPU time to be worth optimizing.
+
+    Args:
+        directory (str): The directory containing the code to profile.
+        script_name (str): The name of the script to run.
+        config (dict): The loaded configuration.
+
+    Returns:
+        dict: Top-level function names keyed by file path, empty if no function is hot enough; or
+        None if the script could not be profiled, in which case all functions should be optimized.
+    """
+    settings = config.get('profiling', {})
+    print(f"Profiling the script {script_name}...")
+    profile = profile_script(
+        os.path.join(directory, script_name),
+        root=directory,
+        interval=settings.get('interval', 0.005),
+        timeout=config.get('execution', {}).get('timeout'),
+        limits=resource_limits(config),
+    )
+    if profile['status'] != 'ok':
+        print(f"Profiling failed, so every function will be optimized: {profile['error']}")
+        return None
+    report_directory = config.get('report', {}).get('report_directory', './reports')
+    write_collapsed(profile, os.path.join(report_directory, 'profile.folded'))
+
+    table = hotspots(profile)
+    print(format_hotspots(table, directory))
+    min_share = settings.get('min_share', 0.05)
+    methods = sorted({row['function'] for row in table
+                      if row['share'] >= min_share and row['function'] != '<module>'
+                      and top_level_function(row['function']) is None})
+    if methods:
+        print(f"Hot methods, which are not optimized automatically: {', '.join(methods)}")
+    selected = hot_functions(table, min_share, settings.get('max_functions'))
+    if not selected:
+        print("No function uses enough CPU time to be worth optimizing.")
+    return selected
 
-def optimize_code(repo_dir, github_token):
+def jit_hot_functions(functions, config):
+    """
+    Try to JIT-compile the hot functions with Numba and report which ones it speeds up.
+
+    Each function is compiled in the JIT registry, checked against the Python version on sample
+    arguments and timed (see jit_optimization.jit_hotspots). The verdicts are printed and saved
+    to jit.json in the report directory.
+
+    Args:
+        functions (dict): Top-level function names keyed by file path, as from find_hot_functions.
+        config (dict): The loaded configuration.
+
+    Returns:
+        dict: Per file path, the registry entry of each function.
+    """
+    # Imported here, as loading Numba is slow and only needed for this step
+    from jit_optimization import jit_hotspots
+
+    settings = config.get('profiling', {})
+    report = {}
+    for path, names in sorted(functions.items()):
+        with open(path) as f:
+            source = f.read()
+        print(f"Trying to JIT-compile {', '.join(sorted(names))} in {path}...")
+        report[path] = jit_hotspots(source, names, settings.get('jit_size', 1000), limits=resource_limits(config))
+        for name, entry in sorted(report[path].items()):
+            if entry['status'] == 'jit':
+                print(f"{name}: {entry['speedup']:.1f}x faster when JIT-compiled")
+            else:
+                print(f"{name}: not JIT-compiled ({entry['reason']})")
+    report_path = os.path.join(config.get('report', {}).get('report_directory', './reports'), 'jit.json')
+    write_report(report, report_path)
+    return report
+
+def model_generator():
+    """
+    Get a candidate generator backed by the fine-tuned model, or None if the model can't be loaded.
+
+    Returns:
+        Callable, optional: An optimization_loop candidate generator.
+    """
+    import metrics
+
+    try:
+        metrics.get_inference_scheduler()
+    except Exception as e:
+        print(f"The model is not available, only rule-based candidates will be tried: {e}")
+        return None
+    return model_candidates(lambda prompt: metrics.cached_generate('optimize', prompt, prompt, maximum=1024))
+
+def optimize_code(repo_dir, github_token, functions=None, config=None):
     """
     Optimize the code in the given directory using an AI model like CodeBERT.
 
+    Each function is optimized by an iterative search (see optimization_loop): candidate rewrites
+    from the rewrite rules and the model are checked for equivalence and benchmarked, the best
+    one is kept, and the search stops at the target reduction of the 'optimization' settings,
+    when improvements plateau, or after max_iterations. Every iteration is logged, so an
+    interrupted run resumes where it stopped.
+
     Args:
         repo_dir (str): The directory containing the cloned repository.
         github_token (str): The GitHub token for accessing the repository data.
+        functions (dict, optional): Only optimize these top-level functions, keyed by file path.
+            Defaults to all functions.
+        config (dict, optional): The loaded configuration. Defaults to config.yaml.
 
     Returns:
         dict: A dictionary containing the optimization results, such as updated energy consumption and sustainability score.
@@ -84,17 +212,65 @@ def optimize_code(repo_dir, github_token):
     """
     try:
         print("Starting the code optimization process...")
-        refactor = RefactorEarth(github_token=github_token)
+        config = config or load_config('config.yaml')
+        sources = config.get('optimization', {}).get('candidate_sources', ['rules', 'model'])
+        generators = [rule_candidates] if 'rules' in sources else []
+        if 'model' in sources:
+            generator = model_generator()
+            if generator is not None:
+                generators.append(generator)
+        loop = optimization_loop(config, generators)
+        file_results = loop.optimize_directory(repo_dir, functions)
 
-        # Run the optimization process using the AI model
-        results = refactor.optimize_repo(repo_dir)
+        results = {'functions': [], 'log_file': loop.log_file}
+        for file_result in file_results:
+            for name, result in file_result['functions'].items():
+                results['functions'].append({
+                    'file': file_result['file'],
+                    'function': name,
+                    'reduction': result['reduction'],
+                    'source': result['label'],
+                    'iterations': result['iterations'],
+                    'stopped': result['stopped'],
+                })
+        improved = [result for result in results['functions'] if result['reduction'] > 0]
+        print(f"Improved {len(improved)} of {len(results['functions'])} functions.")
         print("Code optimization completed successfully.")
         return results
     except Exception as e:
         print(f"Error during code optimization: {e}")
         raise ValueError("Optimization failed. Please check the input and try again.")
 
-def main(repo_url, github_token, script_name='example_script.py'):
+def measure_impact(original_dir, optimized_dir, script_name, config):
+    """
+    Benchmark the original and optimized code against each other and save the report.
+
+    Args:
+        original_dir (str): The directory containing the unmodified code.
+        optimized_dir (str): The directory containing the optimized code.
+        script_name (str): The name of the script to run in both directories.
+        config (dict): The loaded configuration.
+
+    Returns:
+        dict: The benchmark report, with medians, confidence intervals and significance per metric.
+    """
+    settings = config.get('benchmark', {})
+    report = benchmark_trees(
+        original_dir, optimized_dir, script_name,
+        repeats=settings.get('repeats', 10),
+        warmup=settings.get('warmup', 2),
+        timeout=config.get('execution', {}).get('timeout'),
+        alpha=settings.get('alpha', 0.05),
+        confidence=settings.get('confidence', 0.95),
+        track_energy=settings.get('track_energy', True),
+        limits=resource_limits(config),
+    )
+    report_path = os.path.join(config.get('report', {}).get('report_directory', './reports'), 'impact.json')
+    write_report(report, report_path)
+    print(f"Impact report saved to {report_path}")
+    return report
+
+def main(repo_url, github_token, script_name='example_script.py', config_file='config.yaml'):
     """
     Main function to orchestrate the cloning, metric calculation, and optimization processes.
 
@@ -102,25 +278,47 @@ def main(repo_url, github_token, script_name='example_script.py'):
         repo_url (str): The URL of the GitHub repository to clone.
         github_token (str): The GitHub token for accessing the repository data.
         script_name (str): The name of the script to run for initial metrics calculation.
+        config_file (str): Path to the configuration file.
     """
+    config = load_config(config_file)
+    setup_logging(config)
+    timeout = config.get('execution', {}).get('timeout')
+
     # Derive the repository name from the URL and set the target directory
     repo_name = repo_url.split('/')[-1].replace('.git', '')
     target_dir = os.path.join(os.getcwd(), repo_name)
+    original_dir = f"{target_dir}_original"
 
+    runner = script_runner(config)
     try:
         # Step 1: Clone the repository
-        clone_repository(repo_url, target_dir)
+        clone_repository(repo_url, target_dir, config)
 
         # Step 2: Calculate initial metrics
-        initial_metrics = calculate_initial_metrics(target_dir, script_name)
+        initial_metrics = calculate_initial_metrics(target_dir, script_name, timeout, runner)
         print(f"Initial Metrics: {initial_metrics}")
 
-        # Step 3: Optimize the code
-        optimization_results = optimize_code(target_dir, github_token)
+        # Keep an untouched copy so the optimized code can be measured against it
+        shutil.copytree(target_dir, original_dir, ignore=shutil.ignore_patterns('.git'), dirs_exist_ok=True)
+
+        # Step 3: Optimize the code, starting with the functions the profile shows are hot
+        hot = find_hot_functions(target_dir, script_name, config)
+        if hot and config.get('profiling', {}).get('jit', True):
+            jit_hot_functions(hot, config)
+        optimization_results = optimize_code(target_dir, github_token, hot, config)
         print(f"Optimization Results: {optimization_results}")
 
+        # Step 4: Measure the impact of the optimizations
+        report = measure_impact(original_dir, target_dir, script_name, config)
+        for metric, result in report['comparison'].items():
+            if result['relative_change'] is not None:
+                verdict = "significant" if result['significant'] else "not significant"
+                print(f"{metric}: {result['relative_change']:+.1%} (p={result['p_value']:.3f}, {verdict})")
+
     except Exception as e:
         print(f"An error occurred in the process: {e}")
+    finally:
+        runner.close()
 
 if __name__ == "__main__":
     # Example usage:
@@ -0,0 +1,349 @@
+import argparse
+import ast
+import copy
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from analysis_engine import analyze_source
+from benchmark_harness import emissions_tracker
+from rewrite_rules import FUNCTION_NODES, detect_patterns, make_sample_args, module_namespace, optimize_source
+from script_runner import DEFAULT_LIMITS, limit_resources
+from sustainability_report import find_python_files
+
+SAMPLE_DIRECTORIES = ('Code Samples', 'Code_testing')
+DEFAULT_SIZES = (10, 100, 1000)
+DEFAULT_BASELINE = './reports/benchmark_baseline.json'
+# Differences smaller than these are treated as noise, however large they are relatively
+NOISE_FLOOR = {'time': 0.001, 'peak_memory': 64 * 1024, 'energy_consumed': 1e-9}
+
+def discover_samples(directories: Sequence[str] = SAMPLE_DIRECTORIES) -> List[str]:
+    """
+    Find every sample program, including the ones saved without a .py extension.
+
+    Args:
+        directories (Sequence[str]): Directories to search.
+
+    Returns:
+        List[str]: Sorted file paths.
+    """
+    samples = []
+    for directory in directories:
+        samples.extend(find_python_files(directory, include_extensionless=True))
+    return sorted(samples)
+
+def benchmarkable_functions(source: str) -> List[ast.AST]:
+    """
+    Get the top-level functions of a sample that take a size-dependent input.
+
+    Functions without parameters do a fixed amount of work and `main` drives the whole script,
+    so neither can be run at different input sizes.
+
+    Args:
+        source (str): The sample's source code.
+
+    Returns:
+        List[ast.AST]: The function definitions.
+    """
+    functions = []
+    for node in ast.parse(source).body:
+        if isinstance(node, FUNCTION_NODES) and node.name != 'main' and node.args.args:
+            with tempfile.TemporaryDirectory() as workdir:
+                if make_sample_args(node, 0, workdir) is not None:
+                    functions.append(node)
+    return functions
+
+def _benchmark_worker(source: str, function_name: str, size: int, repeats: int, track_energy: bool,
+                      limits: Dict[str, Optional[int]], conn) -> None:
+    limit_resources(limits)
+    result = {'status': 'ok', 'error': None}
+    workdir = tempfile.mkdtemp(prefix='regression_benchmark_')
+    cwd = os.getcwd()
+    try:
+        module = ast.parse(source)
+        namespace = module_namespace(module)
+        function = next(node for node in module.body if isinstance(node, FUNCTION_NODES) and node.name == function_name)
+        args = make_sample_args(function, size, workdir)
+        target = namespace[function_name]
+        os.chdir(workdir)
+
+        def call():
+            # Samples sort and append in place, so every call gets its own copy of the inputs
+            arguments = copy.deepcopy(args)
+            random.seed(size)
+            with redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                target(*arguments)
+                return time.perf_counter() - start
+
+        # One warmup call, then the timed calls without tracemalloc slowing them down
+        call()
+        tracker = emissions_tracker() if track_energy else None
+        if tracker is not None:
+            tracker.start()
+        times = [call() for _ in range(repeats)]
+        if tracker is not None:
+            tracker.stop()
+        tracemalloc.start()
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        energy = None
+        if tracker is not None and tracker.final_emissions_data is not None:
+            energy = tracker.final_emissions_data.energy_consumed / repeats
+        result.update(time=statistics.median(times), times=times, peak_memory=peak, energy_consumed=energy)
+    except Exception as e:
+        result.update(status='error', error=f"{type(e).__name__}: {e}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    conn.send(result)
+    conn.close()
+
+def benchmark_function(source: str, function_name: str, size: int, repeats: int = 5, timeout: float = 10.0,
+                       track_energy: bool = True, limits: Optional[Dict[str, Optional[int]]] = None) -> Dict[str, Any]:
+    """
+    Time one sample function at one input size, in a separate process and a scratch directory.
+
+    Args:
+        source (str): The sample's source code.
+        function_name (str): The top-level function to call.
+        size (int): The input size passed to make_sample_args.
+        repeats (int): Number of timed calls.
+        timeout (float): Seconds before the benchmark is abandoned.
+        track_energy (bool): Whether to measure energy with CodeCarbon, if it is installed.
+        limits (Dict[str, Optional[int]], optional): CPU time, memory and file size limits for the
+            benchmark process (see script_runner.limit_resources). Defaults to DEFAULT_LIMITS.
+
+    Returns:
+        Dict[str, Any]: 'status' ('ok', 'error' or 'timeout'), 'error', and for successful runs the
+        median 'time' in seconds, the individual 'times', 'peak_memory' in bytes (from tracemalloc)
+        and 'energy_consumed' per call in kWh (or None).
+    """
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    # Not a daemon, so a function that starts processes of its own can be benchmarked
+    process = multiprocessing.Process(target=_benchmark_worker,
+                                      args=(source, function_name, size, repeats, track_energy,
+                                            DEFAULT_LIMITS if limits is None else limits, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        if parent_conn.poll(timeout):
+            return parent_conn.recv()
+        return {'status': 'timeout', 'error': f"timed out after {timeout}s"}
+    except EOFError:
+        return {'status': 'error', 'error': "benchmark process crashed"}
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        parent_conn.close()
+
+def benchmark_samples(samples: Sequence[str], sizes: Sequence[int] = DEFAULT_SIZES, repeats: int = 5,
+                      timeout: float = 10.0, track_energy: bool = True,
+                      limits: Optional[Dict[str, Optional[int]]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Benchmark every size-dependent function of the samples at each input size.
+
+    Once a function times out, its larger sizes are skipped. A sample without such a function,
+    e.g. a script that does all its work at the top level, is reported as skipped under its path.
+
+    Args:
+        samples (Sequence[str]): Sample file paths.
+        sizes (Sequence[int]): Input sizes, smallest first.
+        repeats (int): Number of timed calls per function and size.
+        timeout (float): Seconds allowed per function and size.
+        track_energy (bool): Whether to measure energy.
+        limits (Dict[str, Optional[int]], optional): Resource limits per benchmark (see benchmark_function).
+
+    Returns:
+        Dict[str, Dict[str, Any]]: Results keyed by '<sample>::<function>[<size>]', or by
+        '<sample>' for skipped samples.
+    """
+    results = {}
+    for path in samples:
+        with open(path, 'r', encoding='utf-8') as f:
+            source = f.read()
+        functions = benchmarkable_functions(source)
+        if not functions:
+            results[path] = {'status': 'skipped', 'error': "no function takes a size-dependent input"}
+            print(f"{path}: {_describe(results[path])}")
+            continue
+        for function in functions:
+            timed_out = False
+            for size in sorted(sizes):
+                key = f"{path}::{function.name}[{size}]"
+                if timed_out:
+                    results[key] = {'status': 'skipped', 'error': "a smaller size timed out"}
+                    continue
+                results[key] = benchmark_function(source, function.name, size, repeats, timeout, track_energy, limits)
+                timed_out = results[key]['status'] == 'timeout'
+                print(f"{key}: {_describe(results[key])}")
+    return results
+
+def _measure_in_process(operation: Callable[[], Any], repeats: int) -> Dict[str, Any]:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'status': 'ok', 'error': None, 'time': statistics.median(times), 'times': times,
+            'peak_memory': peak, 'energy_consumed': None}
+
+def benchmark_tooling(samples: Sequence[str], repeats: int = 5) -> Dict[str, Dict[str, Any]]:
+    """
+    Measure the overhead of the analysis tooling itself over the whole sample corpus.
+
+    Covers the metric engine, the anti-pattern detector and rule matching (without the
+    equivalence check, which is dominated by running the samples).
+
+    Args:
+        samples (Sequence[str]): Sample file paths.
+        repeats (int): Number of timed passes over the corpus.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: Results keyed by 'tooling::<operation>'.
+    """
+    sources = []
+    for path in samples:
+        with open(path, 'r', encoding='utf-8') as f:
+            sources.append(f.read())
+    operations = {
+        'analyze_source': lambda: [analyze_source(source) for source in sources],
+        'detect_patterns': lambda: [detect_patterns(ast.parse(source)) for source in sources],
+        'rewrite_rules': lambda: [optimize_source(source, verify=False) for source in sources],
+    }
+    results = {}
+    for name, operation in operations.items():
+        key = f"tooling::{name}"
+        results[key] = _measure_in_process(operation, repeats)
+        print(f"{key}: {_describe(results[key])}")
+    return results
+
+def _describe(result: Dict[str, Any]) -> str:
+    if result['status'] != 'ok':
+        return f"{result['status']} ({result['error']})"
+    return f"{1000 * result['time']:.2f} ms, peak {result['peak_memory'] / 1024:.1f} KiB"
+
+def compare_to_baseline(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]],
+                        threshold: float = 0.25) -> List[Dict[str, Any]]:
+    """
+    Find the benchmarks that got worse than the baseline by more than the threshold.
+
+    A benchmark regresses when a metric grows by more than `threshold` (relative) and by more than
+    its noise floor (absolute), or when it no longer completes although it did in the baseline.
+
+    Args:
+        results (Dict[str, Dict[str, Any]]): Current results.
+        baseline (Dict[str, Dict[str, Any]]): Baseline results.
+        threshold (float): Allowed relative increase, e.g. 0.25 for 25%.
+
+    Returns:
+        List[Dict[str, Any]]: One entry per regressed metric, with 'benchmark', 'metric',
+        'baseline' and 'current' values.
+    """
+    regressions = []
+    for key, before in sorted(baseline.items()):
+        after = results.get(key)
+        if after is None or before['status'] != 'ok':
+            continue
+        if after['status'] != 'ok':
+            regressions.append({'benchmark': key, 'metric': 'status', 'baseline': 'ok', 'current': after['status']})
+            continue
+        for metric, floor in NOISE_FLOOR.items():
+            old, new = before.get(metric), after.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + threshold) and new - old > floor:
+                regressions.append({'benchmark': key, 'metric': metric, 'baseline': old, 'current': new})
+    return regressions
+
+def load_baseline(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Load a saved baseline.
+
+    Args:
+        path (str): Path to the baseline JSON file.
+
+    Returns:
+        Optional[Dict[str, Any]]: The baseline, or None if the file doesn't exist.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_baseline(results: Dict[str, Dict[str, Any]], path: str, sizes: Sequence[int], repeats: int) -> None:
+    """
+    Save results as the new baseline.
+
+    Args:
+        results (Dict[str, Dict[str, Any]]): The benchmark results.
+        path (str): Path to the baseline JSON file.
+        sizes (Sequence[int]): Input sizes the results were measured at.
+        repeats (int): Timed calls per benchmark.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    baseline = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+                'sizes': list(sizes), 'repeats': repeats, 'results': results}
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """
+    Run the suite and compare it to the baseline, or record a new baseline.
+
+    Returns:
+        int: The exit status: 1 if anything regressed, 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(description="Regression benchmarks over the sample corpus.")
+    parser.add_argument('directories', nargs='*', default=list(SAMPLE_DIRECTORIES), help="Sample directories")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Baseline JSON file")
+    parser.add_argument('--update-baseline', action='store_true', help="Save the results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Allowed relative slowdown")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help="Input sizes")
+    parser.add_argument('--repeats', type=int, default=5, help="Timed calls per benchmark")
+    parser.add_argument('--timeout', type=float, default=10.0, help="Seconds allowed per benchmark")
+    parser.add_argument('--no-energy', action='store_true', help="Don't measure energy")
+    parser.add_argument('--skip-tooling', action='store_true', help="Don't benchmark the analysis tooling")
+    args = parser.parse_args(argv)
+
+    samples = discover_samples(args.directories)
+    results = benchmark_samples(samples, args.sizes, args.repeats, args.timeout, not args.no_energy)
+    if not args.skip_tooling:
+        results.update(benchmark_tooling(samples, args.repeats))
+
+    if args.update_baseline:
+        save_baseline(results, args.baseline, args.sizes, args.repeats)
+        print(f"Baseline with {len(results)} benchmarks saved to {args.baseline}")
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --update-baseline to create one.")
+        return 0
+    regressions = compare_to_baseline(results, baseline['results'], args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression['benchmark']} {regression['metric']}: "
+              f"{regression['baseline']} -> {regression['current']}")
+    print(f"{len(regressions)} regressions in {len(results)} benchmarks (threshold {args.threshold:.0%}).")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
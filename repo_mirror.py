@@ -0,0 +1,281 @@
+import argparse
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+DEFAULT_CACHE_DIRECTORY = './repo_cache'
+
+def _git(*args: str, cwd: Optional[str] = None) -> str:
+    result = subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True)
+    return result.stdout.strip()
+
+def remote_url(url: str) -> str:
+    """
+    Normalize a repository location for git.
+
+    Git ignores --depth and --filter when cloning a plain local path, so local repositories are
+    addressed with a file:// URL instead.
+
+    Args:
+        url (str): A remote URL or a path to a local repository.
+
+    Returns:
+        str: The URL to fetch from.
+    """
+    if os.path.isdir(url):
+        return 'file://' + os.path.abspath(url)
+    return url
+
+def same_repository(a: str, b: str) -> bool:
+    """
+    Check whether two repository locations name the same repository.
+
+    Args:
+        a (str): A remote URL or a path to a local repository.
+        b (str): Another one.
+
+    Returns:
+        bool: True if they are equal apart from a trailing slash or '.git'.
+    """
+    def normalize(url: str) -> str:
+        url = remote_url(url).rstrip('/')
+        return url[:-4] if url.endswith('.git') else url
+
+    return normalize(a) == normalize(b)
+
+class MirrorCache:
+    """
+    A local cache of bare repository mirrors, with a cheap worktree per analysis.
+
+    Each remote repository is cloned once, bare, into the cache directory; later runs only fetch
+    what changed. Checkouts are git worktrees of the mirror, so they share its object store
+    instead of copying the history. Optionally the mirrors are shallow (`depth`) and/or partial
+    (`filter`, e.g. 'blob:none', which downloads file contents only when a checkout needs them).
+
+    Updates and worktree changes to a mirror hold an exclusive lock on it, so parallel jobs,
+    in this process or others, can share one mirror.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIRECTORY, depth: Optional[int] = None,
+                 filter: Optional[str] = 'blob:none', refresh_interval: float = 300):
+        """
+        Args:
+            directory (str): Where the mirrors are kept.
+            depth (int, optional): Fetch only this many commits of history. None or 0 for all of it.
+            filter (str, optional): A partial-clone filter such as 'blob:none', or None for full clones.
+            refresh_interval (float): Seconds during which a fetched branch is considered up to date.
+        """
+        self.directory = directory
+        self.depth = depth or None
+        self.filter = filter or None
+        self.refresh_interval = refresh_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def mirror_path(self, url: str) -> str:
+        """
+        Get the location of a repository's mirror in the cache.
+
+        Args:
+            url (str): The repository URL.
+
+        Returns:
+            str: The path of the bare mirror; it may not exist yet.
+        """
+        url = remote_url(url)
+        name = re.sub(r'[^A-Za-z0-9._-]+', '_', url.rstrip('/').split('/')[-1])
+        if name.endswith('.git'):
+            name = name[:-4]
+        digest = hashlib.sha1(url.encode()).hexdigest()[:12]
+        return os.path.join(os.path.abspath(self.directory), f"{name}-{digest}.git")
+
+    @contextmanager
+    def lock(self, url: str) -> Iterator[str]:
+        """
+        Hold the exclusive lock on a repository's mirror.
+
+        Args:
+            url (str): The repository URL.
+
+        Yields:
+            str: The path of the mirror.
+        """
+        path = self.mirror_path(url)
+        with open(path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield path
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _fetch_options(self) -> List[str]:
+        options = []
+        if self.depth:
+            options += ['--depth', str(self.depth)]
+        return options
+
+    @staticmethod
+    def _marker(path: str, branch: Optional[str]) -> str:
+        # One file per fetched branch, and one for fetches of every branch; its mtime is the fetch time
+        name = hashlib.sha1(branch.encode()).hexdigest()[:12] if branch else 'all'
+        return os.path.join(path, 'refreshed', name)
+
+    def _mark_fresh(self, path: str, branch: Optional[str]) -> None:
+        marker = self._marker(path, branch)
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        with open(marker, 'a'):
+            os.utime(marker)
+
+    def _is_fresh(self, path: str, branch: Optional[str]) -> bool:
+        # A fetch of one branch says nothing about the others, but a fetch of all covers each of them
+        for marker in {self._marker(path, None), self._marker(path, branch)}:
+            try:
+                if time.time() - os.path.getmtime(marker) < self.refresh_interval:
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def _update(self, url: str, path: str, branch: Optional[str], force: bool) -> None:
+        refspec = f"+refs/heads/{branch}:refs/heads/{branch}" if branch else '+refs/heads/*:refs/heads/*'
+        if not os.path.isdir(path):
+            clone = ['clone', '--bare', '--no-tags']
+            if self.filter:
+                clone += [f"--filter={self.filter}"]
+            if self.depth:
+                clone += ['--depth', str(self.depth)]
+            if branch:
+                clone += ['--single-branch', '--branch', branch]
+            # Clone next to the final location and rename, so a failed clone never leaves a half mirror
+            partial = path + '.partial'
+            shutil.rmtree(partial, ignore_errors=True)
+            _git(*clone, remote_url(url), partial)
+            # A bare clone keeps branches as they are on the remote, but records no fetch refspec
+            _git('config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*', cwd=partial)
+            os.rename(partial, path)
+            self._mark_fresh(path, branch)
+            return
+        if not force and self._is_fresh(path, branch):
+            return
+        _git('fetch', '--prune', '--no-tags', *self._fetch_options(), 'origin', refspec, cwd=path)
+        self._mark_fresh(path, branch)
+
+    def update(self, url: str, branch: Optional[str] = None, force: bool = False) -> str:
+        """
+        Create or refresh a repository's mirror.
+
+        Args:
+            url (str): The repository URL or local path.
+            branch (str, optional): Fetch only this branch. Defaults to all branches.
+            force (bool): Fetch even if the mirror was fetched within the refresh interval.
+
+        Returns:
+            str: The path of the mirror.
+
+        Raises:
+            subprocess.CalledProcessError: If git fails.
+        """
+        with self.lock(url) as path:
+            self._update(url, path, branch, force)
+        return path
+
+    def checkout(self, url: str, target_dir: str, branch: Optional[str] = None, force: bool = False) -> str:
+        """
+        Check out a repository into a directory, as a worktree of its mirror.
+
+        An existing worktree of the same mirror at `target_dir` is reset to the branch's latest
+        commit, discarding local changes.
+
+        Args:
+            url (str): The repository URL or local path.
+            target_dir (str): Where to check it out.
+            branch (str, optional): The branch to check out. Defaults to the remote's default branch.
+            force (bool): Fetch even if the mirror was fetched within the refresh interval.
+
+        Returns:
+            str: The commit checked out.
+
+        Raises:
+            subprocess.CalledProcessError: If git fails.
+            FileExistsError: If `target_dir` exists and is not a worktree of the mirror.
+        """
+        target_dir = os.path.abspath(target_dir)
+        with self.lock(url) as path:
+            self._update(url, path, branch, force)
+            commit = _git('rev-parse', '--verify', f"{branch or 'HEAD'}^{{commit}}", cwd=path)
+            if os.path.exists(target_dir) and os.listdir(target_dir):
+                if target_dir not in self.worktrees(url):
+                    raise FileExistsError(f"{target_dir} exists and is not a checkout of {url}")
+                _git('checkout', '--force', '--detach', commit, cwd=target_dir)
+                _git('clean', '-ffdx', cwd=target_dir)
+            else:
+                # Worktrees left behind by deleted directories would block adding this one
+                _git('worktree', 'prune', cwd=path)
+                # Detached, so any number of checkouts of the same branch can coexist
+                _git('worktree', 'add', '--force', '--detach', target_dir, commit, cwd=path)
+        return commit
+
+    def worktrees(self, url: str) -> List[str]:
+        """
+        List the checkouts of a repository's mirror.
+
+        Args:
+            url (str): The repository URL.
+
+        Returns:
+            List[str]: Absolute paths of the worktrees.
+        """
+        path = self.mirror_path(url)
+        if not os.path.isdir(path):
+            return []
+        output = _git('worktree', 'list', '--porcelain', cwd=path)
+        return [line[len('worktree '):] for line in output.splitlines()
+                if line.startswith('worktree ') and line[len('worktree '):] != path]
+
+    def remove(self, url: str, target_dir: str) -> None:
+        """
+        Delete a checkout made with `checkout`.
+
+        Args:
+            url (str): The repository URL.
+            target_dir (str): The checkout's directory.
+        """
+        with self.lock(url) as path:
+            _git('worktree', 'remove', '--force', os.path.abspath(target_dir), cwd=path)
+
+def mirror_cache(config: Dict[str, Any]) -> MirrorCache:
+    """
+    Create the mirror cache described by the 'repository' section of config.yaml.
+
+    Args:
+        config (Dict[str, Any]): The loaded configuration.
+
+    Returns:
+        MirrorCache: The cache.
+    """
+    settings = config.get('repository', {})
+    return MirrorCache(
+        directory=settings.get('cache_directory', DEFAULT_CACHE_DIRECTORY),
+        depth=settings.get('depth'),
+        filter=settings.get('filter', 'blob:none'),
+        refresh_interval=settings.get('refresh_interval', 300),
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check out a repository through the local mirror cache.")
+    parser.add_argument('url', help="Repository URL or local path")
+    parser.add_argument('target', help="Directory to check it out into")
+    parser.add_argument('--branch', help="Branch to check out")
+    parser.add_argument('--cache', default=DEFAULT_CACHE_DIRECTORY, help="Mirror cache directory")
+    parser.add_argument('--depth', type=int, help="Shallow history depth")
+    parser.add_argument('--filter', default='blob:none', help="Partial-clone filter, or '' for full clones")
+    args = parser.parse_args()
+
+    cache = MirrorCache(args.cache, depth=args.depth, filter=args.filter)
+    commit = cache.checkout(args.url, args.target, args.branch, force=True)
+    print(f"Checked out {commit[:12]} into {args.target}")
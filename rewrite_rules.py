@@ -0,0 +1,978 @@
+import ast
+import copy
+import io
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from script_runner import DEFAULT_LIMITS, limit_resources
+
+# Loops that are statements, as opposed to comprehension clauses
+STATEMENT_LOOPS = (ast.For, ast.AsyncFor, ast.While)
+FUNCTION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+# Builtins that cannot mutate their arguments, so comprehensions calling them can be reordered safely
+PURE_BUILTINS = {'len', 'range', 'abs', 'min', 'max', 'sum', 'str', 'int', 'float', 'round', 'bool', 'pow'}
+# What a container built by a display, a comprehension or a call to these is
+CONSTRUCTOR_KINDS = {'list': 'list', 'sorted': 'list', 'tuple': 'tuple', 'str': 'str', 'set': 'set',
+                     'frozenset': 'set', 'dict': 'dict', 'range': 'range'}
+# Annotations that say what a parameter is, from the builtins and typing
+ANNOTATION_KINDS = {'list': 'list', 'List': 'list', 'Sequence': 'list', 'MutableSequence': 'list',
+                    'tuple': 'tuple', 'Tuple': 'tuple', 'str': 'str', 'set': 'set', 'Set': 'set',
+                    'frozenset': 'set', 'FrozenSet': 'set', 'dict': 'dict', 'Dict': 'dict', 'Mapping': 'dict'}
+HASHABLE_TYPES = {'int', 'float', 'complex', 'bool', 'str', 'bytes'}
+# Containers whose items are found by position, so seq[i] for i in range(len(seq)) is the i-th item
+SEQUENCE_KINDS = {'list', 'tuple', 'str', 'range'}
+# Containers that can be iterated again and again, unlike iterators and generators
+CONTAINER_KINDS = SEQUENCE_KINDS | {'set', 'dict'}
+
+def _dump(node: ast.AST) -> str:
+    return ast.dump(node, include_attributes=False)
+
+def _template(code: str) -> str:
+    """Parse a statement template and return its dump for structural comparison."""
+    return _dump(ast.parse(code).body[0])
+
+def _is_name(node: ast.AST, name: Optional[str] = None) -> bool:
+    return isinstance(node, ast.Name) and (name is None or node.id == name)
+
+def _is_empty_list(node: ast.AST) -> bool:
+    if isinstance(node, ast.List):
+        return not node.elts
+    return isinstance(node, ast.Call) and _is_name(node.func, 'list') and not node.args and not node.keywords
+
+def _names(node: ast.AST) -> Set[str]:
+    """All names read or written anywhere inside a node."""
+    return {child.id for child in ast.walk(node) if isinstance(child, ast.Name)}
+
+def _stored_names(nodes: Iterable[ast.AST]) -> Set[str]:
+    """Names bound anywhere inside the given nodes."""
+    return {child.id for node in nodes for child in ast.walk(node)
+            if isinstance(child, ast.Name) and isinstance(child.ctx, (ast.Store, ast.Del))}
+
+def _simple_assign(node: ast.AST) -> Optional[Tuple[str, ast.AST]]:
+    """Match `name = value` and return (name, value)."""
+    if isinstance(node, ast.Assign) and len(node.targets) == 1 and _is_name(node.targets[0]):
+        return node.targets[0].id, node.value
+    return None
+
+def _method_call(node: ast.AST, method: str) -> Optional[Tuple[str, List[ast.AST]]]:
+    """Match the statement `obj.method(args)` and return (obj, args)."""
+    if (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+            and isinstance(node.value.func, ast.Attribute) and node.value.func.attr == method
+            and _is_name(node.value.func.value) and not node.value.keywords):
+        return node.value.func.value.id, node.value.args
+    return None
+
+def _kind(node: ast.AST) -> Optional[str]:
+    """What kind of container an expression builds, if that is evident from the expression alone."""
+    if isinstance(node, (ast.List, ast.ListComp)):
+        return 'list'
+    if isinstance(node, ast.Tuple):
+        return 'tuple'
+    if isinstance(node, (ast.Set, ast.SetComp)):
+        return 'set'
+    if isinstance(node, (ast.Dict, ast.DictComp)):
+        return 'dict'
+    if isinstance(node, ast.JoinedStr) or (isinstance(node, ast.Constant) and isinstance(node.value, str)):
+        return 'str'
+    if isinstance(node, ast.Call) and _is_name(node.func):
+        return CONSTRUCTOR_KINDS.get(node.func.id)
+    return None
+
+def _annotation_name(node: Optional[ast.AST]) -> Optional[str]:
+    if isinstance(node, ast.Subscript):
+        node = node.value
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return node.id if isinstance(node, ast.Name) else None
+
+class RewriteContext:
+    """What a rule needs to know about the function it is rewriting."""
+
+    def __init__(self, function: ast.AST):
+        self.function = function
+        self._taken = _names(function) | {arg.arg for arg in ast.walk(function) if isinstance(arg, ast.arg)}
+        # Every value each name is given in the function; a parameter's first value is its annotation
+        self._bindings: Dict[str, List[Optional[ast.AST]]] = {}
+        if isinstance(function, FUNCTION_NODES):
+            arguments = function.args
+            for arg in arguments.posonlyargs + arguments.args + arguments.kwonlyargs:
+                self._bindings[arg.arg] = [arg.annotation]
+            for arg in (arguments.vararg, arguments.kwarg):
+                if arg is not None:
+                    self._bindings[arg.arg] = [None]
+        assigned = set()
+        for node in ast.walk(function):
+            match = _simple_assign(node)
+            if match is not None:
+                assigned.add(id(node.targets[0]))
+                self._bindings.setdefault(match[0], []).append(('value', match[1]))
+        for node in ast.walk(function):
+            if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load) and id(node) not in assigned:
+                self._bindings.setdefault(node.id, []).append(None)  # Bound some other way: unknown
+            elif isinstance(node, (ast.Global, ast.Nonlocal)):
+                for name in node.names:
+                    self._bindings.setdefault(name, []).append(None)
+
+    def _binding_kinds(self, name: str) -> List[Tuple[Optional[str], Optional[ast.AST]]]:
+        # (kind, element type or value) of each binding of a name
+        kinds = []
+        for binding in self._bindings.get(name, [None]):
+            if isinstance(binding, tuple):
+                kinds.append((_kind(binding[1]), binding[1]))
+            elif binding is not None:
+                kinds.append((ANNOTATION_KINDS.get(_annotation_name(binding)), binding))
+            else:
+                kinds.append((None, None))
+        return kinds
+
+    def kind(self, name: str) -> Optional[str]:
+        """
+        Tell what kind of container a name always holds in the function.
+
+        Args:
+            name (str): A local variable or parameter.
+
+        Returns:
+            Optional[str]: 'list', 'tuple', 'str', 'set', 'dict' or 'range' if every value the name
+            is given (or its annotation, for a parameter) says so, otherwise None.
+        """
+        kinds = {kind for kind, _ in self._binding_kinds(name)}
+        return kinds.pop() if len(kinds) == 1 else None
+
+    def hashable_items(self, node: ast.AST) -> bool:
+        """
+        Tell whether iterating over an expression only ever yields hashable items.
+
+        Sets, dict keys, strings and ranges always do; lists and tuples do when they are displays
+        of constants or annotated with a hashable item type, e.g. List[int].
+
+        Args:
+            node (ast.AST): The expression iterated over.
+
+        Returns:
+            bool: True if the items are known to be hashable.
+        """
+        bindings = self._binding_kinds(node.id) if _is_name(node) else [(_kind(node), node)]
+        for kind, source in bindings:
+            if kind in ('set', 'dict', 'str', 'range'):
+                continue
+            if kind not in ('list', 'tuple'):
+                return False
+            if isinstance(source, (ast.List, ast.Tuple, ast.Set)):
+                if not all(isinstance(element, ast.Constant) for element in source.elts):
+                    return False
+            elif isinstance(source, ast.Subscript):
+                items = source.slice.elts if isinstance(source.slice, ast.Tuple) else [source.slice]
+                if not items or not all(_annotation_name(item) in HASHABLE_TYPES for item in items
+                                        if not (isinstance(item, ast.Constant) and item.value is Ellipsis)):
+                    return False
+            else:
+                return False
+        return True
+
+    def used_outside(self, region: List[ast.AST], names: Set[str]) -> bool:
+        """
+        Check whether any of `names` appears in the function outside the given statements.
+
+        Args:
+            region (List[ast.AST]): The statements about to be replaced.
+            names (Set[str]): The names to look for.
+
+        Returns:
+            bool: True if a name is used elsewhere, so the rewrite would change what it sees.
+        """
+        inside = {id(child) for statement in region for child in ast.walk(statement)}
+        return any(isinstance(child, ast.Name) and child.id in names and id(child) not in inside
+                   for child in ast.walk(self.function))
+
+    def fresh_name(self, base: str) -> str:
+        """
+        Pick a variable name that doesn't clash with anything in the function.
+
+        Args:
+            base (str): The preferred name.
+
+        Returns:
+            str: `base`, or `base` with a numeric suffix.
+        """
+        name, suffix = base, 1
+        while name in self._taken:
+            suffix += 1
+            name = f"{base}_{suffix}"
+        self._taken.add(name)
+        return name
+
+class RewriteRule:
+    """
+    A mechanical, behaviour-preserving fix for one anti-pattern.
+
+    `apply` looks at the statement at `index` in a block (and may look at its neighbours). If the
+    pattern matches it returns how many statements to replace and what to replace them with.
+    """
+    name = "rule"
+    description = ""
+    # Rules run in ascending phase order; each phase makes its own pass over the function
+    phase = 0
+
+    def apply(self, statements: List[ast.stmt], index: int, context: RewriteContext) -> Optional[Tuple[int, List[ast.stmt]]]:
+        """
+        Try to rewrite the statements starting at `index`.
+
+        Args:
+            statements (List[ast.stmt]): The enclosing block.
+            index (int): Where the pattern would start.
+            context (RewriteContext): The function being rewritten.
+
+        Returns:
+            Optional[Tuple[int, List[ast.stmt]]]: (statements consumed, replacement), or None if the pattern doesn't match.
+        """
+        return None
+
+class DedupMembershipRule(RewriteRule):
+    """`x = []` + `for v in it: if v not in x: x.append(v)` becomes `x = list(dict.fromkeys(it))`."""
+    name = "dedup_membership"
+    description = "Order-preserving de-duplication with a dict instead of list membership tests (items must be hashable)."
+
+    # dict.fromkeys raises TypeError on unhashable items, which list membership tests handle, so the
+    # items must be known to be hashable (see RewriteContext.hashable_items)
+
+    def apply(self, statements, index, context):
+        if index + 1 >= len(statements):
+            return None
+        assign, loop = _simple_assign(statements[index]), statements[index + 1]
+        if assign is None or not _is_empty_list(assign[1]) or not isinstance(loop, ast.For) or not _is_name(loop.target):
+            return None
+        result, item = assign[0], loop.target.id
+        expected = _template(f"for {item} in _:\n    if {item} not in {result}:\n        {result}.append({item})")
+        probe = ast.For(target=loop.target, iter=ast.Name(id='_', ctx=ast.Load()), body=loop.body, orelse=loop.orelse)
+        if _dump(probe) != expected or result in _names(loop.iter):
+            return None
+        if context.used_outside(statements[index:index + 2], {item}) or not context.hashable_items(loop.iter):
+            return None
+        value = ast.parse("list(dict.fromkeys(_))", mode='eval').body
+        value.args[0].args[0] = loop.iter
+        return 2, [ast.Assign(targets=[ast.Name(id=result, ctx=ast.Store())], value=value)]
+
+class StringJoinRule(RewriteRule):
+    """`s = ''` + `for t in it: s += expr` becomes `s = ''.join([expr for t in it])`."""
+    name = "string_join"
+    description = "Build strings with str.join instead of repeated += concatenation."
+
+    def apply(self, statements, index, context):
+        if index + 1 >= len(statements):
+            return None
+        assign, loop = _simple_assign(statements[index]), statements[index + 1]
+        if (assign is None or not isinstance(assign[1], ast.Constant) or not isinstance(assign[1].value, str)
+                or not isinstance(loop, ast.For) or loop.orelse or len(loop.body) != 1):
+            return None
+        name, initial = assign[0], assign[1].value
+        step = loop.body[0]
+        if not (isinstance(step, ast.AugAssign) and _is_name(step.target, name) and isinstance(step.op, ast.Add)):
+            return None
+        if name in _names(step.value) or name in _names(loop.iter):
+            return None
+        if context.used_outside(statements[index:index + 2], _names(loop.target)):
+            return None
+        comprehension = ast.ListComp(elt=step.value, generators=[
+            ast.comprehension(target=loop.target, iter=loop.iter, ifs=[], is_async=0)])
+        value = ast.Call(func=ast.Attribute(value=ast.Constant(value=''), attr='join', ctx=ast.Load()),
+                         args=[comprehension], keywords=[])
+        if initial:
+            value = ast.BinOp(left=ast.Constant(value=initial), op=ast.Add(), right=value)
+        return 2, [ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())], value=value)]
+
+class _ReplaceCalls(ast.NodeTransformer):
+    def __init__(self, replacements: Dict[str, str]):
+        self.replacements = replacements
+
+    def visit_Call(self, node):
+        key = _dump(node)
+        if key in self.replacements:
+            return ast.copy_location(ast.Name(id=self.replacements[key], ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+class HoistAggregateRule(RewriteRule):
+    """`for x in data: ... sum(data) ...` computes `sum(data)` once before the loop."""
+    name = "hoist_aggregate"
+    description = "Compute sum() of an unchanged sequence once instead of on every iteration."
+    aggregates = ('sum',)
+    # Runs after the structural rules, so loops that become comprehensions are not split up first
+    phase = 1
+
+    def apply(self, statements, index, context):
+        loop = statements[index]
+        if not isinstance(loop, ast.For):
+            return None
+        # Only loops over a container that can be iterated again: computing the aggregate up front
+        # would exhaust an iterator before the loop. A sequence passed to len() is a container.
+        if _is_name(loop.iter) and context.kind(loop.iter.id) in CONTAINER_KINDS:
+            sequence = loop.iter.id
+        elif (isinstance(loop.iter, ast.Call) and _is_name(loop.iter.func, 'range') and len(loop.iter.args) == 1
+              and isinstance(loop.iter.args[0], ast.Call) and _is_name(loop.iter.args[0].func, 'len')
+              and len(loop.iter.args[0].args) == 1 and _is_name(loop.iter.args[0].args[0])):
+            sequence = loop.iter.args[0].args[0].id
+        else:
+            return None
+        if sequence in _names(loop.target) or _stored_names([loop]) & (set(self.aggregates) | {sequence}):
+            return None
+        if _stored_names([context.function]) & set(self.aggregates):
+            return None  # sum/len are shadowed somewhere in the function
+
+        # Locals that always hold a new container: calling their methods cannot change the sequence
+        fresh = {name for name in _stored_names([context.function]) if context.kind(name) in ('list', 'set', 'dict')}
+        hoisted = {}
+        for statement in loop.body:
+            for node in ast.walk(statement):
+                if isinstance(node, FUNCTION_NODES + (ast.Lambda,)) and sequence in _names(node):
+                    return None
+                if not isinstance(node, ast.Call):
+                    continue
+                if (_is_name(node.func) and node.func.id in self.aggregates and len(node.args) == 1
+                        and _is_name(node.args[0], sequence) and not node.keywords):
+                    hoisted.setdefault(node.func.id, node)
+                    continue
+                # Any other call that could mutate the sequence makes hoisting unsafe: a call to an
+                # arbitrary function may reach it through a global or an alias
+                if any(_is_name(arg, sequence) for arg in node.args) or any(_is_name(k.value, sequence) for k in node.keywords):
+                    return None
+                if _is_name(node.func) and node.func.id in PURE_BUILTINS and node.func.id not in _stored_names([context.function]):
+                    continue
+                if isinstance(node.func, ast.Attribute) and _is_name(node.func.value) and node.func.value.id in fresh \
+                        and node.func.value.id != sequence:
+                    continue
+                return None
+        if not hoisted:
+            return None
+        for node in ast.walk(loop):
+            if isinstance(node, ast.Subscript) and _is_name(node.value, sequence) and not isinstance(node.ctx, ast.Load):
+                return None
+
+        assignments, replacements = [], {}
+        for function, call in hoisted.items():
+            variable = context.fresh_name(f"{function}_{sequence}")
+            replacements[_dump(call)] = variable
+            assignments.append(ast.Assign(targets=[ast.Name(id=variable, ctx=ast.Store())], value=copy.deepcopy(call)))
+        loop.body = [_ReplaceCalls(replacements).visit(statement) for statement in loop.body]
+        return 1, assignments + [loop]
+
+class HoistAppendOpenRule(RewriteRule):
+    """
+    `for ...: with open(path, 'a') as f: f.write(...)` opens the file once, on the first iteration.
+
+    Opening in append mode creates the file, so it is not opened before the loop: a loop that
+    runs zero times must not create it.
+    """
+    name = "hoist_append_open"
+    description = "Open a file once for the whole loop instead of reopening it in append mode on every iteration."
+
+    def apply(self, statements, index, context):
+        loop = statements[index]
+        if not isinstance(loop, ast.For) or loop.orelse or len(loop.body) != 1:
+            return None
+        block = loop.body[0]
+        if not isinstance(block, ast.With) or len(block.items) != 1:
+            return None
+        item = block.items[0]
+        call, handle = item.context_expr, item.optional_vars
+        if not (isinstance(call, ast.Call) and _is_name(call.func, 'open') and _is_name(handle)):
+            return None
+        mode = call.args[1] if len(call.args) > 1 else next((k.value for k in call.keywords if k.arg == 'mode'), None)
+        if not (isinstance(mode, ast.Constant) and isinstance(mode.value, str) and 'a' in mode.value and '+' not in mode.value):
+            return None
+        # The file arguments must not depend on anything the loop changes
+        if _names(call) & (_stored_names([loop]) | _names(loop.target)):
+            return None
+        # The handle may only be written to; anything else (seek, close, passing it on) could see the difference
+        allowed = set()
+        for node in ast.walk(ast.Module(body=block.body, type_ignores=[])):
+            if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                    and _is_name(node.func.value, handle.id) and node.func.attr in ('write', 'writelines')):
+                allowed.add(id(node.func.value))
+        for node in ast.walk(ast.Module(body=block.body, type_ignores=[])):
+            if _is_name(node, handle.id) and id(node) not in allowed:
+                return None
+        # The handle is None before the first iteration, instead of unbound or its earlier value
+        if context.used_outside([loop], {handle.id}):
+            return None
+        template = ast.parse(
+            f"{handle.id} = None\n"
+            f"try:\n"
+            f"    for _ in _:\n"
+            f"        if {handle.id} is None:\n"
+            f"            {handle.id} = _\n"
+            f"finally:\n"
+            f"    if {handle.id} is not None:\n"
+            f"        {handle.id}.close()\n"
+        ).body
+        inner = template[1].body[0]
+        inner.target, inner.iter = loop.target, loop.iter
+        inner.body[0].body[0].value = call
+        inner.body.extend(block.body)
+        return 1, template
+
+class QuadraticSortRule(RewriteRule):
+    """Replaces bubble, exchange and selection-by-removal sorts with the built-in sort."""
+    name = "builtin_sort"
+    description = "Use the built-in O(n log n) sort instead of a hand-written O(n^2) sort."
+
+    @staticmethod
+    def _length_of(node: ast.AST, statements: List[ast.stmt], index: int) -> Optional[str]:
+        """Return the list whose length `node` is: either `len(a)` or a name assigned `len(a)` just before."""
+        if isinstance(node, ast.Call) and _is_name(node.func, 'len') and len(node.args) == 1 and _is_name(node.args[0]):
+            return node.args[0].id
+        if _is_name(node) and index > 0:
+            assign = _simple_assign(statements[index - 1])
+            if assign and assign[0] == node.id:
+                return QuadraticSortRule._length_of(assign[1], statements, index - 1)
+        return None
+
+    def apply(self, statements, index, context):
+        statement = statements[index]
+        if isinstance(statement, ast.While):
+            return self._selection_sort(statements, index, context)
+        if not (isinstance(statement, ast.For) and _is_name(statement.target) and isinstance(statement.iter, ast.Call)
+                and _is_name(statement.iter.func, 'range') and len(statement.iter.args) == 1
+                and len(statement.body) == 1 and isinstance(statement.body[0], ast.For)
+                and _is_name(statement.body[0].target)):
+            return None
+        outer, inner = statement, statement.body[0]
+        array = self._length_of(outer.iter.args[0], statements, index)
+        if array is None:
+            return None
+        i, j, n = outer.target.id, inner.target.id, ast.unparse(outer.iter.args[0])
+        probe = _dump(outer)
+        for op, reverse in (('>', False), ('<', True)):
+            bubble_body = (f"        if {array}[{j}] {op} {array}[{j} + 1]:\n"
+                           f"            {array}[{j}], {array}[{j} + 1] = {array}[{j} + 1], {array}[{j}]")
+            bubble = [f"for {i} in range({n}):\n    for {j} in range({start}{n} - {i} - 1):\n" + bubble_body
+                      for start in ('', '0, ')]
+            # Swapping whenever a[i] < a[j] over all pairs leaves the list in ascending order
+            exchange_op = '<' if op == '>' else '>'
+            exchange = (f"for {i} in range({n}):\n    for {j} in range({n}):\n"
+                        f"        if {array}[{i}] {exchange_op} {array}[{j}]:\n"
+                        f"            {array}[{i}], {array}[{j}] = {array}[{j}], {array}[{i}]")
+            if probe in [_template(code) for code in bubble + [exchange]]:
+                if context.used_outside([outer], {i, j}):
+                    return None
+                replacement = f"{array}.sort(reverse=True)" if reverse else f"{array}.sort()"
+                return 1, [ast.parse(replacement).body[0]]
+        return None
+
+    def _selection_sort(self, statements, index, context):
+        loop = statements[index]
+        if not _is_name(loop.test) or len(loop.body) != 4 or loop.orelse:
+            return None
+        array = loop.test.id
+        first = _simple_assign(loop.body[0])
+        scan, output = loop.body[1], _method_call(loop.body[3], 'append')
+        if first is None or output is None or not isinstance(scan, ast.For) or not _is_name(scan.target):
+            return None
+        minimum, item, result = first[0], scan.target.id, output[0]
+        for op, reverse in (('<', False), ('>', True)):
+            expected = _template(
+                f"while {array}:\n"
+                f"    {minimum} = {array}[0]\n"
+                f"    for {item} in {array}:\n"
+                f"        if {item} {op} {minimum}:\n"
+                f"            {minimum} = {item}\n"
+                f"    {array}.remove({minimum})\n"
+                f"    {result}.append({minimum})"
+            )
+            if _dump(loop) == expected:
+                if result == array or context.used_outside([loop], {minimum, item}):
+                    return None
+                order = ", reverse=True" if reverse else ""
+                return 1, ast.parse(f"{result}.extend(sorted({array}{order}))\n{array}.clear()").body
+        return None
+
+class _ReplaceSubscripts(ast.NodeTransformer):
+    def __init__(self, sequence: str, index: str, element: str):
+        self.sequence, self.index, self.element = sequence, index, element
+
+    def visit_Subscript(self, node):
+        if _is_name(node.value, self.sequence) and _is_name(node.slice, self.index):
+            return ast.copy_location(ast.Name(id=self.element, ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+class AppendLoopComprehensionRule(RewriteRule):
+    """
+    `x = []` + nested `for`/`if` blocks ending in `x.append(expr)` becomes a single list comprehension.
+
+    Loops over `range(len(seq))` whose index is only used as `seq[i]` iterate over `seq` directly.
+    """
+    name = "append_loop_comprehension"
+    description = "Build lists with a comprehension instead of nested loops calling append."
+
+    def apply(self, statements, index, context):
+        if index + 1 >= len(statements) or not isinstance(context.function, FUNCTION_NODES):
+            return None
+        assign, node = _simple_assign(statements[index]), statements[index + 1]
+        if assign is None or not _is_empty_list(assign[1]) or not isinstance(node, ast.For):
+            return None
+        result = assign[0]
+        generators = []
+        while True:
+            if isinstance(node, ast.For) and not node.orelse:
+                generators.append(ast.comprehension(target=node.target, iter=node.iter, ifs=[], is_async=0))
+                body = node.body
+            elif isinstance(node, ast.If) and not node.orelse and generators:
+                generators[-1].ifs.append(node.test)
+                body = node.body
+            else:
+                append = _method_call(node, 'append')
+                if append is None or append[0] != result or len(append[1]) != 1:
+                    return None
+                element = append[1][0]
+                break
+            if len(body) != 1:
+                return None
+            node = body[0]
+
+        comprehension = ast.ListComp(elt=element, generators=generators)
+        if result in _names(comprehension):
+            return None
+        targets = set().union(*(_names(g.target) for g in generators))
+        if context.used_outside(statements[index:index + 2], targets):
+            return None
+        comprehension = self._iterate_directly(comprehension, context)
+        return 2, [ast.Assign(targets=[ast.Name(id=result, ctx=ast.Store())], value=comprehension)]
+
+    @staticmethod
+    def _iterate_directly(comprehension: ast.ListComp, context: RewriteContext) -> ast.ListComp:
+        calls = [node for node in ast.walk(comprehension) if isinstance(node, ast.Call)]
+        if any(not (_is_name(call.func) and call.func.id in PURE_BUILTINS) for call in calls):
+            return comprehension  # A call could change the sequence while we iterate over it
+        for position, generator in enumerate(comprehension.generators):
+            it = generator.iter
+            if not (_is_name(generator.target) and isinstance(it, ast.Call) and _is_name(it.func, 'range')
+                    and len(it.args) == 1 and isinstance(it.args[0], ast.Call) and _is_name(it.args[0].func, 'len')
+                    and len(it.args[0].args) == 1 and _is_name(it.args[0].args[0])):
+                continue
+            index, sequence = generator.target.id, it.args[0].args[0].id
+            # Iterating over a dict yields its keys, not d[i]; only sequences are indexed by position
+            if context.kind(sequence) not in SEQUENCE_KINDS:
+                continue
+            later = [comprehension.elt] + generator.ifs
+            for following in comprehension.generators[position + 1:]:
+                later += [following.iter] + following.ifs
+            allowed = {id(node.slice) for part in later for node in ast.walk(part)
+                       if isinstance(node, ast.Subscript) and _is_name(node.value, sequence) and _is_name(node.slice, index)}
+            uses = [node for part in later for node in ast.walk(part) if _is_name(node, index)]
+            if not uses or any(id(node) not in allowed for node in uses):
+                continue
+            element = context.fresh_name(f"{sequence}_{index}")
+            replacer = _ReplaceSubscripts(sequence, index, element)
+            comprehension.elt = replacer.visit(comprehension.elt)
+            for following in comprehension.generators[position:]:
+                if following is not generator:
+                    following.iter = replacer.visit(following.iter)
+                following.ifs = [replacer.visit(condition) for condition in following.ifs]
+            generator.target = ast.Name(id=element, ctx=ast.Store())
+            generator.iter = ast.Name(id=sequence, ctx=ast.Load())
+        return comprehension
+
+DEFAULT_RULES: List[RewriteRule] = [
+    DedupMembershipRule(),
+    StringJoinRule(),
+    QuadraticSortRule(),
+    HoistAggregateRule(),
+    HoistAppendOpenRule(),
+    AppendLoopComprehensionRule(),
+]
+
+def _rewrite_block(statements: List[ast.stmt], context: RewriteContext, rules: List[RewriteRule], applied: List[str]) -> List[ast.stmt]:
+    # Inner blocks first, so an outer pattern sees already simplified bodies
+    for statement in statements:
+        for field in ('body', 'orelse', 'finalbody'):
+            block = getattr(statement, field, None)
+            if isinstance(block, list) and block and isinstance(block[0], ast.stmt):
+                setattr(statement, field, _rewrite_block(block, context, rules, applied))
+        for handler in getattr(statement, 'handlers', []):
+            handler.body = _rewrite_block(handler.body, context, rules, applied)
+
+    statements = list(statements)
+    index = 0
+    while index < len(statements):
+        for rule in rules:
+            match = rule.apply(statements, index, context)
+            if match is not None:
+                consumed, replacement = match
+                for new in replacement:
+                    ast.copy_location(new, statements[index])
+                statements[index:index + consumed] = replacement
+                applied.append(rule.name)
+                index += len(replacement) - 1
+                break
+        index += 1
+    return statements
+
+def rewrite_function(function: ast.AST, rules: Optional[List[RewriteRule]] = None) -> Tuple[ast.AST, List[str]]:
+    """
+    Apply the rewrite rules to one function.
+
+    Args:
+        function (ast.AST): The function definition. It is not modified.
+        rules (List[RewriteRule], optional): Rules to apply. Defaults to DEFAULT_RULES.
+
+    Returns:
+        Tuple[ast.AST, List[str]]: The rewritten function and the names of the rules applied.
+    """
+    rewritten = copy.deepcopy(function)
+    applied = []
+    rules = rules or DEFAULT_RULES
+    for phase in sorted({rule.phase for rule in rules}):
+        phase_rules = [rule for rule in rules if rule.phase == phase]
+        rewritten.body = _rewrite_block(rewritten.body, RewriteContext(rewritten), phase_rules, applied)
+    ast.fix_missing_locations(rewritten)
+    return rewritten, applied
+
+def detect_patterns(tree: ast.AST) -> List[Dict[str, Any]]:
+    """
+    Find known inefficiencies, whether or not a rule can rewrite them.
+
+    Args:
+        tree (ast.AST): The parsed module.
+
+    Returns:
+        List[Dict[str, Any]]: Findings with the keys 'pattern', 'function' and 'lineno'.
+    """
+    findings = []
+
+    def visit(node, function, loop_depth, strings):
+        for child in ast.iter_child_nodes(node):
+            child_function, child_depth, child_strings = function, loop_depth, strings
+            if isinstance(child, FUNCTION_NODES):
+                child_function, child_depth, child_strings = child.name, 0, set()
+            elif isinstance(child, STATEMENT_LOOPS):
+                child_depth = loop_depth + 1
+                if child_depth == 3:
+                    findings.append({'pattern': 'deep_nested_loops', 'function': function, 'lineno': child.lineno})
+            assign = _simple_assign(child)
+            if assign and isinstance(assign[1], ast.Constant) and isinstance(assign[1].value, str):
+                strings.add(assign[0])
+            if loop_depth > 0:
+                if isinstance(child, ast.Call) and _is_name(child.func, 'open'):
+                    findings.append({'pattern': 'open_in_loop', 'function': function, 'lineno': child.lineno})
+                elif isinstance(child, ast.Call) and _is_name(child.func) and child.func.id in ('sum', 'max', 'min', 'sorted') \
+                        and child.args and _is_name(child.args[0]):
+                    findings.append({'pattern': 'recomputed_aggregate', 'function': function, 'lineno': child.lineno})
+                elif isinstance(child, ast.AugAssign) and isinstance(child.op, ast.Add) and _is_name(child.target) \
+                        and child.target.id in strings:
+                    findings.append({'pattern': 'string_concat_in_loop', 'function': function, 'lineno': child.lineno})
+                elif isinstance(child, ast.Call) and isinstance(child.func, ast.Attribute) and child.func.attr == 'remove':
+                    findings.append({'pattern': 'list_remove_in_loop', 'function': function, 'lineno': child.lineno})
+                elif isinstance(child, ast.Compare) and any(isinstance(op, (ast.In, ast.NotIn)) for op in child.ops) \
+                        and any(isinstance(c, (ast.List, ast.ListComp)) or _is_name(c) for c in child.comparators):
+                    findings.append({'pattern': 'membership_test_in_loop', 'function': function, 'lineno': child.lineno})
+            visit(child, child_function, child_depth, child_strings)
+
+    visit(tree, None, 0, set())
+    return findings
+
+def make_sample_args(function: ast.AST, size: int, workdir: str, seed: int = 0,
+                     create_files: bool = True) -> Optional[List[Any]]:
+    """
+    Build deterministic sample arguments for a function from its parameter names.
+
+    File-like parameters get a path to a small file in `workdir`, matrix-like ones a size x size
+    list of lists, count-like ones the integer `size`, text-like ones a string, and everything
+    else a list of `size` small integers with duplicates.
+
+    Args:
+        function (ast.AST): The function definition.
+        size (int): The input size.
+        workdir (str): Directory for file arguments.
+        seed (int): Seed for the generated values.
+        create_files (bool): Whether to write the files; if not, file-like parameters get the path
+            of a file that doesn't exist yet.
+
+    Returns:
+        Optional[List[Any]]: Positional arguments, or None if the signature can't be filled in
+        (e.g. *args, **kwargs or keyword-only parameters).
+    """
+    args = function.args
+    if args.vararg or args.kwarg or args.kwonlyargs or args.posonlyargs:
+        return None
+    rng = random.Random(seed)
+    values = []
+    for parameter in args.args:
+        name = parameter.arg.lower()
+        if name in ('self', 'cls'):
+            return None
+        if any(word in name for word in ('file', 'path')):
+            path = os.path.join(workdir, f"{parameter.arg}.txt")
+            if create_files:
+                with open(path, 'w') as f:
+                    f.writelines(f"{rng.randint(1, 1000)}\n" for _ in range(size))
+            values.append(path)
+        elif 'matrix' in name:
+            values.append([[rng.random() for _ in range(size)] for _ in range(size)])
+        elif name in ('n', 'k', 'size', 'length', 'count', 'iterations', 'num', 'limit') or name.endswith(('_size', '_count', 'iterations')):
+            values.append(size)
+        elif name in ('content', 'text', 'line', 'string', 'prefix', 'separator'):
+            values.append("sample text\n" * max(size, 1))
+        elif any(word in name for word in ('strings', 'words', 'names', 'lines')):
+            values.append([f"string_{rng.randint(0, size)}" for _ in range(size)])
+        else:
+            values.append([rng.randint(0, max(size, 1)) for _ in range(size)])
+    return values
+
+def _is_main_guard(node: ast.AST) -> bool:
+    test = node.test if isinstance(node, ast.If) else None
+    return (isinstance(test, ast.Compare) and len(test.ops) == 1 and isinstance(test.ops[0], ast.Eq)
+            and {ast.unparse(test.left), ast.unparse(test.comparators[0])} == {'__name__', "'__main__'"})
+
+def module_namespace(module: ast.Module) -> Dict[str, Any]:
+    """
+    Execute a module as an import would, so its functions see all of its globals, but not its script code.
+
+    The `if __name__ == '__main__':` block and bare calls such as `main()` are skipped. Each
+    statement runs on its own: one that fails (e.g. reading a missing data file) leaves its
+    names undefined instead of the whole namespace.
+    """
+    namespace = {'__name__': '__rewrite_check__'}
+    for node in module.body:
+        if _is_main_guard(node) or (isinstance(node, ast.Expr) and isinstance(node.value, (ast.Call, ast.Await))):
+            continue
+        try:
+            with redirect_stdout(io.StringIO()):
+                exec(compile(ast.Module(body=[node], type_ignores=[]), '<module>', 'exec'), namespace)
+        except Exception:
+            continue
+    return namespace
+
+def _same(a: Any, b: Any) -> bool:
+    try:
+        return bool(a == b)
+    except Exception:
+        return repr(a) == repr(b)
+
+def _run_variant(namespace: Dict[str, Any], function: ast.AST, size: int, workdir: str,
+                 create_files: bool = True) -> Optional[Dict[str, Any]]:
+    for entry in os.listdir(workdir):
+        os.remove(os.path.join(workdir, entry))
+    args = make_sample_args(function, size, workdir, create_files=create_files)
+    if args is None:
+        return None
+    exec(compile(ast.Module(body=[function], type_ignores=[]), '<rewrite>', 'exec'), namespace)
+    random.seed(size)
+    stdout = io.StringIO()
+    outcome = {'args': None, 'result': None, 'error': None}
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with redirect_stdout(stdout):
+            outcome['result'] = namespace[function.name](*args)
+    except Exception as e:
+        outcome['error'] = type(e).__name__
+    finally:
+        os.chdir(cwd)
+    outcome['args'] = args
+    outcome['stdout'] = stdout.getvalue()
+    outcome['files'] = {}
+    for entry in sorted(os.listdir(workdir)):
+        with open(os.path.join(workdir, entry), 'rb') as f:
+            outcome['files'][entry] = f.read()
+    return outcome
+
+def _equivalence_worker(module_source: str, original: str, rewritten: str, sizes: Tuple[int, ...],
+                        limits: Dict[str, Optional[int]], conn) -> None:
+    limit_resources(limits)
+    verdict = {'equivalent': False, 'detail': ''}
+    workdir = tempfile.mkdtemp(prefix='rewrite_check_')
+    try:
+        module = ast.parse(module_source)
+        variants = [ast.parse(original).body[0], ast.parse(rewritten).body[0]]
+        has_parameters = bool(variants[0].args.args)
+        # File arguments are tried both as existing files and as paths that don't exist yet, so
+        # creating a file (or failing to) counts as a difference
+        cases = [(size, create_files) for size in (sizes if has_parameters else sizes[:1])
+                 for create_files in (True, False)]
+        completed = False
+        for size, create_files in cases:
+            outcomes = [_run_variant(module_namespace(module), variant, size, workdir, create_files)
+                        for variant in variants]
+            if outcomes[0] is None:
+                verdict['detail'] = "cannot generate sample arguments"
+                break
+            before, after = outcomes
+            completed = completed or before['error'] is None
+            for key in ('error', 'result', 'args', 'stdout', 'files'):
+                if not _same(before[key], after[key]):
+                    files = "existing" if create_files else "missing"
+                    verdict['detail'] = f"{key} differs for input size {size} with {files} input files"
+                    break
+            else:
+                continue
+            break
+        else:
+            if completed:
+                verdict['equivalent'] = True
+            else:
+                # Failing the same way proves nothing, e.g. both raising NameError on a missing global
+                verdict['detail'] = "the original raised an exception for every sample input"
+    except Exception as e:
+        verdict['detail'] = f"{type(e).__name__}: {e}"
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    conn.send(verdict)
+    conn.close()
+
+def check_equivalence(module_source: str, original: str, rewritten: str,
+                      sizes: Tuple[int, ...] = (0, 1, 5, 20), timeout: float = 10.0,
+                      limits: Optional[Dict[str, Optional[int]]] = None) -> Dict[str, Any]:
+    """
+    Run the original and rewritten versions of a function on the same sample inputs and compare them.
+
+    Both versions run in a separate, resource-limited process, inside a scratch directory, each with a fresh copy of
+    the module's globals (see module_namespace). Return values, mutated arguments, printed output,
+    raised exception types and the files in the scratch directory afterwards must all match, with
+    file arguments that exist beforehand and with ones that don't. The original must run without
+    an exception for at least one input, since two versions failing the same way prove nothing.
+
+    Args:
+        module_source (str): Source of the module the function belongs to.
+        original (str): Source of the original function.
+        rewritten (str): Source of the rewritten function.
+        sizes (Tuple[int, ...]): Input sizes to try.
+        timeout (float): Seconds before the check is abandoned.
+        limits (Dict[str, Optional[int]], optional): CPU time, memory and file size limits for the
+            process (see script_runner.limit_resources). Defaults to DEFAULT_LIMITS.
+
+    Returns:
+        Dict[str, Any]: 'equivalent' (True, False, or None when the check timed out) and a 'detail' message.
+    """
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    # Not a daemon, so a function that starts processes of its own can be checked
+    process = multiprocessing.Process(target=_equivalence_worker,
+                                      args=(module_source, original, rewritten, sizes,
+                                            DEFAULT_LIMITS if limits is None else limits, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        if parent_conn.poll(timeout):
+            return parent_conn.recv()
+        return {'equivalent': None, 'detail': f"timed out after {timeout}s"}
+    except EOFError:
+        return {'equivalent': False, 'detail': "check process crashed"}
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        parent_conn.close()
+
+def optimize_source(source: str, functions: Optional[Set[str]] = None, verify: bool = True,
+                    rules: Optional[List[RewriteRule]] = None, check: Optional[Callable[[], None]] = None) -> Dict[str, Any]:
+    """
+    Rewrite the known anti-patterns in a module, keeping only rewrites that pass the equivalence check.
+
+    Only the changed top-level functions are re-generated; the rest of the file, including its
+    comments and formatting, is left as it was.
+
+    Args:
+        source (str): The module's source code.
+        functions (Set[str], optional): Only rewrite these top-level functions. Defaults to all of them.
+        verify (bool): Whether to run the equivalence check. Unverified rewrites are rejected.
+        rules (List[RewriteRule], optional): Rules to apply. Defaults to DEFAULT_RULES.
+        check (Callable[[], None], optional): Called before each function is rewritten; raising from
+            it, e.g. when a job is cancelled, stops the rewriting.
+
+    Returns:
+        Dict[str, Any]: 'source' (the new code), 'rewrites' (accepted changes), 'rejected'
+        (rewrites that failed the check) and 'remaining' (findings no rule fixed in the selected functions).
+
+    Raises:
+        SyntaxError: If the source cannot be parsed.
+    """
+    tree = ast.parse(source)
+    lines = source.splitlines(keepends=True)
+    rewrites, rejected, edits = [], [], []
+    for node in tree.body:
+        if not isinstance(node, FUNCTION_NODES) or (functions is not None and node.name not in functions):
+            continue
+        if check is not None:
+            check()
+        rewritten, applied = rewrite_function(node, rules)
+        if not applied:
+            continue
+        record = {'function': node.name, 'lineno': node.lineno, 'rules': applied}
+        if verify:
+            verdict = check_equivalence(source, ast.unparse(node), ast.unparse(rewritten))
+            record['detail'] = verdict['detail']
+            if not verdict['equivalent']:
+                rejected.append(record)
+                continue
+        rewrites.append(record)
+        start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+        edits.append((start, node.end_lineno, ast.unparse(rewritten) + '\n'))
+
+    # Splice from the bottom up so earlier line numbers stay valid
+    for start, end, text in sorted(edits, reverse=True):
+        lines[start - 1:end] = [text]
+    new_source = ''.join(lines)
+    remaining = [finding for finding in detect_patterns(ast.parse(new_source))
+                 if functions is None or finding['function'] in functions]
+    return {
+        'source': new_source,
+        'rewrites': rewrites,
+        'rejected': rejected,
+        'remaining': remaining,
+    }
+
+def optimize_file(path: str, write: bool = True, functions: Optional[Set[str]] = None) -> Dict[str, Any]:
+    """
+    Apply the rewrite rules to a file.
+
+    Args:
+        path (str): Path to the Python file.
+        write (bool): Whether to save the rewritten code back to the file.
+        functions (Set[str], optional): Only rewrite these top-level functions.
+
+    Returns:
+        Dict[str, Any]: The optimize_source result plus the 'file' path.
+    """
+    with open(path, 'r') as f:
+        source = f.read()
+    result = optimize_source(source, functions)
+    if write and result['rewrites']:
+        with open(path, 'w') as f:
+            f.write(result['source'])
+    result['file'] = path
+    return result
+
+def optimize_directory(directory: str, write: bool = True,
+                       functions: Optional[Dict[str, Set[str]]] = None) -> List[Dict[str, Any]]:
+    """
+    Apply the rewrite rules to every Python file under a directory.
+
+    Args:
+        directory (str): The root directory.
+        write (bool): Whether to save rewritten files.
+        functions (Dict[str, Set[str]], optional): Only rewrite these top-level functions, keyed by
+            file path (e.g. the hot functions from a profile). Other files are skipped.
+
+    Returns:
+        List[Dict[str, Any]]: One optimize_file result per file that could be parsed.
+    """
+    if functions is not None:
+        functions = {os.path.abspath(path): names for path, names in functions.items()}
+    results = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            if file.endswith('.py'):
+                path = os.path.join(root, file)
+                selected = None
+                if functions is not None:
+                    selected = functions.get(os.path.abspath(path))
+                    if not selected:
+                        continue
+                try:
+                    results.append(optimize_file(path, write, selected))
+                except (SyntaxError, UnicodeDecodeError):
+                    continue
+    return results
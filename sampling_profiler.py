@@ -0,0 +1,307 @@
+import argparse
+import multiprocessing
+import os
+import runpy
+import signal
+import sys
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set, Tuple
+from script_runner import DEFAULT_LIMITS, limit_resources
+
+# A frame is identified by (file, qualified function name, first line of the function)
+Frame = Tuple[str, str, int]
+
+def _under(path: str, root: str) -> bool:
+    # Called from the signal handler, so a prefix check rather than path normalization
+    return path.startswith(root + os.sep)
+
+def _current_line(frame) -> int:
+    if frame.f_lineno is not None:
+        return frame.f_lineno
+    # Signals are handled at loop back-edges, which have no line of their own; use the last line before it
+    line = frame.f_code.co_firstlineno
+    for start, _, lineno in frame.f_code.co_lines():
+        if start > frame.f_lasti:
+            break
+        if lineno is not None:
+            line = lineno
+    return line
+
+def _profile_worker(script_path: str, root: str, interval: float, track_energy: bool,
+                    limits: Dict[str, Optional[int]], conn) -> None:
+    """
+    Worker entry point: run a script with a CPU-time stack sampler and send back the samples.
+
+    Every `interval` seconds of CPU time, ITIMER_PROF delivers SIGPROF and the handler records
+    the interrupted Python stack, from the script's module frame down to the running line.
+    """
+    limit_resources(limits)
+    script_path = os.path.abspath(script_path)
+    stacks: Counter = Counter()
+    lines: Counter = Counter()
+
+    def sample(signum, frame):
+        stack = []
+        line = None
+        while frame is not None:
+            code = frame.f_code
+            filename = code.co_filename
+            if line is None and _under(filename, root):
+                # The innermost project line is where the time is spent, even inside library calls
+                line = (filename, code.co_firstlineno, _current_line(frame))
+            stack.append((filename, code.co_qualname, code.co_firstlineno))
+            if filename == script_path and code.co_name == '<module>':
+                break
+            frame = frame.f_back
+        else:
+            # Not under the script (e.g. interpreter shutdown)
+            return
+        stacks[tuple(reversed(stack))] += 1
+        if line is not None:
+            lines[line] += 1
+
+    record = {'status': 'ok', 'error': None, 'energy_consumed': None, 'emissions': None}
+    tracker = None
+    if track_energy:
+        try:
+            from codecarbon import EmissionsTracker
+            tracker = EmissionsTracker(save_to_file=False, log_level='error')
+        except ImportError:
+            tracker = None
+    os.chdir(os.path.dirname(script_path))
+    sys.path.insert(0, os.path.dirname(script_path))
+    if tracker is not None:
+        tracker.start()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    signal.signal(signal.SIGPROF, sample)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+    try:
+        runpy.run_path(script_path, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            record.update(status='error', error=f"SystemExit({e.code!r})")
+    except BaseException as e:
+        record.update(status='error', error=f"{type(e).__name__}: {e}")
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        record['duration'] = time.perf_counter() - start
+        record['cpu_time'] = time.process_time() - cpu_start
+        if tracker is not None:
+            record['emissions'] = tracker.stop()
+            if tracker.final_emissions_data is not None:
+                record['energy_consumed'] = tracker.final_emissions_data.energy_consumed
+    record['stacks'] = list(stacks.items())
+    record['lines'] = list(lines.items())
+    conn.send(record)
+    conn.close()
+
+def profile_script(script_path: str, root: Optional[str] = None, interval: float = 0.005,
+                   timeout: Optional[float] = None, track_energy: bool = True,
+                   limits: Optional[Dict[str, Optional[int]]] = None) -> Dict[str, Any]:
+    """
+    Run a script in a child process under the sampling profiler.
+
+    Args:
+        script_path (str): The script to run.
+        root (str, optional): Directory of the project being profiled. Frames from files under it
+            are the project's own code; everything else (the standard library, installed packages)
+            is attributed to the project function that called it. Defaults to the script's directory.
+        interval (float): CPU seconds between samples.
+        timeout (float, optional): Seconds before the child is killed.
+        track_energy (bool): Whether to measure the run's energy with CodeCarbon, if it is installed.
+        limits (Dict[str, Optional[int]], optional): CPU time, memory and file size limits for the
+            child (see script_runner.limit_resources). Defaults to DEFAULT_LIMITS.
+
+    Returns:
+        Dict[str, Any]: The run's 'status', 'error', 'duration', 'cpu_time', 'energy_consumed' (kWh)
+        and 'emissions' (kg CO2eq), plus the raw 'stacks' and 'lines' sample counts, the
+        'interval' and the 'root'.
+    """
+    root = os.path.abspath(root or os.path.dirname(os.path.abspath(script_path)))
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    # Not a daemon, so the script can start processes of its own
+    process = multiprocessing.Process(target=_profile_worker,
+                                      args=(script_path, root, interval, track_energy,
+                                            DEFAULT_LIMITS if limits is None else limits, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        if parent_conn.poll(timeout):
+            profile = parent_conn.recv()
+        else:
+            profile = {'status': 'timeout', 'error': f"timed out after {timeout}s", 'stacks': [], 'lines': []}
+    except EOFError:
+        profile = {'status': 'error', 'error': "profiled process crashed", 'stacks': [], 'lines': []}
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        parent_conn.close()
+    profile.update(interval=interval, root=root)
+    return profile
+
+def _label(frame: Frame, root: str) -> str:
+    filename, name, lineno = frame
+    if _under(filename, root):
+        filename = os.path.relpath(filename, root)
+    else:
+        filename = os.path.basename(filename)
+    return f"{name} ({filename}:{lineno})"
+
+def collapsed_stacks(profile: Dict[str, Any]) -> List[str]:
+    """
+    Render the samples in the collapsed-stack format read by flamegraph.pl and speedscope.
+
+    Args:
+        profile (Dict[str, Any]): The result of profile_script.
+
+    Returns:
+        List[str]: One 'frame;frame;frame count' line per distinct stack.
+    """
+    root = profile['root']
+    return sorted(f"{';'.join(_label(frame, root) for frame in stack)} {count}" for stack, count in profile['stacks'])
+
+def write_collapsed(profile: Dict[str, Any], path: str) -> None:
+    """
+    Save the collapsed stacks to a file, e.g. to render with `flamegraph.pl profile.folded > profile.svg`.
+
+    Args:
+        profile (Dict[str, Any]): The result of profile_script.
+        path (str): Where to write them.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as f:
+        f.writelines(line + '\n' for line in collapsed_stacks(profile))
+
+def hotspots(profile: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Rank the project's functions by the CPU time spent in them.
+
+    A function's self time includes library code it called directly, since that is the code a
+    refactoring of the function can change. Energy and emissions are apportioned by self time.
+
+    Args:
+        profile (Dict[str, Any]): The result of profile_script.
+
+    Returns:
+        List[Dict[str, Any]]: Per function, sorted by self time: 'file', 'function', 'lineno',
+        'self_samples', 'total_samples', 'self_time' and 'total_time' (CPU seconds), 'share' of all
+        samples, 'energy_consumed', 'emissions', and the 'hot_lines' within it.
+    """
+    root = profile['root']
+    interval = profile['interval']
+    self_samples: Counter = Counter()
+    total_samples: Counter = Counter()
+    for stack, count in profile['stacks']:
+        project = [frame for frame in stack if _under(frame[0], root)]
+        if not project:
+            continue
+        self_samples[project[-1]] += count
+        for frame in set(project):
+            total_samples[frame] += count
+
+    all_samples = sum(count for _, count in profile['stacks']) or 1
+    line_counts: Dict[Tuple[str, int], List[Tuple[int, int]]] = {}
+    for (filename, firstlineno, lineno), count in profile['lines']:
+        line_counts.setdefault((filename, firstlineno), []).append((lineno, count))
+
+    table = []
+    for frame, total in total_samples.items():
+        filename, name, lineno = frame
+        share = self_samples[frame] / all_samples
+        hot_lines = sorted(line_counts.get((filename, lineno), []), key=lambda item: -item[1])
+        table.append({
+            'file': filename,
+            'function': name,
+            'lineno': lineno,
+            'self_samples': self_samples[frame],
+            'total_samples': total,
+            'self_time': self_samples[frame] * interval,
+            'total_time': total * interval,
+            'share': share,
+            'energy_consumed': profile['energy_consumed'] * share if profile.get('energy_consumed') is not None else None,
+            'emissions': profile['emissions'] * share if profile.get('emissions') is not None else None,
+            'hot_lines': hot_lines[:5],
+        })
+    table.sort(key=lambda row: (-row['self_samples'], -row['total_samples']))
+    return table
+
+def format_hotspots(table: List[Dict[str, Any]], root: str, limit: int = 20) -> str:
+    """
+    Format the hotspot table for printing.
+
+    Args:
+        table (List[Dict[str, Any]]): The result of hotspots.
+        root (str): The profiled project's directory, to shorten file names.
+        limit (int): Maximum number of rows.
+
+    Returns:
+        str: The table as text.
+    """
+    rows = [f"{'self %':>7} {'self s':>8} {'total s':>8} {'energy kWh':>11}  function"]
+    for row in table[:limit]:
+        energy = f"{row['energy_consumed']:.3g}" if row['energy_consumed'] is not None else '-'
+        location = f"{os.path.relpath(row['file'], root)}:{row['lineno']}"
+        rows.append(f"{100 * row['share']:>6.1f}% {row['self_time']:>8.3f} {row['total_time']:>8.3f} {energy:>11}  "
+                    f"{row['function']} ({location})")
+    return '\n'.join(rows)
+
+def top_level_function(qualname: str) -> Optional[str]:
+    """
+    Find the top-level function a profiled function belongs to.
+
+    Args:
+        qualname (str): A qualified name from the profile, e.g. 'outer.<locals>.inner' or 'Class.method'.
+
+    Returns:
+        Optional[str]: The top-level function's name ('outer'), or None for module code, methods
+        and functions nested in classes, which the optimizers don't rewrite.
+    """
+    outer = qualname.split('.<locals>.')[0]
+    if outer == '<module>' or '.' in outer:
+        return None
+    return outer
+
+def hot_functions(table: List[Dict[str, Any]], min_share: float = 0.05, limit: Optional[int] = None) -> Dict[str, Set[str]]:
+    """
+    Select the functions worth optimizing: those with at least `min_share` of the samples.
+
+    Nested functions are mapped to the top-level function containing them, which is the unit the
+    optimizers work on. Hot methods are left out, as the optimizers only rewrite top-level
+    functions; `limit` counts only the functions that can be selected.
+
+    Args:
+        table (List[Dict[str, Any]]): The result of hotspots.
+        min_share (float): Minimum fraction of all samples spent in the function itself.
+        limit (int, optional): Maximum number of functions.
+
+    Returns:
+        Dict[str, Set[str]]: Top-level function names per file, ready for optimize_directory;
+        empty if nothing is hot.
+    """
+    selected: Dict[str, Set[str]] = {}
+    rows = [row for row in table if row['share'] >= min_share and top_level_function(row['function'])]
+    for row in rows[:limit]:
+        selected.setdefault(row['file'], set()).add(top_level_function(row['function']))
+    return selected
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile a script and rank its hot functions.")
+    parser.add_argument('script', help="The script to run")
+    parser.add_argument('--root', help="Project directory (defaults to the script's directory)")
+    parser.add_argument('--interval', type=float, default=0.005, help="CPU seconds between samples")
+    parser.add_argument('--timeout', type=float, help="Seconds before the script is killed")
+    parser.add_argument('--output', default='profile.folded', help="Collapsed-stack output file")
+    args = parser.parse_args()
+
+    result = profile_script(args.script, args.root, args.interval, args.timeout)
+    if result['status'] != 'ok':
+        print(f"The script did not finish cleanly: {result['error']}")
+    write_collapsed(result, args.output)
+    print(format_hotspots(hotspots(result), result['root']))
+    print(f"Collapsed stacks saved to {args.output}")
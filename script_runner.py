@@ -0,0 +1,404 @@
+import argparse
+import importlib
+import multiprocessing
+import os
+import queue
+import resource
+import runpy
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Sequence
+
+# Modules the analysed scripts commonly import; a fork server imports them once and every script
+# forked from it starts with them loaded. Missing ones are skipped.
+DEFAULT_PRELOAD = ('json', 'collections', 'itertools', 'numpy', 'pandas')
+MEGABYTE = 1024 * 1024
+
+# Limits for analysed code run outside a ScriptRunner when the caller passes none; config.yaml's defaults
+DEFAULT_LIMITS = {'cpu_time': 600, 'memory': 4096 * MEGABYTE, 'file_size': 512 * MEGABYTE}
+
+def _limit(kind: int, value: Optional[int]) -> None:
+    if value is None:
+        return
+    _, hard = resource.getrlimit(kind)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    resource.setrlimit(kind, (value, hard))
+
+def limit_resources(limits: Dict[str, Optional[int]]) -> None:
+    """
+    Limit the CPU time, memory and file size of the current process and the processes it starts.
+
+    Child processes that run analysed code call this first, so they are bounded like the scripts
+    of a ScriptRunner.
+
+    Args:
+        limits (Dict[str, Optional[int]]): 'cpu_time' in seconds, 'memory' in bytes of address space
+            and 'file_size' in bytes; a missing or None entry is not limited.
+    """
+    if limits.get('cpu_time') is not None:
+        # SIGXCPU at the soft limit, SIGKILL a second later if the code handles it
+        _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+        cpu_time = int(limits['cpu_time'])
+        if hard != resource.RLIM_INFINITY:
+            cpu_time = min(cpu_time, hard - 1)
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time + 1 if hard == resource.RLIM_INFINITY else hard))
+    # Linux does not enforce RLIMIT_RSS, so memory is bounded through the address space
+    _limit(resource.RLIMIT_AS, limits.get('memory'))
+    _limit(resource.RLIMIT_FSIZE, limits.get('file_size'))
+    _limit(resource.RLIMIT_CORE, 0)
+
+def _child(request: Dict[str, Any], conn, stdout_fd: int, stderr_fd: int) -> None:
+    # Runs in the forked child and never returns: the script's exit ends the process
+    code = 1
+    try:
+        # A session of its own, so a timeout kills everything the script started
+        os.setsid()
+        conn.close()
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGPIPE):
+            signal.signal(signum, signal.SIG_DFL)
+        # The server is a daemon so it dies with the caller; the script is not, and may start its
+        # own multiprocessing pools and processes
+        multiprocessing.current_process()._config['daemon'] = False
+        stdin = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(stdin, 0)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        limit_resources(request['limits'])
+
+        script_path = request['script_path']
+        os.chdir(request['cwd'])
+        sys.argv = [script_path, *request['args']]
+        sys.path[0] = os.path.dirname(script_path)
+        code = 0
+        try:
+            runpy.run_path(script_path, run_name='__main__')
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException as e:
+            # Start the traceback at the script, as running it directly would
+            tb = e.__traceback__
+            while tb is not None and tb.tb_frame.f_code.co_filename != script_path:
+                tb = tb.tb_next
+            traceback.print_exception(type(e), e, tb or e.__traceback__)
+            code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+def _read_output(file, max_output: int) -> Dict[str, Any]:
+    size = file.seek(0, os.SEEK_END)
+    file.seek(0)
+    return {'text': file.read(max_output).decode('utf-8', errors='replace'), 'truncated': size > max_output}
+
+def _kill_group(pid: int, timed_out: threading.Event) -> None:
+    timed_out.set()
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def _run_script(request: Dict[str, Any], conn) -> Dict[str, Any]:
+    """
+    Fork a child of the server to run one script, wait for it, and describe how it ended.
+    """
+    with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            _child(request, conn, stdout.fileno(), stderr.fileno())
+        timed_out = threading.Event()
+        timer = None
+        if request['timeout'] is not None:
+            timer = threading.Timer(request['timeout'], _kill_group, (pid, timed_out))
+            timer.start()
+        _, status, rusage = os.wait4(pid, 0)
+        duration = time.perf_counter() - start
+        if timer is not None:
+            timer.cancel()
+        # Processes the script left behind are killed with it
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+        result = {
+            'script': request['script_path'],
+            'status': 'ok',
+            'returncode': None,
+            'signal': None,
+            'error': None,
+            'duration': duration,
+            'cpu_time': rusage.ru_utime + rusage.ru_stime,
+            'max_rss': rusage.ru_maxrss * 1024,
+        }
+        if os.WIFSIGNALED(status):
+            signum = os.WTERMSIG(status)
+            result['signal'] = signum
+            result['returncode'] = -signum
+            if timed_out.is_set():
+                result.update(status='timeout', error=f"Exceeded the {request['timeout']}s timeout")
+            elif signum == signal.SIGXCPU or (signum == signal.SIGKILL and request['limits']['cpu_time'] is not None
+                                              and result['cpu_time'] >= request['limits']['cpu_time']):
+                result.update(status='killed', error=f"Exceeded the {request['limits']['cpu_time']}s CPU time limit")
+            elif signum == signal.SIGXFSZ:
+                result.update(status='killed', error="Exceeded the file size limit")
+            else:
+                result.update(status='killed', error=f"Killed by {signal.Signals(signum).name}")
+        else:
+            result['returncode'] = os.WEXITSTATUS(status)
+            if result['returncode'] != 0:
+                result.update(status='error', error=f"Exited with code {result['returncode']}")
+        for name, file in (('stdout', stdout), ('stderr', stderr)):
+            output = _read_output(file, request['max_output'])
+            result[name] = output['text']
+            result[f'{name}_truncated'] = output['truncated']
+    return result
+
+def _serve(conn, preload: Sequence[str]) -> None:
+    """
+    Fork server entry point: import the preloaded modules, then run each requested script in a
+    forked child until the connection closes.
+    """
+    loaded = []
+    for name in preload:
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except Exception:
+            pass
+    conn.send(loaded)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        try:
+            result = _run_script(request, conn)
+        except Exception as e:
+            result = {'script': request['script_path'], 'status': 'error', 'returncode': None, 'signal': None,
+                      'error': f"Runner failed: {type(e).__name__}: {e}", 'stdout': '', 'stderr': ''}
+        conn.send(result)
+    conn.close()
+
+class ScriptRunner:
+    """
+    A pool of fork servers that run untrusted scripts in isolated, resource-limited processes.
+
+    Each server is a fresh interpreter that imports the `preload` modules once. A script is run in
+    a child forked from a server, so it starts with those imports done instead of paying for a new
+    interpreter. The child runs in its own session, under the CPU time, memory and file size
+    limits, with the script's output captured; it is killed, with anything it started, when the
+    timeout expires. This bounds what a script can consume, not what it can touch: it runs as the
+    caller's user with the caller's filesystem access, so only run scripts you would run yourself.
+    """
+
+    def __init__(self, workers: int = 1, preload: Sequence[str] = DEFAULT_PRELOAD, timeout: Optional[float] = None,
+                 cpu_time: Optional[int] = None, memory: Optional[int] = None, file_size: Optional[int] = None,
+                 max_output: int = MEGABYTE):
+        """
+        Args:
+            workers (int): Number of fork servers, i.e. scripts that can run at once.
+            preload (Sequence[str]): Modules imported once per server.
+            timeout (float, optional): Default wall-clock seconds before a script is killed.
+            cpu_time (int, optional): CPU seconds a script may use.
+            memory (int, optional): Bytes of address space a script may use.
+            file_size (int, optional): Largest file, in bytes, a script may write.
+            max_output (int): Bytes of stdout and of stderr kept per script.
+        """
+        self.workers = max(1, int(workers))
+        self.preload = tuple(preload)
+        self.timeout = timeout
+        self.limits = {'cpu_time': cpu_time, 'memory': memory, 'file_size': file_size}
+        self.max_output = max_output
+        self.preloaded: List[str] = []
+        self._idle: Optional[queue.Queue] = None
+        self._servers: List[tuple] = []
+        self._lock = threading.Lock()
+
+    def _start_server(self) -> tuple:
+        # Spawned rather than forked, so servers never inherit the caller's threads, locks or modules
+        context = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=_serve, args=(child_conn, self.preload), daemon=True)
+        process.start()
+        child_conn.close()
+        self.preloaded = parent_conn.recv()
+        return process, parent_conn
+
+    def start(self) -> None:
+        """Start the fork servers. Called by the first run if needed."""
+        with self._lock:
+            if self._idle is not None:
+                return
+            self._servers = [self._start_server() for _ in range(self.workers)]
+            self._idle = queue.Queue()
+            for server in self._servers:
+                self._idle.put(server)
+
+    def run(self, script_path: str, args: Sequence[str] = (), cwd: Optional[str] = None,
+            timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Run a script, waiting for a free server if all are busy.
+
+        Args:
+            script_path (str): The script to run.
+            args (Sequence[str]): Its command-line arguments.
+            cwd (str, optional): Its working directory. Defaults to the script's directory.
+            timeout (float, optional): Wall-clock seconds before it is killed. Defaults to the runner's.
+
+        Returns:
+            Dict[str, Any]: 'script', 'status' ('ok', 'error', 'timeout' or 'killed'), 'returncode',
+            'signal', 'error', 'duration' (s), 'cpu_time' (s), 'max_rss' (bytes), 'stdout', 'stderr',
+            and whether each output was truncated.
+        """
+        self.start()
+        script_path = os.path.abspath(script_path)
+        request = {
+            'script_path': script_path,
+            'args': [str(arg) for arg in args],
+            'cwd': os.path.abspath(cwd) if cwd else os.path.dirname(script_path),
+            'timeout': timeout if timeout is not None else self.timeout,
+            'limits': self.limits,
+            'max_output': self.max_output,
+        }
+        server = self._idle.get()
+        try:
+            process, conn = server
+            try:
+                conn.send(request)
+                return conn.recv()
+            except (EOFError, OSError) as e:
+                # The server itself died; replace it so the pool keeps its size
+                with self._lock:
+                    self._servers.remove(server)
+                    conn.close()
+                    process.join(1)
+                    server = self._start_server()
+                    self._servers.append(server)
+                return {'script': script_path, 'status': 'error', 'returncode': None, 'signal': None,
+                        'error': f"Runner failed: {type(e).__name__}", 'stdout': '', 'stderr': ''}
+        finally:
+            self._idle.put(server)
+
+    def close(self) -> None:
+        """Stop the fork servers."""
+        with self._lock:
+            for process, conn in self._servers:
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+                conn.close()
+            for process, _ in self._servers:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+            self._servers = []
+            self._idle = None
+
+    def __enter__(self) -> 'ScriptRunner':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def resource_limits(config: Dict[str, Any]) -> Dict[str, Optional[int]]:
+    """
+    Read the limits for analysed code from the 'execution' section of config.yaml.
+
+    Args:
+        config (Dict[str, Any]): The loaded configuration.
+
+    Returns:
+        Dict[str, Optional[int]]: 'cpu_time' in seconds, 'memory' and 'file_size' in bytes; None
+        where the configuration sets no limit.
+    """
+    settings = config.get('execution', {})
+
+    def megabytes(key):
+        value = settings.get(key)
+        return int(value * MEGABYTE) if value else None
+
+    return {'cpu_time': settings.get('cpu_time_limit'), 'memory': megabytes('memory_limit_mb'),
+            'file_size': megabytes('file_size_limit_mb')}
+
+def script_runner(config: Dict[str, Any]) -> ScriptRunner:
+    """
+    Create the runner described by the 'execution' section of config.yaml.
+
+    Args:
+        config (Dict[str, Any]): The loaded configuration.
+
+    Returns:
+        ScriptRunner: The runner; it starts its servers on first use.
+    """
+    settings = config.get('execution', {})
+    limits = resource_limits(config)
+    return ScriptRunner(
+        workers=settings.get('workers', 1),
+        preload=settings.get('preload', DEFAULT_PRELOAD),
+        timeout=settings.get('timeout'),
+        cpu_time=limits['cpu_time'],
+        memory=limits['memory'],
+        file_size=limits['file_size'],
+    )
+
+def measure_startup(script_path: str, runs: int = 20, preload: Sequence[str] = DEFAULT_PRELOAD) -> Dict[str, float]:
+    """
+    Compare the mean wall time of running a script through the runner and as a new interpreter.
+
+    Args:
+        script_path (str): The script to run.
+        runs (int): Runs per method.
+        preload (Sequence[str]): Modules the runner preloads.
+
+    Returns:
+        Dict[str, float]: Mean seconds per run for 'runner' and 'subprocess'.
+    """
+    results = {}
+    with ScriptRunner(preload=preload) as runner:
+        start = time.perf_counter()
+        for _ in range(runs):
+            runner.run(script_path)
+        results['runner'] = (time.perf_counter() - start) / runs
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run([sys.executable, script_path], capture_output=True, cwd=os.path.dirname(os.path.abspath(script_path)))
+    results['subprocess'] = (time.perf_counter() - start) / runs
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a script in the sandboxed fork-server runner.")
+    parser.add_argument('script', help="The script to run")
+    parser.add_argument('--timeout', type=float, help="Seconds before the script is killed")
+    parser.add_argument('--compare', type=int, metavar='RUNS',
+                        help="Instead, time RUNS runs through the runner and as new interpreters")
+    args = parser.parse_args()
+
+    if args.compare:
+        for method, seconds in measure_startup(args.script, args.compare).items():
+            print(f"{method}: {seconds * 1000:.1f} ms per run")
+    else:
+        with ScriptRunner(timeout=args.timeout) as runner:
+            result = runner.run(args.script)
+        sys.stdout.write(result['stdout'])
+        sys.stderr.write(result['stderr'])
+        print(f"{result['status']} in {result['duration']:.3f}s ({result['error'] or 'no error'})")
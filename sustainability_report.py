@@ -1,13 +1,40 @@
+import ast
 import os
-from typing import List
+import runpy
+import signal
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+from typing import Any, Dict, Iterator, List, Optional
 from codecarbon import EmissionsTracker
+from config_parser import load_config
+from script_runner import ScriptRunner, limit_resources, resource_limits, script_runner
 
-def find_python_files(directory: str) -> List[str]:
+def is_python_source(file_path: str) -> bool:
+    """
+    Check whether a file contains non-empty, syntactically valid Python source code.
+
+    Args:
+        file_path (str): The full path to the file.
+
+    Returns:
+        bool: True if the file parses as Python.
+    """
+    try:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            source = file.read()
+        return bool(source.strip()) and ast.parse(source) is not None
+    except (OSError, UnicodeDecodeError, SyntaxError, ValueError):
+        return False
+
+def find_python_files(directory: str, include_extensionless: bool = False) -> List[str]:
     """
     Find all Python files in the given directory and its subdirectories.
 
     Args:
         directory (str): The root directory to start searching for Python files.
+        include_extensionless (bool): Also include files without an extension that contain
+            Python source code, like most of the samples in 'Code Samples'.
 
     Returns:
         List[str]: A list of full file paths for all Python files found.
@@ -18,26 +45,35 @@ def find_python_files(directory: str) -> List[str]:
             os.path.join(root, file)
             for file in files
             if file.endswith('.py')
+            or (include_extensionless and '.' not in file and is_python_source(os.path.join(root, file)))
         )
     return python_files
 
-def execute_file(file_path: str, tracker: EmissionsTracker) -> None:
+def execute_file(file_path: str, tracker: EmissionsTracker, runner: ScriptRunner) -> Dict[str, Any]:
     """
     Execute a Python file while tracking emissions.
 
+    The file runs in a sandboxed child process of the runner, never in this process.
+
     Args:
         file_path (str): The full path to the Python file to be executed.
         tracker (EmissionsTracker): The emissions tracker object.
+        runner (ScriptRunner): The runner to execute the file with.
+
+    Returns:
+        Dict[str, Any]: The runner's result for the file.
     """
     print(f"Running {file_path} with CodeCarbon tracking...")
     try:
         tracker.start()
-        with open(file_path, 'r') as file:
-            exec(file.read())
-    except Exception as e:
-        print(f"An error occurred while running {file_path}: {e}")
+        result = runner.run(file_path)
     finally:
         tracker.stop()
+    print(result['stdout'], end='')
+    if result['status'] != 'ok':
+        print(f"An error occurred while running {file_path}: {result['error']}")
+        print(result['stderr'], end='')
+    return result
 
 def run_code_files(directory: str) -> None:
     """
@@ -48,10 +84,161 @@ def run_code_files(directory: str) -> None:
     """
     python_files = find_python_files(directory)
     tracker = EmissionsTracker()
-    
-    for file_path in python_files:
-        execute_file(file_path, tracker)
+
+    with script_runner(load_config('config.yaml')) as runner:
+        for file_path in python_files:
+            execute_file(file_path, tracker, runner)
+
+def _measure_file(file_path: str, limits: Dict[str, Optional[int]], conn) -> None:
+    """
+    Worker entry point: run one file under a fresh emissions tracker and send back its record.
+
+    Args:
+        file_path (str): The full path to the Python file to be executed.
+        limits (Dict[str, Optional[int]]): Resource limits for the worker (see script_runner.limit_resources).
+        conn (multiprocessing.connection.Connection): Pipe end used to report the result.
+    """
+    # A process group of its own, so a timeout kills everything the file started
+    os.setsid()
+    limit_resources(limits)
+    record = {'file': file_path, 'status': 'ok', 'error': None,
+              'energy_consumed': None, 'emissions': None}
+    # Workers run concurrently, so none of them writes emissions.csv; the record carries the results.
+    # Each one measures its own process, not the whole machine the other workers share.
+    tracker = EmissionsTracker(save_to_file=False, log_level='error', tracking_mode='process')
+    start_time = time.perf_counter()
+    tracker.start()
+    try:
+        runpy.run_path(file_path, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            record['status'] = 'error'
+            record['error'] = f"SystemExit({e.code!r})"
+    except BaseException as e:
+        record['status'] = 'error'
+        record['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        record['emissions'] = tracker.stop()  # in kgCO2
+        record['duration'] = time.perf_counter() - start_time
+        emissions_data = tracker.final_emissions_data
+        if emissions_data is not None:
+            record['energy_consumed'] = emissions_data.energy_consumed  # in kWh
+    conn.send(record)
+    conn.close()
+
+def _kill_worker(process: multiprocessing.Process) -> None:
+    """
+    Kill a worker and every process it started.
+
+    Args:
+        process (multiprocessing.Process): The worker, which leads its own process group.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # Either everything has exited, or the worker has not made its group yet
+        if process.exitcode is None:
+            process.kill()
+
+def _pool_settings(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Derive worker count and per-file timeout from the configuration.
+
+    Args:
+        config (Dict[str, Any]): Configuration settings loaded from config.yaml.
+
+    Returns:
+        Dict[str, Any]: The 'max_workers' and 'timeout' settings.
+    """
+    advanced = config.get('advanced', {})
+    execution = config.get('execution', {})
+    max_workers = advanced.get('max_threads', os.cpu_count() or 1)
+    if not advanced.get('use_multiprocessing', True):
+        max_workers = 1
+    return {
+        'max_workers': max(1, int(max_workers)),
+        'timeout': execution.get('timeout'),
+    }
+
+def run_code_files_parallel(directory: str, config: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Execute all Python files in the given directory, each in its own worker process.
+
+    Every file gets a fresh interpreter state and a fresh EmissionsTracker, so a script that
+    leaks state or hangs cannot affect the others. At most `advanced.max_threads` workers run
+    at once (a single worker when `advanced.use_multiprocessing` is false). Workers run under the
+    `execution` CPU time, memory and file size limits, and one that exceeds `execution.timeout`
+    seconds is killed, together with any processes it started.
+
+    Args:
+        directory (str): The root directory to start searching for Python files.
+        config (Dict[str, Any], optional): Configuration settings. Defaults to loading config.yaml.
+
+    Yields:
+        Dict[str, Any]: One record per file, in completion order, with the keys 'file', 'status'
+        ('ok', 'error' or 'timeout'), 'error', 'duration', 'energy_consumed' and 'emissions'.
+    """
+    if config is None:
+        config = load_config('config.yaml')
+    settings = _pool_settings(config)
+    timeout = settings['timeout']
+    limits = resource_limits(config)
+
+    pending = list(reversed(find_python_files(directory)))
+    running = {}  # Maps the parent end of each pipe to (process, file_path, start_time)
+
+    try:
+        while pending or running:
+            # Top the pool up to its configured size
+            while pending and len(running) < settings['max_workers']:
+                file_path = pending.pop()
+                parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+                # Not a daemon, so the measured script can start processes of its own
+                process = multiprocessing.Process(target=_measure_file, args=(file_path, limits, child_conn))
+                process.start()
+                child_conn.close()
+                running[parent_conn] = (process, file_path, time.monotonic())
+
+            wait_for = None
+            if timeout is not None:
+                oldest = min(start for _, _, start in running.values())
+                wait_for = max(0.0, oldest + timeout - time.monotonic())
+
+            for conn in wait(list(running), timeout=wait_for):
+                process, file_path, start = running.pop(conn)
+                try:
+                    record = conn.recv()
+                except EOFError:
+                    # The worker died without reporting, e.g. os._exit() or a crash
+                    record = {'file': file_path, 'status': 'error', 'energy_consumed': None,
+                              'emissions': None, 'duration': time.monotonic() - start}
+                    process.join()
+                    record['error'] = f"Worker exited with code {process.exitcode}"
+                conn.close()
+                process.join()
+                # Processes the file left behind are killed with it
+                _kill_worker(process)
+                yield record
+
+            if timeout is not None:
+                now = time.monotonic()
+                for conn, (process, file_path, start) in list(running.items()):
+                    if now - start >= timeout:
+                        _kill_worker(process)
+                        process.join()
+                        conn.close()
+                        del running[conn]
+                        yield {'file': file_path, 'status': 'timeout', 'energy_consumed': None,
+                               'emissions': None, 'duration': now - start,
+                               'error': f"Exceeded the {timeout}s timeout"}
+    finally:
+        # Don't leave workers behind if the caller stops consuming early
+        for conn, (process, _, _) in running.items():
+            _kill_worker(process)
+            process.join()
+            conn.close()
 
 if __name__ == "__main__":
     CODE_DIRECTORY = 'path/to/RefactorEarth/RefactorEarth-main/Code Samples'
-    run_code_files(CODE_DIRECTORY)
+    for record in run_code_files_parallel(CODE_DIRECTORY):
+        print(record)
@@ -0,0 +1,10 @@
+from benchmark_harness import run_once
+
+def test_run_once_applies_resource_limits(tmp_path):
+    script = tmp_path / 'write.py'
+    script.write_text("with open('out.bin', 'wb') as f:\n    f.write(b'x' * 1024 * 1024)\n")
+    unlimited = run_once(str(script), timeout=30, track_energy=False, limits={})
+    assert unlimited['returncode'] == 0
+    limited = run_once(str(script), timeout=30, track_energy=False, limits={'file_size': 64 * 1024})
+    assert limited['returncode'] != 0
+    assert (tmp_path / 'out.bin').stat().st_size <= 64 * 1024
@@ -0,0 +1,77 @@
+import threading
+import pytest
+from generation_cache import GenerationCache
+from job_queue import JobCancelled
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = GenerationCache(str(tmp_path / 'generation.sqlite'))
+    cache.POLL_INTERVAL = 0.01
+    return cache
+
+def start_leader(cache, generate):
+    outcome = {}
+
+    def run():
+        try:
+            outcome['response'] = cache.get_or_generate('model', 'task', 'x = 1', generate)
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, outcome
+
+def test_waiting_caller_stops_when_its_own_job_is_cancelled(cache):
+    started, release = threading.Event(), threading.Event()
+
+    def generate():
+        started.set()
+        release.wait(5)
+        return 'leader'
+
+    thread, outcome = start_leader(cache, generate)
+    assert started.wait(5)
+
+    def check():
+        raise JobCancelled('follower')
+
+    with pytest.raises(JobCancelled):
+        cache.get_or_generate('model', 'task', 'x = 1', lambda: 'follower', check=check)
+    release.set()
+    thread.join(5)
+    assert outcome['response'] == 'leader'
+
+def test_waiting_caller_takes_over_from_a_cancelled_leader(cache):
+    started, release = threading.Event(), threading.Event()
+
+    def generate():
+        started.set()
+        release.wait(5)
+        raise JobCancelled('leader')
+
+    thread, outcome = start_leader(cache, generate)
+    assert started.wait(5)
+    timer = threading.Timer(0.2, release.set)
+    timer.start()
+    response = cache.get_or_generate('model', 'task', 'x = 1', lambda: 'follower', check=lambda: None)
+    thread.join(5)
+    assert response == 'follower'
+    assert isinstance(outcome['error'], JobCancelled)
+    assert cache.stats()['coalesced'] == 1
+    assert cache.get_or_generate('model', 'task', 'x = 1', lambda: 'unused') == 'follower'
+
+def test_waiting_caller_shares_other_failures(cache):
+    started, release = threading.Event(), threading.Event()
+
+    def generate():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("model failed")
+
+    thread, _ = start_leader(cache, generate)
+    assert started.wait(5)
+    threading.Timer(0.2, release.set).start()
+    with pytest.raises(RuntimeError):
+        cache.get_or_generate('model', 'task', 'x = 1', lambda: 'follower', check=lambda: None)
+    thread.join(5)
@@ -0,0 +1,22 @@
+import os
+import subprocess
+import sys
+import pytest
+from lazy_imports import measure_import_time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Seconds a cold `import metrics` may take; the analysis tools import it only for the static metrics
+IMPORT_BUDGET = 1.0
+HEAVY_MODULES = ('streamlit', 'plotly', 'pandas', 'git', 'transformers', 'torch', 'codecarbon', 'memory_profiler')
+
+def test_metrics_import_is_within_budget(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    # The fastest of a few runs, so a cold disk cache on the first one doesn't fail the test
+    elapsed = min(measure_import_time('metrics') for _ in range(3))
+    assert elapsed <= IMPORT_BUDGET, f"import metrics took {elapsed:.3f}s, over the {IMPORT_BUDGET}s budget"
+
+@pytest.mark.parametrize('module', HEAVY_MODULES)
+def test_metrics_import_defers_heavy_dependencies(module):
+    code = f"import sys, metrics\nprint({module!r} in sys.modules)"
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    assert output.strip() == 'False'
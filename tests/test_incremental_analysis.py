@@ -0,0 +1,81 @@
+import ast
+import subprocess
+import pytest
+from analysis_cache import AnalysisCache, normalized_hash
+from analysis_engine import analyze_source
+from incremental_analysis import IncrementalAnalyzer
+
+def git(cwd, *args):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+def commit(repo, name, source, message):
+    (repo / name).write_text(source)
+    git(repo, 'add', name)
+    git(repo, 'commit', '-q', '-m', message)
+    return git(repo, 'rev-parse', 'HEAD')
+
+@pytest.fixture
+def repo(tmp_path):
+    path = tmp_path / 'repo'
+    path.mkdir()
+    git(path, 'init', '-q', '-b', 'main')
+    git(path, 'config', 'user.email', 'test@example.com')
+    git(path, 'config', 'user.name', 'Test')
+    return path
+
+@pytest.fixture
+def cache(tmp_path):
+    return AnalysisCache(str(tmp_path / 'analysis.sqlite'))
+
+def test_single_commit_repository(repo, cache):
+    root = commit(repo, 'a.py', "def f():\n    return 1\n", "root")
+    timeline = IncrementalAnalyzer(str(repo), cache).analyze_range('HEAD~1..HEAD')
+    assert [record['commit'] for record in timeline] == [root]
+    assert timeline[0]['totals']['functions'] == 1
+
+def test_merged_branch_is_one_mainline_commit(repo, cache):
+    first = commit(repo, 'a.py', "def f():\n    return 1\n", "first")
+    git(repo, 'checkout', '-q', '-b', 'side')
+    commit(repo, 'b.py', "def g(xs):\n    for x in xs:\n        for y in xs:\n            print(x, y)\n", "side")
+    git(repo, 'checkout', '-q', 'main')
+    second = commit(repo, 'a.py', "def f():\n    return 2\n", "second")
+    git(repo, 'merge', '-q', '--no-ff', '-m', 'merge side', 'side')
+    merge = git(repo, 'rev-parse', 'HEAD')
+
+    timeline = IncrementalAnalyzer(str(repo), cache).analyze_range('HEAD')
+
+    assert [record['commit'] for record in timeline] == [first, second, merge]
+    assert [record['totals']['functions'] for record in timeline] == [1, 1, 2]
+    assert timeline[-1]['files_changed'] == 1
+
+def test_bare_repository_matches_working_tree(repo, cache, tmp_path):
+    commit(repo, 'a.py', "def f():\n    return 1\n", "first")
+    commit(repo, 'a.py', "def f(xs):\n    return [x for x in xs]\n\ndef g():\n    pass\n", "second")
+    bare = tmp_path / 'bare.git'
+    git(tmp_path, 'clone', '-q', '--bare', str(repo), str(bare))
+
+    expected = IncrementalAnalyzer(str(repo), cache).analyze_range('HEAD~1..HEAD')
+    timeline = IncrementalAnalyzer(str(bare), cache).analyze_range('HEAD~1..HEAD')
+
+    # The second run reuses the first one's stored results, so only compare what was measured
+    assert [(r['commit'], r['totals']) for r in timeline] == [(r['commit'], r['totals']) for r in expected]
+    assert timeline[0]['functions_analyzed'] == 0
+    assert timeline[0]['totals']['functions'] == 2
+
+def test_comments_and_blank_lines_keep_the_hash():
+    before = "def f(xs):\n    total = 0\n    for x in xs:\n        total += x\n    return total\n"
+    after = ("# Sums\n\ndef f(xs):\n    total = 0\n\n    # Every element\n    for x in xs:  # in order\n"
+             "        total += x\n    return total\n")
+    assert normalized_hash(ast.parse(before).body[0]) == normalized_hash(ast.parse(after).body[0])
+    assert normalized_hash(ast.parse(before)) == normalized_hash(ast.parse(after))
+    split = before.replace("total += x", "total += (\n            x)")
+    assert normalized_hash(ast.parse(before).body[0]) != normalized_hash(ast.parse(split).body[0])
+
+def test_changed_module_reuses_unchanged_functions(cache):
+    functions = "def f(xs):\n    return sorted(xs)\n\ndef test_f():\n    assert f([2, 1]) == [1, 2]\n"
+    cache.analyze(functions)
+    changed = functions + "\ndef g(xs):\n    return [x for x in xs for y in xs]\n"
+    hits = cache.stats()['hits']
+    results = cache.analyze(changed)
+    assert cache.stats()['hits'] == hits + 2
+    assert results == analyze_source(changed)
@@ -0,0 +1,97 @@
+import threading
+import pytest
+import torch
+from inference_scheduler import InferenceScheduler
+
+EOS = 0
+
+class FakeTokenizer:
+    """Maps each character to its code point; 'generation' appends the prompt's characters reversed."""
+
+    pad_token = '\0'
+    eos_token = '\0'
+    pad_token_id = 0
+    eos_token_id = EOS
+    padding_side = 'right'
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+
+    def __call__(self, prompts, return_tensors=None, padding=False, add_special_tokens=True):
+        if isinstance(prompts, str):
+            return {'input_ids': [ord(c) for c in prompts]}
+        width = max(len(p) for p in prompts)
+        ids = [[self.pad_token_id] * (width - len(p)) + [ord(c) for c in p] for p in prompts]
+        return {'input_ids': torch.tensor(ids)}
+
+    def decode(self, tokens, skip_special_tokens=True):
+        text = ''.join(chr(t) for t in tokens)
+        if text == self.fail_on:
+            raise ValueError(f"cannot decode {text!r}")
+        return text
+
+class FakeModel:
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.prompts = []
+
+    def generate(self, input_ids, max_new_tokens, pad_token_id, **kwargs):
+        if self.gate is not None:
+            self.gate.wait(5)
+        rows = []
+        for row in input_ids.tolist():
+            prompt = [t for t in row if t != pad_token_id]
+            self.prompts.append(''.join(chr(t) for t in prompt))
+            rows.append(row + (prompt[::-1] + [EOS] * max_new_tokens)[:max_new_tokens])
+        return torch.tensor(rows)
+
+@pytest.fixture
+def make_scheduler():
+    schedulers = []
+
+    def make(model, tokenizer, **kwargs):
+        scheduler = InferenceScheduler(model, tokenizer, **kwargs)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.close()
+
+def test_batches_concurrent_requests(make_scheduler):
+    model = FakeModel(gate=threading.Event())
+    scheduler = make_scheduler(model, FakeTokenizer(), max_batch_size=4, max_wait_ms=200)
+    futures = [scheduler.submit(prompt, max_new_tokens=5) for prompt in ('ab', 'cde', 'f')]
+    model.gate.set()
+    assert [f.result(timeout=5) for f in futures] == ['ba', 'edc', 'f']
+    assert scheduler.stats()['batches'] == 1
+
+def test_decode_failure_fails_the_batch_and_keeps_the_worker_alive(make_scheduler):
+    scheduler = make_scheduler(FakeModel(), FakeTokenizer(fail_on='yx'), max_batch_size=1, max_wait_ms=1)
+    with pytest.raises(ValueError):
+        scheduler.submit('xy', max_new_tokens=5).result(timeout=5)
+    assert scheduler.submit('ok', max_new_tokens=5).result(timeout=5) == 'ko'
+
+def test_generation_failure_is_reported_to_every_caller(make_scheduler):
+    class BrokenModel(FakeModel):
+        def generate(self, *args, **kwargs):
+            raise RuntimeError("out of memory")
+
+    scheduler = make_scheduler(BrokenModel(), FakeTokenizer(), max_batch_size=2, max_wait_ms=200)
+    futures = [scheduler.submit('a'), scheduler.submit('b')]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="out of memory"):
+            future.result(timeout=5)
+
+def test_cancelled_request_is_not_generated(make_scheduler):
+    model = FakeModel(gate=threading.Event())
+    scheduler = make_scheduler(model, FakeTokenizer(), max_batch_size=1, max_wait_ms=1)
+    first = scheduler.submit('first', max_new_tokens=5)
+    cancelled = scheduler.submit('skip', max_new_tokens=5)
+    last = scheduler.submit('last', max_new_tokens=5)
+    assert cancelled.cancel()
+    model.gate.set()
+    assert first.result(timeout=5) == 'tsrif'
+    assert last.result(timeout=5) == 'tsal'
+    assert cancelled.cancelled()
+    assert 'skip' not in model.prompts
@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+import pytest
+from job_queue import CANCELLED, DONE, JobCancelled, JobQueue
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite'), workers=1, progress_interval=0)
+    yield queue
+    queue.shutdown()
+
+def blocking_job(started, release):
+    def job(context, value):
+        started.set()
+        while not release.wait(0.01):
+            context.check()
+        return value
+    return job
+
+def test_cancel_stops_a_running_job(queue):
+    started, release = threading.Event(), threading.Event()
+    queue.register('block', blocking_job(started, release))
+    job_id = queue.submit('block', 1)
+    assert started.wait(5)
+    assert queue.cancel(job_id)
+    assert queue.wait(job_id, timeout=5)['status'] == CANCELLED
+
+def test_coalesced_job_runs_until_every_submitter_cancels(queue):
+    started, release = threading.Event(), threading.Event()
+    queue.register('block', blocking_job(started, release))
+    first = queue.submit('block', 1)
+    second = queue.submit('block', 1)
+    assert first == second
+    assert started.wait(5)
+    assert not queue.cancel(first)
+    assert queue.get(first)['status'] == 'running'
+    assert queue.cancel(second)
+    assert queue.wait(first, timeout=5)['status'] == CANCELLED
+
+def test_coalesced_job_finishes_for_the_remaining_submitter(queue):
+    started, release = threading.Event(), threading.Event()
+    queue.register('block', blocking_job(started, release))
+    job_id = queue.submit('block', 2)
+    queue.submit('block', 2)
+    assert started.wait(5)
+    assert not queue.cancel(job_id)
+    release.set()
+    job = queue.wait(job_id, timeout=5)
+    assert job['status'] == DONE and job['result'] == 2
+
+def test_resubmitting_after_the_last_cancel_withdraws_it(queue):
+    started, release = threading.Event(), threading.Event()
+    queue.register('block', blocking_job(started, release))
+    first = queue.submit('block', 5)
+    assert started.wait(5)
+    assert queue.cancel(first)
+    second = queue.submit('block', 5)
+    assert second == first
+    release.set()
+    job = queue.wait(second, timeout=5)
+    assert job['status'] == DONE and job['result'] == 5
+
+def test_resubmitting_after_a_cancelled_job_stopped_runs_it_again(queue):
+    runs = []
+    def job(context, value):
+        runs.append(value)
+        if len(runs) == 1:
+            queue.cancel(context.job_id)
+            assert context.cancelled
+            queue.submit('flaky', value)  # Arrives after this run saw the cancellation, before it stopped
+            raise JobCancelled(context.job_id)
+        return value
+    queue.register('flaky', job)
+    job_id = queue.submit('flaky', 6)
+    result = queue.wait(job_id, timeout=5)
+    assert result['status'] == DONE and result['result'] == 6
+    assert runs == [6, 6]
+
+def test_force_cancels_for_everyone(queue):
+    started, release = threading.Event(), threading.Event()
+    queue.register('block', blocking_job(started, release))
+    job_id = queue.submit('block', 3)
+    queue.submit('block', 3)
+    assert started.wait(5)
+    assert queue.cancel(job_id, force=True)
+    assert queue.wait(job_id, timeout=5)['status'] == CANCELLED
+
+def test_opens_a_database_without_subscriber_counts(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, args TEXT NOT NULL, status TEXT NOT NULL, "
+        "progress REAL NOT NULL, message TEXT, result TEXT, error TEXT, owner TEXT NOT NULL, "
+        "cancel_requested INTEGER NOT NULL, submitted REAL NOT NULL, started REAL, finished REAL)"
+    )
+    conn.commit()
+    conn.close()
+    queue = JobQueue(path, workers=1)
+    try:
+        queue.register('echo', lambda context, value: value)
+        job = queue.wait(queue.submit('echo', 4), timeout=5)
+        assert job['status'] == DONE and job['subscribers'] == 1
+    finally:
+        queue.shutdown()
@@ -0,0 +1,38 @@
+import logging
+from optimization_loop import OptimizationLoop, rule_candidates
+
+MODULE = '''
+import re
+
+WORD = re.compile(r"[a-z]+")
+WEIGHTS = {"a": 2, "b": 3}
+
+def score(words):
+    total = ""
+    for word in words:
+        total += str(WEIGHTS.get(word, 1)) + WORD.sub("", str(word))
+    return total
+
+def broken(words):
+    text = ""
+    for word in words:
+        text += MISSING[word]
+    return text
+
+if __name__ == "__main__":
+    raise SystemExit(score(["a"]))
+'''
+
+def make_loop():
+    return OptimizationLoop([rule_candidates], max_iterations=1, size=20, repeats=1, rounds=1,
+                            timeout=30.0, workers=1, log_file=None)
+
+def test_functions_see_module_level_data():
+    result = make_loop().optimize_function(MODULE, 'score')
+    assert result['stopped'] in ('max_iterations', 'plateau', 'target_reached')
+
+def test_unmeasurable_function_is_logged(caplog):
+    with caplog.at_level(logging.WARNING, logger='optimization_loop'):
+        result = make_loop().optimize_function(MODULE, 'broken')
+    assert result['stopped'] == 'unmeasurable' and result['reduction'] == 0.0
+    assert "broken unchanged" in caplog.text and "NameError" in caplog.text
@@ -0,0 +1,77 @@
+import os
+import subprocess
+import pytest
+from repo_mirror import MirrorCache
+
+def git(*args, cwd=None):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+def commit(work, name, text):
+    with open(os.path.join(work, name), 'w') as f:
+        f.write(text)
+    git('add', name, cwd=work)
+    git('commit', '-q', '-m', f"Write {name}", cwd=work)
+    return git('rev-parse', 'HEAD', cwd=work)
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    """A bare repository with a 'main' and a 'dev' branch, and a clone to push new commits from."""
+    for variable in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv(f"GIT_{variable}_NAME", 'Test')
+        monkeypatch.setenv(f"GIT_{variable}_EMAIL", 'test@example.com')
+    origin, work = str(tmp_path / 'origin.git'), str(tmp_path / 'work')
+    git('init', '-q', '--bare', '--initial-branch=main', origin)
+    git('clone', '-q', origin, work)
+    git('checkout', '-q', '-b', 'main', cwd=work)
+    commit(work, 'a.py', "x = 1\n")
+    git('push', '-q', 'origin', 'main', cwd=work)
+    git('checkout', '-q', '-b', 'dev', cwd=work)
+    commit(work, 'b.py', "y = 2\n")
+    git('push', '-q', 'origin', 'dev', cwd=work)
+    git('checkout', '-q', 'main', cwd=work)
+    return origin, work
+
+@pytest.fixture
+def cache(tmp_path):
+    return MirrorCache(str(tmp_path / 'cache'), filter=None, refresh_interval=300)
+
+def test_clones_once_and_checks_out(tmp_path, remote, cache):
+    origin, work = remote
+    target = str(tmp_path / 'checkout')
+    assert cache.checkout(origin, target, 'main') == git('rev-parse', 'main', cwd=work)
+    mirror = os.path.basename(cache.mirror_path(origin))
+    assert sorted(os.listdir(cache.directory)) == [mirror, mirror + '.lock']
+    assert os.path.exists(os.path.join(target, 'a.py')) and not os.path.exists(os.path.join(target, 'b.py'))
+    assert cache.worktrees(origin) == [os.path.abspath(target)]
+
+def test_checkout_again_resets_the_worktree(tmp_path, remote, cache):
+    origin, work = remote
+    target = str(tmp_path / 'checkout')
+    first = cache.checkout(origin, target, 'main')
+    with open(os.path.join(target, 'a.py'), 'w') as f:
+        f.write("x = 'edited'\n")
+    open(os.path.join(target, 'scratch.txt'), 'w').close()
+    latest = commit(work, 'a.py', "x = 3\n")
+    git('push', '-q', 'origin', 'main', cwd=work)
+    # Within the refresh interval the mirror is not fetched again
+    assert cache.checkout(origin, target, 'main') == first
+    assert open(os.path.join(target, 'a.py')).read() == "x = 1\n"
+    assert not os.path.exists(os.path.join(target, 'scratch.txt'))
+    assert cache.checkout(origin, target, 'main', force=True) == latest
+    assert open(os.path.join(target, 'a.py')).read() == "x = 3\n"
+
+def test_second_branch_is_fetched_within_the_refresh_interval(tmp_path, remote, cache):
+    origin, work = remote
+    cache.checkout(origin, str(tmp_path / 'main'), 'main')
+    assert cache.checkout(origin, str(tmp_path / 'dev'), 'dev') == git('rev-parse', 'dev', cwd=work)
+    assert os.path.exists(tmp_path / 'dev' / 'b.py')
+    assert sorted(cache.worktrees(origin)) == [str(tmp_path / 'dev'), str(tmp_path / 'main')]
+
+def test_refuses_to_overwrite_another_directory(tmp_path, remote, cache):
+    origin, _ = remote
+    target = tmp_path / 'taken'
+    target.mkdir()
+    (target / 'notes.txt').write_text("keep me\n")
+    with pytest.raises(FileExistsError):
+        cache.checkout(origin, str(target), 'main')
+    assert (target / 'notes.txt').read_text() == "keep me\n"
@@ -0,0 +1,219 @@
+import ast
+import textwrap
+import pytest
+from rewrite_rules import check_equivalence, module_namespace, optimize_source, rewrite_function
+
+def rewrite(source):
+    function = ast.parse(textwrap.dedent(source)).body[0]
+    rewritten, applied = rewrite_function(function)
+    return applied, ast.unparse(rewritten)
+
+def test_dedup_membership_with_hashable_items():
+    applied, code = rewrite("""
+        def unique(items: List[int]):
+            seen = []
+            for item in items:
+                if item not in seen:
+                    seen.append(item)
+            return seen
+    """)
+    assert applied == ['dedup_membership']
+    assert 'dict.fromkeys(items)' in code
+
+@pytest.mark.parametrize('signature', ['items', 'items: List[list]', 'items: list'])
+def test_dedup_membership_needs_known_hashable_items(signature):
+    # Lists of lists are deduplicated fine by membership tests, but dict.fromkeys raises TypeError
+    applied, _ = rewrite(f"""
+        def unique({signature}):
+            seen = []
+            for item in items:
+                if item not in seen:
+                    seen.append(item)
+            return seen
+    """)
+    assert 'dedup_membership' not in applied
+
+def test_string_join():
+    applied, code = rewrite("""
+        def render(words):
+            text = ''
+            for word in words:
+                text += word + ' '
+            return text
+    """)
+    assert applied == ['string_join']
+    assert "''.join([word + ' ' for word in words])" in code
+
+def test_string_join_keeps_a_loop_variable_used_afterwards():
+    applied, _ = rewrite("""
+        def render(words):
+            text = ''
+            for word in words:
+                text += word
+            return text, word
+    """)
+    assert applied == []
+
+def test_bubble_sort_becomes_builtin_sort():
+    applied, code = rewrite("""
+        def order(values):
+            n = len(values)
+            for i in range(n):
+                for j in range(n - i - 1):
+                    if values[j] > values[j + 1]:
+                        values[j], values[j + 1] = values[j + 1], values[j]
+            return values
+    """)
+    assert applied == ['builtin_sort']
+    assert 'values.sort()' in code
+
+def test_sort_with_index_used_afterwards_is_kept():
+    applied, _ = rewrite("""
+        def order(values):
+            n = len(values)
+            for i in range(n):
+                for j in range(n - i - 1):
+                    if values[j] > values[j + 1]:
+                        values[j], values[j + 1] = values[j + 1], values[j]
+            return i
+    """)
+    assert applied == []
+
+def test_hoist_aggregate_over_a_list():
+    applied, code = rewrite("""
+        def shares(values: list):
+            out = []
+            for value in values:
+                share = value / sum(values)
+                out.append(share)
+            return out
+    """)
+    assert applied == ['hoist_aggregate']
+    assert code.index('sum_values = sum(values)') < code.index('for value in values')
+
+def test_hoist_aggregate_over_range_len():
+    applied, _ = rewrite("""
+        def shares(values):
+            total = 0
+            for i in range(len(values)):
+                total += values[i] * sum(values)
+            return total
+    """)
+    assert applied == ['hoist_aggregate']
+
+def test_hoist_aggregate_skips_possible_iterators():
+    # sum() before the loop would exhaust an iterator the loop then finds empty
+    applied, _ = rewrite("""
+        def shares(values):
+            out = []
+            for value in values:
+                share = value / sum(values)
+                out.append(share)
+            return out
+    """)
+    assert 'hoist_aggregate' not in applied
+
+def test_hoist_aggregate_skips_loops_calling_other_functions():
+    # bump() may change the list through a global or an alias
+    applied, _ = rewrite("""
+        def shares(values: list):
+            total = 0
+            for value in values:
+                total += value * sum(values)
+                bump()
+            return total
+    """)
+    assert applied == []
+
+def test_hoist_append_open():
+    applied, code = rewrite("""
+        def save(lines, path):
+            for line in lines:
+                with open(path, 'a') as f:
+                    f.write(line)
+    """)
+    assert applied == ['hoist_append_open']
+    assert code.count('open(') == 1 and 'f.close()' in code
+
+@pytest.mark.parametrize('body', ["with open(path, 'w') as f:\n        f.write(line)",
+                                  "with open(path, 'a') as f:\n        f.write(line)\n        f.flush()"])
+def test_hoist_append_open_needs_append_mode_and_only_writes(body):
+    applied, _ = rewrite(f"""
+def save(lines, path):
+    for line in lines:
+    {body}
+""".replace('\n    with', '\n        with').replace('\n        f.', '\n            f.'))
+    assert applied == []
+
+def test_append_loop_comprehension_iterates_a_list_directly():
+    applied, code = rewrite("""
+        def doubled(values: List[int]):
+            out = []
+            for i in range(len(values)):
+                out.append(values[i] * 2)
+            return out
+    """)
+    assert applied == ['append_loop_comprehension']
+    assert 'for values_i in values' in code
+
+def test_append_loop_comprehension_keeps_indexing_a_dict():
+    # Iterating over a dict yields its keys, not d[i]
+    applied, code = rewrite("""
+        def doubled(table: dict):
+            out = []
+            for i in range(len(table)):
+                out.append(table[i] * 2)
+            return out
+    """)
+    assert applied == ['append_loop_comprehension']
+    assert 'for i in range(len(table))' in code and 'table[i]' in code
+
+MODULE = """
+DATA = [1, 2, 3]
+
+def bump():
+    DATA.append(len(DATA))
+
+def score(n):
+    total = 0
+    for value in DATA:
+        total += value * sum(DATA)
+        if len(DATA) < 6:
+            bump()
+    return total + n
+"""
+
+def test_equivalence_sees_non_constant_globals():
+    original = ast.unparse(ast.parse(MODULE).body[2])
+    hoisted = original.replace('    for value in DATA:', '    data_sum = sum(DATA)\n    for value in DATA:')
+    hoisted = hoisted.replace('* sum(DATA)', '* data_sum')
+    verdict = check_equivalence(MODULE, original, hoisted)
+    assert verdict['equivalent'] is False
+    assert check_equivalence(MODULE, original, original.replace('total = 0', 'total = 0 * 1'))['equivalent']
+
+def test_equivalence_rejects_an_original_that_always_fails():
+    module = "def broken(n):\n    return MISSING + n\n"
+    verdict = check_equivalence(module, module, module.replace('MISSING + n', 'MISSING + n + 0'))
+    assert verdict['equivalent'] is False
+    assert 'every sample input' in verdict['detail']
+
+def test_module_namespace_skips_script_code():
+    namespace = module_namespace(ast.parse(
+        "import math\nWEIGHTS = [math.pi, 2]\nmain()\n"
+        "if __name__ == '__main__':\n    raise SystemExit(1)\n"))
+    assert namespace['WEIGHTS'] == [3.141592653589793, 2]
+
+def test_optimize_source_keeps_only_verified_rewrites():
+    source = textwrap.dedent("""
+        from typing import List
+
+        def unique(items: List[int]):
+            seen = []
+            for item in items:
+                if item not in seen:
+                    seen.append(item)
+            return seen
+    """)
+    result = optimize_source(source)
+    assert [rewrite['function'] for rewrite in result['rewrites']] == ['unique']
+    assert 'dict.fromkeys' in result['source'] and 'from typing import List' in result['source']
@@ -0,0 +1,111 @@
+import itertools
+import numpy as np
+import pytest
+from training_data import BucketedDataset, LengthBucketSampler, PackedDataset, pad_ratio, tokenize_sources, training_dataset
+
+CLS, SEP = 1, 2
+OFFSET = 10  # Token ids of characters start here, clear of the special tokens
+
+class FakeTokenizer:
+    """Maps each character to one token id, so token ids decode back to the text."""
+
+    name_or_path = 'fake'
+    cls_token_id = CLS
+    sep_token_id = SEP
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_vocab(self):
+        return {'[CLS]': CLS, '[SEP]': SEP}
+
+    def __len__(self):
+        return 256 + OFFSET
+
+    def __call__(self, texts, add_special_tokens=True, verbose=True):
+        self.calls += 1
+        return {'input_ids': [[ord(c) % 256 + OFFSET for c in text] for text in texts]}
+
+def decode(ids):
+    return ''.join(chr(i - OFFSET) for i in ids)
+
+DOCUMENTS = {
+    'a.py': "x = 1\n",
+    'b.py': "def f(a, b):\n    return a + b\n" * 5,
+    'c.py': "",
+    'd.py': "print('hello')\n" * 3,
+    'e.py': "y = [i * i for i in range(10)]\n",
+}
+
+@pytest.fixture
+def corpus(tmp_path):
+    source = tmp_path / 'src'
+    source.mkdir()
+    for name, text in DOCUMENTS.items():
+        (source / name).write_text(text)
+    return tokenize_sources([str(source)], FakeTokenizer(), str(tmp_path / 'cache'), batch_files=2)
+
+def test_tokenize_round_trip_skips_empty_files(corpus):
+    texts = [text for _, text in sorted(DOCUMENTS.items()) if text]
+    assert corpus.num_documents == len(texts)
+    assert corpus.num_tokens == sum(map(len, texts))
+    assert [decode(corpus.document(i)) for i in range(corpus.num_documents)] == texts
+    assert [name.rsplit('/', 1)[-1] for name in corpus.meta['files']] == ['a.py', 'b.py', 'd.py', 'e.py']
+
+def test_tokenize_is_cached(tmp_path, corpus):
+    tokenizer = FakeTokenizer()
+    again = tokenize_sources([str(tmp_path / 'src')], tokenizer, str(tmp_path / 'cache'))
+    assert tokenizer.calls == 0
+    assert again.path == corpus.path
+
+@pytest.mark.parametrize('seq_length', [4, 16, 64])
+def test_packed_sequences_rebuild_the_stream(corpus, seq_length):
+    dataset = PackedDataset(corpus, seq_length, CLS, SEP)
+    stream = list(itertools.chain.from_iterable(list(corpus.document(i)) + [SEP] for i in range(corpus.num_documents)))
+    assert len(dataset) == len(stream) // (seq_length - 2)
+    inner = []
+    for index in range(len(dataset)):
+        ids = dataset[index]['input_ids']
+        assert len(ids) == seq_length
+        assert ids[0] == CLS and ids[-1] == SEP
+        inner.extend(ids[1:-1])
+    assert inner == stream[:len(inner)]
+
+@pytest.mark.parametrize('max_length', [5, 12, 512])
+def test_bucketed_examples_rebuild_each_document(corpus, max_length):
+    dataset = BucketedDataset(corpus, max_length, CLS, SEP)
+    pieces = {}
+    for index in range(len(dataset)):
+        ids = dataset[index]['input_ids']
+        assert len(ids) == dataset.lengths[index] <= max_length
+        assert ids[0] == CLS and ids[-1] == SEP
+        pieces.setdefault(int(dataset.documents[index]), []).extend(ids[1:-1])
+    assert pieces == {i: list(corpus.document(i)) for i in range(corpus.num_documents)}
+
+def test_bucket_sampler_covers_every_example_once_per_epoch():
+    lengths = [3, 40, 7, 100, 33, 5, 64, 2, 90, 31]
+    boundaries = [8, 32, 64, 128]
+    sampler = LengthBucketSampler(lengths, batch_size=2, boundaries=boundaries, seed=3)
+    buckets = np.searchsorted(boundaries, lengths, side='left')
+    epochs = [list(sampler) for _ in range(3)]
+    for batches in epochs:
+        assert len(batches) == len(sampler)
+        assert sorted(itertools.chain.from_iterable(batches)) == list(range(len(lengths)))
+        for batch in batches:
+            assert len(batch) <= 2
+            assert len({buckets[i] for i in batch}) == 1
+    assert epochs[0] != epochs[1] or epochs[1] != epochs[2]
+    replay = LengthBucketSampler(lengths, batch_size=2, boundaries=boundaries, seed=3)
+    assert list(replay) == epochs[0]
+
+def test_training_dataset_modes(corpus):
+    tokenizer = FakeTokenizer()
+    packed, sampler = training_dataset(corpus, tokenizer, 'pack', max_length=16)
+    assert sampler is None
+    assert pad_ratio(packed, [range(len(packed))]) == 0.0
+    bucketed, sampler = training_dataset(corpus, tokenizer, 'bucket', max_length=16, batch_size=2)
+    assert isinstance(bucketed, BucketedDataset)
+    assert sorted(itertools.chain.from_iterable(sampler)) == list(range(len(bucketed)))
+    assert 0.0 <= pad_ratio(bucketed, sampler) < 1.0
+    with pytest.raises(ValueError):
+        training_dataset(corpus, tokenizer, 'fixed')
@@ -0,0 +1,400 @@
+import atexit
+import functools
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Optional, Tuple
+
+HISTOGRAM_BUCKETS = 64
+PAGE_SIZE = resource.getpagesize()
+MEMORY_MODES = ('none', 'rss', 'tracemalloc')
+SETTINGS = {'enabled', 'sample_rate', 'memory', 'memory_sample_rate', 'energy', 'log_summary'}
+
+def current_rss() -> int:
+    """
+    Get the process's current resident set size.
+
+    ru_maxrss is not used: it is the peak over the process's lifetime, so calls after a large
+    one would all measure nothing.
+
+    Returns:
+        int: The resident set size in bytes.
+    """
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        import psutil  # No /proc, e.g. on macOS
+        return psutil.Process().memory_info().rss
+
+class FunctionStats:
+    """
+    Aggregated measurements for one tracked function.
+
+    Durations go into power-of-two nanosecond buckets, so recording a call is an index and an
+    increment. Counters are updated without a lock; under heavy thread contention an
+    occasional count can be lost, which is acceptable for sampled statistics.
+    """
+    __slots__ = ('name', 'every', 'memory_every', 'calls', 'sampled', 'total_ns', 'max_ns',
+                 'histogram', 'memory_samples', 'memory_total', 'memory_max')
+
+    def __init__(self, name: str, every: int, memory_every: int):
+        self.name = name
+        self.every = every
+        self.memory_every = memory_every
+        self.calls = 0
+        self.sampled = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+        self.memory_samples = 0
+        self.memory_total = 0
+        self.memory_max = 0
+
+    def record(self, elapsed_ns: int) -> None:
+        self.sampled += 1
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+        # 64 buckets cover durations up to 2**63 ns, far beyond any real call
+        self.histogram[elapsed_ns.bit_length()] += 1
+
+    def record_memory(self, used: int) -> None:
+        self.memory_samples += 1
+        self.memory_total += used
+        if used > self.memory_max:
+            self.memory_max = used
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """
+        Estimate a duration percentile from the histogram.
+
+        Args:
+            fraction (float): The percentile as a fraction, e.g. 0.99.
+
+        Returns:
+            Optional[float]: The duration in seconds (the geometric middle of its bucket), or None without samples.
+        """
+        if not self.sampled:
+            return None
+        rank = fraction * self.sampled
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                # Bucket b holds durations in [2**(b-1), 2**b) ns
+                return (2 ** (bucket - 0.5) if bucket else 0) / 1e9
+        return self.max_ns / 1e9
+
+class TrackingSession:
+    """
+    A process-wide tracking session shared by every function decorated with `track`.
+
+    One energy sampler (a CodeCarbon tracker) runs for the whole session instead of one per call.
+    It is started lazily on the first sampled call. Each function's estimated energy is the
+    session's energy times that function's share of the session's wall time.
+
+    Per call, the decorator only increments a counter unless the call is sampled. Sampled calls
+    are timed with `perf_counter_ns`, and a fraction of those also record memory. With 'rss' that
+    is how much the resident set size grew over the call, i.e. memory still held when it returns;
+    with 'tracemalloc' it is the peak Python allocation during the call, including memory freed
+    before returning. tracemalloc is more precise, but it slows down every allocation while it is
+    enabled.
+    """
+
+    def __init__(self, enabled: bool = True, sample_rate: float = 0.1, memory: str = 'rss',
+                 memory_sample_rate: float = 0.01, energy: bool = True, log_summary: bool = True):
+        """
+        Args:
+            enabled (bool): Whether calls are recorded at all.
+            sample_rate (float): Fraction of calls that are timed.
+            memory (str): How memory is measured: 'none', 'rss' or 'tracemalloc'.
+            memory_sample_rate (float): Fraction of timed calls that also measure memory.
+            energy (bool): Whether to run the shared CodeCarbon tracker.
+            log_summary (bool): Whether to log the report when the process exits.
+        """
+        if memory not in MEMORY_MODES:
+            raise ValueError(f"Unknown memory mode '{memory}', expected one of {MEMORY_MODES}")
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.memory = memory
+        self.memory_sample_rate = memory_sample_rate
+        self.energy = energy
+        self.log_summary = log_summary
+        self.functions: Dict[str, FunctionStats] = {}
+        self.started = False
+        self._lock = threading.Lock()
+        self._tracker = None
+        self._started_at = None
+        self._stopped_at = None
+        self._energy_consumed = None
+        self._emissions = None
+
+    @staticmethod
+    def _interval(rate: float) -> int:
+        # Sampling every n-th call is cheaper than drawing a random number on every call
+        return max(1, round(1 / rate)) if rate > 0 else sys.maxsize
+
+    def _intervals(self) -> Tuple[int, int]:
+        memory_rate = self.memory_sample_rate if self.memory != 'none' else 0
+        return self._interval(self.sample_rate), self._interval(memory_rate)
+
+    def configure(self, **settings) -> None:
+        """
+        Change the session's settings. Functions that are already tracked pick up the new sampling rates.
+
+        The energy and log_summary settings only take effect if the session hasn't started yet.
+
+        Args:
+            **settings: Any of the constructor's arguments.
+        """
+        unknown = set(settings) - SETTINGS
+        if unknown:
+            raise TypeError(f"Unknown tracking settings: {', '.join(sorted(unknown))}")
+        if settings.get('memory', self.memory) not in MEMORY_MODES:
+            raise ValueError(f"Unknown memory mode '{settings['memory']}', expected one of {MEMORY_MODES}")
+        with self._lock:
+            for key, value in settings.items():
+                setattr(self, key, value)
+            every, memory_every = self._intervals()
+            for stats in self.functions.values():
+                stats.every, stats.memory_every = every, memory_every
+            if self.started and self.memory == 'tracemalloc' and not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def register(self, name: str) -> FunctionStats:
+        """
+        Get the statistics for a function, creating them on first use.
+
+        Args:
+            name (str): The function's qualified name.
+
+        Returns:
+            FunctionStats: The function's statistics.
+        """
+        with self._lock:
+            stats = self.functions.get(name)
+            if stats is None:
+                stats = FunctionStats(name, *self._intervals())
+                self.functions[name] = stats
+            return stats
+
+    def start(self) -> None:
+        """Start the session clock and the shared energy sampler. Calling it again has no effect."""
+        with self._lock:
+            if self._started_at is not None:
+                return
+            self._started_at = time.perf_counter()
+            if self.memory == 'tracemalloc' and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self.energy:
+                try:
+                    from codecarbon import EmissionsTracker
+                    self._tracker = EmissionsTracker(save_to_file=False, log_level='error')
+                    self._tracker.start()
+                except Exception as e:
+                    logging.warning("Energy tracking disabled: %s", e)
+                    self._tracker = None
+            if self.log_summary:
+                atexit.register(self._log_report)
+            self.started = True
+
+    def stop(self) -> None:
+        """Stop the shared energy sampler and freeze the session's duration and energy."""
+        with self._lock:
+            if self._started_at is None or self._stopped_at is not None:
+                return
+            self._stopped_at = time.perf_counter()
+            if self._tracker is not None:
+                self._emissions = self._tracker.stop()
+                data = self._tracker.final_emissions_data
+                self._energy_consumed = data.energy_consumed if data is not None else None
+            if self.memory == 'tracemalloc' and tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def call(self, stats: FunctionStats, func: Callable, args: tuple, kwargs: dict) -> Any:
+        """Run a sampled call on the slow path: start the session if needed, time it and possibly measure its memory."""
+        if not self.started:
+            self.start()
+        if self.memory == 'none' or stats.sampled % stats.memory_every:
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.record(time.perf_counter_ns() - start)
+
+        if self.memory == 'tracemalloc':
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        else:
+            before = current_rss()
+        start = time.perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.record(time.perf_counter_ns() - start)
+            if self.memory == 'tracemalloc':
+                stats.record_memory(tracemalloc.get_traced_memory()[1] - before)
+            else:
+                stats.record_memory(max(0, current_rss() - before))
+
+    def report(self) -> Dict[str, Any]:
+        """
+        Summarize the session.
+
+        Returns:
+            Dict[str, Any]: The session's duration, energy (kWh) and emissions (kg CO2eq), known
+            once the session is stopped, and per function: call counts, timing statistics in
+            seconds, the histogram, memory in bytes and the estimated share of energy and emissions.
+        """
+        if self._started_at is None:
+            duration = 0.0
+        else:
+            duration = (self._stopped_at or time.perf_counter()) - self._started_at
+        functions = {}
+        for name, stats in list(self.functions.items()):
+            # Unsampled calls are assumed to take as long as the sampled ones on average
+            mean = stats.total_ns / stats.sampled / 1e9 if stats.sampled else None
+            estimated_time = mean * stats.calls if mean is not None else 0.0
+            share = min(estimated_time / duration, 1.0) if duration else 0.0
+            functions[name] = {
+                'calls': stats.calls,
+                'sampled_calls': stats.sampled,
+                'mean_time': mean,
+                'max_time': stats.max_ns / 1e9 if stats.sampled else None,
+                'p50_time': stats.percentile(0.50),
+                'p90_time': stats.percentile(0.90),
+                'p99_time': stats.percentile(0.99),
+                'histogram': {f"<{2 ** bucket}ns": count for bucket, count in enumerate(stats.histogram) if count},
+                'memory_samples': stats.memory_samples,
+                'mean_memory': stats.memory_total / stats.memory_samples if stats.memory_samples else None,
+                'max_memory': stats.memory_max if stats.memory_samples else None,
+                'estimated_time': estimated_time,
+                'energy_consumed': self._energy_consumed * share if self._energy_consumed is not None else None,
+                'emissions': self._emissions * share if self._emissions is not None else None,
+            }
+        return {
+            'duration': duration,
+            'energy_consumed': self._energy_consumed,
+            'emissions': self._emissions,
+            'functions': functions,
+        }
+
+    def _log_report(self) -> None:
+        self.stop()
+        logging.info("Tracking session report: %s", json.dumps(self.report()))
+
+_session: Optional[TrackingSession] = None
+_session_lock = threading.Lock()
+
+def configure(config: Optional[Dict[str, Any]] = None, **settings) -> TrackingSession:
+    """
+    Configure the process-wide session, e.g. from the 'tracking' section of config.yaml.
+
+    Args:
+        config (Dict[str, Any], optional): A loaded configuration with a 'tracking' section.
+        **settings: TrackingSession arguments, overriding the configuration.
+
+    Returns:
+        TrackingSession: The session.
+    """
+    session = get_session()
+    session.configure(**dict((config or {}).get('tracking', {}), **settings))
+    return session
+
+def get_session() -> TrackingSession:
+    """
+    Get the process-wide session, creating a default one if none was configured.
+
+    Returns:
+        TrackingSession: The session.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = TrackingSession()
+    return _session
+
+def track(func: Callable) -> Callable:
+    """
+    Decorator that records a function's calls in the process-wide tracking session.
+
+    Args:
+        func (Callable): The function to track.
+
+    Returns:
+        Callable: The wrapped function.
+    """
+    session = get_session()
+    stats = session.register(func.__qualname__)
+    perf_counter_ns = time.perf_counter_ns
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        calls = stats.calls = stats.calls + 1
+        if calls % stats.every or not session.enabled:
+            return func(*args, **kwargs)
+        if not session.started or stats.sampled % stats.memory_every == 0:
+            return session.call(stats, func, args, kwargs)
+        start = perf_counter_ns()
+        result = func(*args, **kwargs)
+        # FunctionStats.record, inlined to keep the timed path short
+        elapsed = perf_counter_ns() - start
+        stats.sampled += 1
+        stats.total_ns += elapsed
+        if elapsed > stats.max_ns:
+            stats.max_ns = elapsed
+        stats.histogram[elapsed.bit_length()] += 1
+        return result
+    return wrapper
+
+def measure_overhead(iterations: int = 1_000_000) -> Dict[str, float]:
+    """
+    Micro-benchmark the decorator's cost per call on an empty function.
+
+    Runs in a private session without energy tracking, so it doesn't disturb the process-wide one.
+
+    Args:
+        iterations (int): Calls per measurement.
+
+    Returns:
+        Dict[str, float]: Nanoseconds per call for the bare function, and the added cost of an
+        unsampled call, a timed call, and timed calls measuring memory with RSS or tracemalloc.
+    """
+    global _session
+
+    def noop():
+        pass
+
+    def per_call(func: Callable) -> float:
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            func()
+        return (time.perf_counter_ns() - start) / iterations
+
+    bare = per_call(noop)
+    results = {'bare_call_ns': bare}
+    variants = {
+        'unsampled_overhead_ns': dict(sample_rate=1 / iterations, memory='none'),
+        'timed_overhead_ns': dict(sample_rate=1.0, memory='none'),
+        'rss_overhead_ns': dict(sample_rate=1.0, memory='rss', memory_sample_rate=1.0),
+        'tracemalloc_overhead_ns': dict(sample_rate=1.0, memory='tracemalloc', memory_sample_rate=1.0),
+    }
+    previous = _session
+    try:
+        for key, settings in variants.items():
+            _session = TrackingSession(energy=False, log_summary=False, **settings)
+            results[key] = per_call(track(noop)) - bare
+            _session.stop()
+    finally:
+        _session = previous
+    return results
+
+if __name__ == "__main__":
+    # Publish the decorator's overhead, e.g. `python tracking_session.py 1000000`
+    print(json.dumps(measure_overhead(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000), indent=2))
@@ -1,59 +1,132 @@
-import torch
-from transformers import RobertaTokenizer, RobertaForMaskedLM, Trainer, TrainingArguments
-from datasets import load_dataset
-import os
-from github import Github
-
-# GitHub setup
-github_token = "YOUR_GITHUB_TOKEN"
-repo_name = "ShaliniAnandaPhD/Sea_Sifter"
-file_path = "train.py"
-
-# Initialize GitHub client
-g = Github(github_token)
-
-# Get the repository
-repo = g.get_repo(repo_name)
-
-# Get the file content
-file_content = repo.get_contents(file_path).decoded_content.decode()
-
-# Save the content to a local file
-with open("local_train.py", "w") as f:
-    f.write(file_content)
-
-# Load the dataset
-dataset = load_dataset("text", data_files={"train": ["local_train.py"]})
-
-# Load tokenizer and model
-tokenizer = RobertaTokenizer.from_pretrained("microsoft/codebert-base")
-model = RobertaForMaskedLM.from_pretrained("microsoft/codebert-base")
-
-# Tokenize the dataset
-def tokenize_function(examples):
-    return tokenizer(examples["text"], padding="max_length", truncation=True, max_length=512)
-
-tokenized_datasets = dataset.map(tokenize_function, batched=True)
-
-# Set up training arguments
-training_args = TrainingArguments(
-    output_dir="./results",
-    num_train_epochs=3,
-    per_device_train_batch_size=8,
-    save_steps=10_000,
-    save_total_limit=2,
-)
-
-# Initialize Trainer
-trainer = Trainer(
-    model=model,
-    args=training_args,
-    train_dataset=tokenized_datasets["train"],
-)
-
-# Start training
-trainer.train()
-
-# Save the fine-tuned model
-model.save_pretrained("./fine_tuned_codebert")
-tokenizer.save_pretrained("./fine_tuned_codebert")
+import argparse
+from torch.utils.data import DataLoader
+from transformers import (DataCollatorForLanguageModeling, RobertaConfig, RobertaForMaskedLM, RobertaTokenizerFast,
+                          Trainer, TrainingArguments)
+from config_parser import load_config
+import training_data
+
+class PipelineTrainer(Trainer):
+    """
+    A Trainer that loads batches with the pipeline's length-bucket sampler, if there is one, and
+    reports tokens/sec and the pad ratio with its other training logs.
+    """
+
+    def __init__(self, *args, batch_sampler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sampler = batch_sampler
+        self.throughput = training_data.ThroughputStats()
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.batch_sampler is None:
+            return super().get_train_dataloader()
+        loader = DataLoader(
+            self.train_dataset,
+            batch_sampler=self.batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        return self.accelerator.prepare(loader) if hasattr(self, 'accelerator') else loader
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        self.throughput.update(inputs['attention_mask'])
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def log(self, logs, *args, **kwargs):
+        logs.update(self.throughput.summary())
+        super().log(logs, *args, **kwargs)
+
+def build_model(tokenizer, model_name: str, tiny: bool, max_length: int) -> RobertaForMaskedLM:
+    """
+    Load the pretrained model, or create a tiny randomly initialized one for quick CPU runs.
+
+    Args:
+        tokenizer: The tokenizer, for the vocabulary size and padding token.
+        model_name (str): Name or path of the pretrained model.
+        tiny (bool): Whether to create a two-layer model instead.
+        max_length (int): Longest sequence the tiny model must handle.
+
+    Returns:
+        RobertaForMaskedLM: The model.
+    """
+    if not tiny:
+        return RobertaForMaskedLM.from_pretrained(model_name)
+    config = RobertaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=128,
+        # RoBERTa numbers positions from the padding id + 1
+        max_position_embeddings=max_length + tokenizer.pad_token_id + 1,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    return RobertaForMaskedLM(config)
+
+def main(argv=None):
+    config = load_config('config.yaml')
+    settings = config.get('training', {})
+
+    parser = argparse.ArgumentParser(description="Fine-tune CodeBERT on the source code of local repository clones.")
+    parser.add_argument('sources', nargs='*', help="Directories to collect source files from")
+    parser.add_argument('--model', default=settings.get('model_name', 'microsoft/codebert-base'),
+                        help="Pretrained model name or path")
+    parser.add_argument('--corpus', default=settings.get('corpus'),
+                        help="A deduplicated corpus built by corpus_builder.py, instead of source directories")
+    parser.add_argument('--tokenizer', help="Tokenizer name or path; defaults to the model's")
+    parser.add_argument('--mode', choices=training_data.MODES, default=settings.get('mode', 'bucket'),
+                        help="Pack sequences to full length, or batch whole files by length with dynamic padding")
+    parser.add_argument('--max-length', type=int, default=settings.get('max_length', 512), help="Sequence length")
+    parser.add_argument('--batch-size', type=int, default=settings.get('batch_size', 8), help="Examples per batch")
+    parser.add_argument('--epochs', type=float, default=settings.get('epochs', 3), help="Training epochs")
+    parser.add_argument('--max-steps', type=int, default=-1, help="Stop after this many steps")
+    parser.add_argument('--output', default=settings.get('output_dir', './fine_tuned_codebert'),
+                        help="Where to save the fine-tuned model")
+    parser.add_argument('--tiny', action='store_true', help="Train a tiny randomly initialized model, for testing")
+    args = parser.parse_args(argv)
+
+    sources = args.sources or settings.get('sources') or [config['repository']['local_directory']]
+    tokenizer = RobertaTokenizerFast.from_pretrained(args.tokenizer or args.model)
+    cache_directory = settings.get('cache_directory', training_data.DEFAULT_CACHE_DIRECTORY)
+    if args.corpus:
+        corpus = training_data.tokenize_corpus(training_data.CodeCorpus(args.corpus), tokenizer, cache_directory)
+    else:
+        corpus = training_data.tokenize_sources(
+            sources, tokenizer, cache_directory,
+            extensions=settings.get('extensions', training_data.DEFAULT_EXTENSIONS),
+        )
+    print(f"Corpus: {corpus.num_documents} files, {corpus.num_tokens} tokens")
+    dataset, batch_sampler = training_data.training_dataset(corpus, tokenizer, args.mode, args.max_length,
+                                                            args.batch_size)
+    model = build_model(tokenizer, args.model, args.tiny, args.max_length)
+
+    # Pads each batch only to its longest example, and masks tokens for masked language modelling
+    data_collator = DataCollatorForLanguageModeling(tokenizer, mlm_probability=0.15, pad_to_multiple_of=8)
+    training_args = TrainingArguments(
+        output_dir="./results",
+        num_train_epochs=args.epochs,
+        max_steps=args.max_steps,
+        per_device_train_batch_size=args.batch_size,
+        save_steps=10_000,
+        save_total_limit=2,
+        logging_steps=settings.get('logging_steps', 50),
+    )
+    trainer = PipelineTrainer(
+        model=model,
+        args=training_args,
+        train_dataset=dataset,
+        data_collator=data_collator,
+        batch_sampler=batch_sampler,
+    )
+    trainer.train()
+
+    summary = trainer.throughput.summary()
+    print(f"Trained on {trainer.throughput.real_tokens} tokens at {summary['tokens_per_second']:.0f} tokens/sec, "
+          f"pad ratio {summary['pad_ratio']:.1%}")
+
+    # Save the fine-tuned model
+    model.save_pretrained(args.output)
+    tokenizer.save_pretrained(args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+from corpus_builder import DEFAULT_EXTENSIONS, CodeCorpus, iter_source_files
+
+DEFAULT_CACHE_DIRECTORY = './.refactor_earth_cache/training_data'
+TOKEN_DTYPE = np.uint32
+TOKENS_FILE = 'tokens.bin'
+OFFSETS_FILE = 'offsets.npy'
+META_FILE = 'meta.json'
+MODES = ('pack', 'bucket')
+
+def _tokenizer_digest(tokenizer: Any) -> str:
+    vocab = json.dumps(sorted(tokenizer.get_vocab().items())).encode()
+    identity = f"{type(tokenizer).__name__}|{tokenizer.name_or_path}|{len(tokenizer)}".encode()
+    return hashlib.sha1(identity + vocab).hexdigest()
+
+def _corpus_digest(files: Sequence[str], tokenizer_digest: str) -> str:
+    digest = hashlib.sha1(tokenizer_digest.encode())
+    for path in files:
+        stat = os.stat(path)
+        digest.update(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+class TokenizedCorpus:
+    """
+    Token ids of a set of source files, stored on disk and read through a memory map.
+
+    The tokens of all documents are concatenated in one flat file of 32-bit ids; `offsets` holds
+    where each document starts, with the total token count as its last entry.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): Directory written by `tokenize_sources`.
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        if self.offsets[-1]:
+            self.tokens = np.memmap(os.path.join(path, TOKENS_FILE), dtype=TOKEN_DTYPE, mode='r')
+        else:  # np.memmap cannot map an empty file
+            self.tokens = np.zeros(0, dtype=TOKEN_DTYPE)
+
+    @property
+    def num_documents(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def num_tokens(self) -> int:
+        return int(self.offsets[-1])
+
+    def lengths(self) -> np.ndarray:
+        """Token count of each document."""
+        return np.diff(self.offsets)
+
+    def document(self, index: int) -> np.ndarray:
+        """Token ids of one document."""
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]]
+
+def _tokenize(documents: Iterable[Tuple[str, str]], tokenizer: Any, path: str, batch_files: int) -> TokenizedCorpus:
+    if os.path.exists(os.path.join(path, META_FILE)):
+        return TokenizedCorpus(path)
+
+    # Written next to the final location and renamed, so an interrupted run never leaves a half corpus
+    partial = path + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    start = time.perf_counter()
+    offsets = [0]
+    names = []
+    documents = iter(documents)
+    with open(os.path.join(partial, TOKENS_FILE), 'wb') as out:
+        while True:
+            batch = list(itertools.islice(documents, batch_files))
+            if not batch:
+                break
+            # Whole files, without special tokens: those are added when sequences are built
+            encoded = tokenizer([text for _, text in batch], add_special_tokens=False, verbose=False)['input_ids']
+            for (name, _), ids in zip(batch, encoded):
+                if not ids:
+                    continue
+                np.asarray(ids, dtype=TOKEN_DTYPE).tofile(out)
+                offsets.append(offsets[-1] + len(ids))
+                names.append(name)
+    elapsed = time.perf_counter() - start
+
+    np.save(os.path.join(partial, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    meta = {
+        'tokenizer': tokenizer.name_or_path,
+        'files': names,
+        'tokens': offsets[-1],
+        'tokenize_seconds': elapsed,
+        'tokens_per_second': offsets[-1] / elapsed if elapsed else 0.0,
+    }
+    with open(os.path.join(partial, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(partial, path)
+    print(f"Tokenized {len(names)} files into {offsets[-1]} tokens "
+          f"in {elapsed:.2f} seconds ({meta['tokens_per_second']:.0f} tokens/sec)")
+    return TokenizedCorpus(path)
+
+def _read_files(files: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    for file_path in files:
+        with open(file_path, encoding='utf-8', errors='replace') as f:
+            yield file_path, f.read()
+
+def tokenize_sources(directories: Iterable[str], tokenizer: Any, cache_directory: str = DEFAULT_CACHE_DIRECTORY,
+                     extensions: Sequence[str] = DEFAULT_EXTENSIONS, batch_files: int = 64) -> TokenizedCorpus:
+    """
+    Tokenize every source file under some directories, once.
+
+    The result is cached under a digest of the tokenizer and of the files' paths, sizes and
+    modification times, so later runs on an unchanged tree load it instantly. Files are read and
+    tokenized in batches and written out as they go, so memory use doesn't grow with the corpus.
+
+    Args:
+        directories (Iterable[str]): Directories to search, e.g. local repository clones.
+        tokenizer: A Hugging Face tokenizer; a fast one tokenizes batches in parallel.
+        cache_directory (str): Where tokenized corpora are kept.
+        extensions (Sequence[str]): File extensions to include.
+        batch_files (int): Files tokenized per call to the tokenizer.
+
+    Returns:
+        TokenizedCorpus: The tokenized corpus.
+    """
+    files = list(iter_source_files(directories, extensions))
+    path = os.path.join(cache_directory, _corpus_digest(files, _tokenizer_digest(tokenizer))[:16])
+    return _tokenize(_read_files(files), tokenizer, path, batch_files)
+
+def tokenize_corpus(corpus: CodeCorpus, tokenizer: Any, cache_directory: str = DEFAULT_CACHE_DIRECTORY,
+                    batch_files: int = 64) -> TokenizedCorpus:
+    """
+    Tokenize a deduplicated corpus built by corpus_builder, once.
+
+    Like `tokenize_sources`, but the documents are read from the corpus' memory-mapped shards,
+    and the result is cached under the corpus' id.
+
+    Args:
+        corpus (CodeCorpus): The corpus.
+        tokenizer: A Hugging Face tokenizer.
+        cache_directory (str): Where tokenized corpora are kept.
+        batch_files (int): Documents tokenized per call to the tokenizer.
+
+    Returns:
+        TokenizedCorpus: The tokenized corpus.
+    """
+    digest = hashlib.sha1(f"{corpus.id}|{_tokenizer_digest(tokenizer)}".encode()).hexdigest()
+    names = (document['path'] for document in corpus.documents())
+    return _tokenize(zip(names, corpus), tokenizer, os.path.join(cache_directory, digest[:16]), batch_files)
+
+class PackedDataset(Dataset):
+    """
+    The corpus as one stream of tokens, cut into sequences of exactly `seq_length` tokens.
+
+    Documents are joined with a separator token and every sequence is wrapped in the
+    classification and separator tokens, so no position is ever padding. The tokens left over
+    at the end of the stream are dropped.
+    """
+
+    def __init__(self, corpus: TokenizedCorpus, seq_length: int, cls_token_id: int, sep_token_id: int):
+        """
+        Args:
+            corpus (TokenizedCorpus): The tokenized corpus.
+            seq_length (int): Length of every sequence, special tokens included.
+            cls_token_id (int): Token that starts each sequence.
+            sep_token_id (int): Token that ends each sequence and each document.
+        """
+        self.corpus = corpus
+        self.block = seq_length - 2
+        self.cls_token_id = cls_token_id
+        self.sep_token_id = sep_token_id
+        # Where each document starts in the stream, counting the separator after every document
+        self._starts = corpus.offsets[:-1] + np.arange(corpus.num_documents)
+        self.stream_length = corpus.num_tokens + corpus.num_documents
+
+    def __len__(self) -> int:
+        return self.stream_length // self.block
+
+    def __getitem__(self, index: int) -> Dict[str, List[int]]:
+        position, end = index * self.block, (index + 1) * self.block
+        document = int(np.searchsorted(self._starts, position, side='right')) - 1
+        pieces = [[self.cls_token_id]]
+        while position < end:
+            tokens = self.corpus.document(document)
+            offset = position - self._starts[document]
+            piece = tokens[offset:offset + end - position]
+            pieces.append(piece)
+            position += len(piece)
+            if position < end:
+                pieces.append([self.sep_token_id])
+                position += 1
+            document += 1
+        pieces.append([self.sep_token_id])
+        return {'input_ids': np.concatenate(pieces).astype(np.int64).tolist()}
+
+class BucketedDataset(Dataset):
+    """
+    Each document as its own example, split into pieces of at most `max_length` tokens.
+
+    Examples are not padded here; combined with `LengthBucketSampler` and a padding collator,
+    each batch is padded only to the length of its own longest example.
+    """
+
+    def __init__(self, corpus: TokenizedCorpus, max_length: int, cls_token_id: int, sep_token_id: int):
+        """
+        Args:
+            corpus (TokenizedCorpus): The tokenized corpus.
+            max_length (int): Longest example, special tokens included.
+            cls_token_id (int): Token that starts each example.
+            sep_token_id (int): Token that ends each example.
+        """
+        self.corpus = corpus
+        self.cls_token_id = cls_token_id
+        self.sep_token_id = sep_token_id
+        chunk = max_length - 2
+        document_lengths = corpus.lengths()
+        pieces = -(-document_lengths // chunk)
+        self.documents = np.repeat(np.arange(corpus.num_documents), pieces)
+        first_piece = np.repeat(np.cumsum(pieces) - pieces, pieces)
+        self.starts = (np.arange(len(self.documents)) - first_piece) * chunk
+        self.lengths = np.minimum(chunk, document_lengths[self.documents] - self.starts) + 2
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def __getitem__(self, index: int) -> Dict[str, List[int]]:
+        start = self.starts[index]
+        tokens = self.corpus.document(self.documents[index])[start:start + self.lengths[index] - 2]
+        ids = np.concatenate(([self.cls_token_id], tokens, [self.sep_token_id]))
+        return {'input_ids': ids.astype(np.int64).tolist()}
+
+def default_boundaries(max_length: int, smallest: int = 32) -> List[int]:
+    """Bucket upper bounds doubling from `smallest` up to `max_length`."""
+    boundaries = []
+    bound = smallest
+    while bound < max_length:
+        boundaries.append(bound)
+        bound *= 2
+    return boundaries + [max_length]
+
+class LengthBucketSampler(Sampler):
+    """
+    Yields batches of example indexes whose lengths fall in the same bucket.
+
+    Every epoch the examples are shuffled within their bucket, cut into batches, and the batches
+    of all buckets shuffled together, so batches are of similar lengths but in random order.
+    """
+
+    def __init__(self, lengths: Sequence[int], batch_size: int, boundaries: Optional[Sequence[int]] = None,
+                 shuffle: bool = True, seed: int = 0):
+        """
+        Args:
+            lengths (Sequence[int]): Length of each example.
+            batch_size (int): Examples per batch.
+            boundaries (Sequence[int], optional): Upper bounds of the buckets. Defaults to
+                `default_boundaries` up to the longest example.
+            shuffle (bool): Whether to shuffle; if not, batches go from the shortest bucket up.
+            seed (int): Seed of the shuffling; each epoch uses the next one.
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        if boundaries is None:
+            boundaries = default_boundaries(int(self.lengths.max()) if len(self.lengths) else 1)
+        self.buckets = np.searchsorted(np.asarray(boundaries), self.lengths, side='left')
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _batches(self) -> List[np.ndarray]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        batches = []
+        for bucket in np.unique(self.buckets):
+            members = np.flatnonzero(self.buckets == bucket)
+            if self.shuffle:
+                rng.shuffle(members)
+            batches.extend(members[i:i + self.batch_size] for i in range(0, len(members), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self._batches()
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        return int(sum(-(-count // self.batch_size) for count in np.unique(self.buckets, return_counts=True)[1]))
+
+def training_dataset(corpus: TokenizedCorpus, tokenizer: Any, mode: str = 'bucket', max_length: int = 512,
+                     batch_size: int = 8, seed: int = 0) -> Tuple[Dataset, Optional[LengthBucketSampler]]:
+    """
+    Build the examples to train on.
+
+    Args:
+        corpus (TokenizedCorpus): The tokenized corpus.
+        tokenizer: The tokenizer, for its special tokens.
+        mode (str): 'pack' for full fixed-length sequences, 'bucket' for whole documents batched by length.
+        max_length (int): Sequence length, special tokens included.
+        batch_size (int): Examples per batch.
+        seed (int): Seed of the bucket shuffling.
+
+    Returns:
+        Tuple[Dataset, Optional[LengthBucketSampler]]: The dataset, and in 'bucket' mode the batch
+        sampler to load it with.
+    """
+    if mode == 'pack':
+        return PackedDataset(corpus, max_length, tokenizer.cls_token_id, tokenizer.sep_token_id), None
+    if mode == 'bucket':
+        dataset = BucketedDataset(corpus, max_length, tokenizer.cls_token_id, tokenizer.sep_token_id)
+        return dataset, LengthBucketSampler(dataset.lengths, batch_size, default_boundaries(max_length), seed=seed)
+    raise ValueError(f"Unknown mode {mode!r}; expected one of {', '.join(MODES)}")
+
+class ThroughputStats:
+    """Counts real and padded token positions of the batches trained on, and the time taken."""
+
+    def __init__(self):
+        self.real_tokens = 0
+        self.total_tokens = 0
+        self.started: Optional[float] = None
+
+    def update(self, attention_mask: torch.Tensor) -> None:
+        """Record one batch, from its attention mask (1 for real tokens, 0 for padding)."""
+        if self.started is None:
+            self.started = time.perf_counter()
+        self.real_tokens += int(attention_mask.sum())
+        self.total_tokens += attention_mask.numel()
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Returns:
+            Dict[str, float]: 'tokens_per_second' (real tokens only) and 'pad_ratio', the fraction
+            of positions that were padding.
+        """
+        elapsed = time.perf_counter() - self.started if self.started is not None else 0.0
+        return {
+            'tokens_per_second': self.real_tokens / elapsed if elapsed else 0.0,
+            'pad_ratio': 1 - self.real_tokens / self.total_tokens if self.total_tokens else 0.0,
+        }
+
+def pad_ratio(dataset: Dataset, batches: Iterable[Sequence[int]], pad_to_multiple_of: int = 1) -> float:
+    """
+    Compute the fraction of padding a dataset would be batched with, without tokenizing or training.
+
+    Args:
+        dataset (Dataset): A PackedDataset or BucketedDataset.
+        batches (Iterable[Sequence[int]]): Index batches, e.g. from a sampler.
+        pad_to_multiple_of (int): Padded lengths are rounded up to a multiple of this.
+
+    Returns:
+        float: Padded positions over all positions.
+    """
+    lengths = dataset.lengths if isinstance(dataset, BucketedDataset) else np.full(len(dataset), dataset.block + 2)
+    real = total = 0
+    for batch in batches:
+        batch_lengths = lengths[list(batch)]
+        longest = -(-int(batch_lengths.max()) // pad_to_multiple_of) * pad_to_multiple_of
+        real += int(batch_lengths.sum())
+        total += longest * len(batch)
+    return 1 - real / total if total else 0.0
+
+def compare_modes(corpus: TokenizedCorpus, tokenizer: Any, max_length: int = 512, batch_size: int = 8) -> Dict[str, Dict[str, float]]:
+    """
+    Compare the padding of the old fixed-length batching with packing and length bucketing.
+
+    Args:
+        corpus (TokenizedCorpus): The tokenized corpus.
+        tokenizer: The tokenizer, for its special tokens.
+        max_length (int): Sequence length.
+        batch_size (int): Examples per batch.
+
+    Returns:
+        Dict[str, Dict[str, float]]: 'examples', 'batches' and 'pad_ratio' of each strategy.
+    """
+    results = {}
+    bucketed, sampler = training_dataset(corpus, tokenizer, 'bucket', max_length, batch_size)
+    batches = list(sampler)
+    fixed_real = int(bucketed.lengths.sum())
+    results['max_length'] = {'examples': len(bucketed), 'batches': len(batches),
+                             'pad_ratio': 1 - fixed_real / (len(bucketed) * max_length) if len(bucketed) else 0.0}
+    results['bucket'] = {'examples': len(bucketed), 'batches': len(batches),
+                         'pad_ratio': pad_ratio(bucketed, batches, pad_to_multiple_of=8)}
+    packed, _ = training_dataset(corpus, tokenizer, 'pack', max_length, batch_size)
+    results['pack'] = {'examples': len(packed), 'batches': -(-len(packed) // batch_size), 'pad_ratio': 0.0}
+    return results
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Tokenize source trees and compare padding strategies.")
+    parser.add_argument('directories', nargs='+', help="Directories to collect source files from")
+    parser.add_argument('--tokenizer', default='microsoft/codebert-base', help="Tokenizer name or path")
+    parser.add_argument('--cache', default=DEFAULT_CACHE_DIRECTORY, help="Tokenized corpus cache directory")
+    parser.add_argument('--max-length', type=int, default=512, help="Sequence length")
+    parser.add_argument('--batch-size', type=int, default=8, help="Examples per batch")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    corpus = tokenize_sources(args.directories, tokenizer, args.cache)
+    print(f"{corpus.num_documents} documents, {corpus.num_tokens} tokens in {corpus.path}")
+    for mode, result in compare_modes(corpus, tokenizer, args.max_length, args.batch_size).items():
+        print(f"{mode:>10}: {result['examples']} examples in {result['batches']} batches, "
+              f"pad ratio {result['pad_ratio']:.1%}")